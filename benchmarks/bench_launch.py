@@ -0,0 +1,252 @@
+# Benchmarks for the launch path of run-sandbox, using synthetic config trees and a stub bwrap.
+# Doesn't need bwrap, D-Bus or a display.
+#
+# Usage:
+#   python benchmarks/bench_launch.py --output results.json
+#   python benchmarks/bench_launch.py --save-baseline baseline.json
+#   python benchmarks/bench_launch.py --baseline baseline.json
+# With --baseline, the exit status is 1 if any benchmark is slower than the baseline by
+# more than --threshold. Baselines are only meaningful on the machine they were recorded on.
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+from argparse import ArgumentParser
+from collections.abc import Callable
+from statistics import median
+from typing import Any
+
+src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, src_path)
+
+from classes.config_index import ConfigIndex
+from classes.config_loader import ConfigLoader
+from classes.config_parser import ConfigParser
+from classes.merger import simple_merge
+from classes.sandbox import Sandbox
+
+# Sizes of the generated trees
+scales: dict[str, dict[str, int]] = {
+    "small": {"depth": 10, "width": 20, "entries": 50, "search_paths": 3, "directories": 20, "extra_configs": 100},
+    "default": {"depth": 40, "width": 100, "entries": 200, "search_paths": 5, "directories": 100, "extra_configs": 1000},
+    "large": {"depth": 100, "width": 400, "entries": 1000, "search_paths": 10, "directories": 500, "extra_configs": 5000},
+}
+
+
+def write_config(path: str, config: dict[str, Any]) -> None:
+    # JSON is a subset of YAML, and much faster to write
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        json.dump(config, file)
+
+
+def filesystem_entries(prefix: str, count: int) -> dict[str, list[str]]:
+    return {
+        "ro-bind-opt": [f"/nonexistent/{prefix}/ro/{i}" for i in range(count // 2)],
+        "bind-opt": [f'"$HOME/.bench/{prefix}/rw {i}"' for i in range(count - count // 2)],
+    }
+
+
+# Generates the config tree in 'root' and returns its search paths.
+# It contains:
+#   deep-0 .. deep-N   a chain where each config inherits the next one
+#   wide               inherits every 'leaf-*' config, which all inherit 'shared'
+#   extra-*            unrelated configs, spread across directories and search paths
+def generate_tree(root: str, scale: dict[str, int]) -> list[str]:
+    search_paths = [os.path.join(root, f"search-{i}") for i in range(scale["search_paths"])]
+    directories = [os.path.join(search_paths[i % len(search_paths)], *[f"d{j}" for j in range(i % 4 + 1)], f"dir-{i}") for i in range(scale["directories"])]
+
+    def place(name: str, index: int) -> str:
+        return os.path.join(directories[index % len(directories)], name + ".yaml")
+
+    # The chain is spread over the directories, with its root in the last search path
+    for i in range(scale["depth"]):
+        config = {"permissions": {"filesystem": filesystem_entries(f"deep-{i}", scale["entries"])}}
+        if i + 1 < scale["depth"]:
+            config["inherit"] = [f"deep-{i + 1}"]
+        if i == 0:
+            config["name"] = "Deep"
+            config["run"] = "true"
+        write_config(place(f"deep-{i}", i), config)
+
+    write_config(place("shared", 0), {
+        "permissions": {
+            "filesystem": filesystem_entries("shared", scale["entries"]),
+            "environment": {"copyenv": ["HOME", "PATH"]},
+        },
+    })
+    for i in range(scale["width"]):
+        write_config(place(f"leaf-{i}", i), {
+            "inherit": ["shared"],
+            "permissions": {"filesystem": filesystem_entries(f"leaf-{i}", scale["entries"] // 10)},
+        })
+    write_config(place("wide", 1), {
+        "name": "Wide",
+        "inherit": [f"leaf-{i}" for i in range(scale["width"])],
+        "permissions": {"namespaces": ["share-network"]},
+        "run": "true",
+    })
+
+    for i in range(scale["extra_configs"]):
+        write_config(place(f"extra-{i}", i), {"inherit": ["shared"], "run": "true"})
+
+    return search_paths
+
+
+# Runs 'function' until it has run 'runs' times or for 'duration' seconds, whichever is
+# later, and returns the timings in seconds. 'setup' is called before each run, untimed.
+def measure(function: Callable[[], Any], runs: int, duration: float, setup: Callable[[], Any] = lambda: None) -> list[float]:
+    timings = []
+    end = time.perf_counter() + duration
+    while len(timings) < runs or time.perf_counter() < end:
+        setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run_benchmarks(search_paths: list[str], root: str, runs: int, duration: float) -> dict[str, list[float]]:
+    results = {}
+    index_cache = os.path.join(root, "index.json")
+
+    # Config lookups
+    def cold_index() -> None:
+        ConfigIndex(search_paths, cache_file=None).find("deep-0.yaml")
+    results["find_file.cold"] = measure(cold_index, runs, duration)
+
+    ConfigIndex(search_paths, cache_file=index_cache).refresh()
+    def warm_index() -> None:
+        ConfigIndex(search_paths, cache_file=index_cache).find("deep-0.yaml")
+    results["find_file.warm"] = measure(warm_index, runs, duration)
+
+    index = ConfigIndex(search_paths, cache_file=index_cache)
+    index.refresh()
+    names = sorted(name for name in index.names if name.startswith("extra-"))[::7]
+    results["find_file.indexed"] = measure(lambda: [index.find(name) for name in names], runs, duration)
+
+    # Resolving inherits
+    results["load.deep"] = measure(lambda: ConfigLoader(search_paths, index).load("deep-0"), runs, duration)
+    results["load.wide"] = measure(lambda: ConfigLoader(search_paths, index).load("wide"), runs, duration)
+
+    # Merging on its own, with configs which have already been parsed. Merging modifies
+    # the configs, so fresh copies are made before each run.
+    leaves = [ConfigLoader(search_paths, index).load(f"leaf-{i}") for i in range(20)]
+    copies = []
+    def copy_leaves() -> None:
+        nonlocal copies
+        copies = [json.loads(json.dumps(leaf)) for leaf in leaves]
+    def merge() -> None:
+        for leaf in copies[1:]:
+            simple_merge(copies[0], leaf)
+    results["simple_merge"] = measure(merge, runs, duration, setup=copy_leaves)
+
+    # Generating args
+    for name in ["deep-0", "wide"]:
+        config = ConfigLoader(search_paths, index).load(name)
+        categories = {key: value for key, value in config.items() if key not in ["name", "run"]}
+        results[f"config_parser.{name}"] = measure(lambda: ConfigParser(categories), runs, duration)
+        parser = ConfigParser(categories)
+        results[f"to_args.{name}"] = measure(parser.to_args, runs, duration)
+
+    # Launching, against the stub bwrap
+    for name in ["deep-0", "wide"]:
+        config = ConfigLoader(search_paths, index).load(name)
+        def launch() -> None:
+            Sandbox(dict(config)).run()
+        results[f"sandbox_run.{name}"] = measure(launch, runs, duration)
+
+    # The whole command, including interpreter startup, with and without the launch cache
+    command = [sys.executable, os.path.join(src_path, "run-sandbox.py")] + [arg for path in search_paths for arg in ["-s", path]]
+    subprocess.run(command + ["wide"], check=True, stdout=subprocess.DEVNULL)
+    results["run_sandbox.cached"] = measure(lambda: subprocess.run(command + ["wide"], check=True), runs, duration)
+    results["run_sandbox.uncached"] = measure(lambda: subprocess.run(command + ["--no-cache", "wide"], check=True), runs, duration)
+
+    return results
+
+
+# Returns the names of the benchmarks which are slower than in the baseline by more than 'threshold'
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], threshold: float) -> list[str]:
+    regressions = []
+    print(f"{'benchmark':<28}{'baseline':>12}{'current':>12}{'change':>10}", file=sys.stderr)
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:<28}{'-':>12}{result['median'] * 1000:>10.3f}ms{'new':>10}", file=sys.stderr)
+            continue
+        previous = baseline[name]["median"]
+        change = (result["median"] - previous) / previous if previous else 0.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = " !"
+        print(f"{name:<28}{previous * 1000:>10.3f}ms{result['median'] * 1000:>10.3f}ms{change:>+9.0%}{flag}", file=sys.stderr)
+    return regressions
+
+
+def main() -> int:
+    argparser = ArgumentParser(description="Benchmarks for the launch path of run-sandbox.")
+    argparser.add_argument("--scale", choices=scales.keys(), default="default", help="Size of the generated config trees.")
+    argparser.add_argument("--runs", type=int, default=10, help="Minimum number of runs of each benchmark.")
+    argparser.add_argument("--duration", type=float, default=0.5, help="Minimum time to spend on each benchmark, in seconds.")
+    argparser.add_argument("--output", "-o", metavar="FILE", default=None, help="Write the results as JSON to FILE instead of stdout.")
+    argparser.add_argument("--baseline", metavar="FILE", default=None, help="Compare the results to a baseline written with --save-baseline.")
+    argparser.add_argument("--save-baseline", metavar="FILE", default=None, help="Write the results to FILE as a baseline.")
+    argparser.add_argument("--threshold", type=float, default=0.25, help="Slowdown relative to the baseline which counts as a regression. Defaults to 0.25 (25%%).")
+    args = argparser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="sandbox-bench-")
+    try:
+        # Keep the benchmarks away from the user's caches, config dirs and runtime dir
+        stub_path = os.path.join(root, "bin")
+        os.makedirs(stub_path)
+        with open(os.path.join(stub_path, "bwrap"), "w") as file:
+            file.write("#!/bin/sh\nexit 0\n")
+        os.chmod(os.path.join(stub_path, "bwrap"), 0o755)
+        os.environ["PATH"] = stub_path + os.pathsep + os.environ.get("PATH", "")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(root, "cache")
+        os.environ["XDG_RUNTIME_DIR"] = os.path.join(root, "runtime")
+        os.environ["SANDBOX_CONFIG_DIRS"] = ""
+        os.environ.setdefault("HOME", root)
+
+        search_paths = generate_tree(os.path.join(root, "configs"), scales[args.scale])
+        timings = run_benchmarks(search_paths, root, args.runs, args.duration)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    results = {name: {"median": median(values), "min": min(values), "runs": len(values)} for name, values in timings.items()}
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "scale": args.scale,
+        "results": results,
+    }
+
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(data + "\n")
+    else:
+        print(data)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            file.write(data + "\n")
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        if baseline.get("scale") != args.scale:
+            print(f"The baseline was recorded with scale '{baseline.get('scale')}', not '{args.scale}'.", file=sys.stderr)
+            return 2
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            print(f"Slower than the baseline: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
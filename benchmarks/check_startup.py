@@ -0,0 +1,92 @@
+# Checks that the imports at the top of run-sandbox.py (done on every launch, including launch
+# cache hits) stay within a time budget, and that modules which are only needed on other paths
+# aren't imported there. Uses 'python -X importtime', and only counts the modules run-sandbox
+# imports itself, not those the interpreter imports anyway.
+#
+# Usage:
+#   python benchmarks/check_startup.py
+#   python benchmarks/check_startup.py --budget-ms 30 --runs 20
+# The exit status is 1 if the median import time is over the budget, or if a deferred module
+# was imported.
+import os
+import re
+import sys
+import subprocess
+from argparse import ArgumentParser
+from statistics import median
+
+src_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+run_sandbox = os.path.join(src_path, "run-sandbox.py")
+
+# Modules which should only be imported once they're needed (e.g. PyYAML when a config file
+# is parsed, handlers when a config is), as patterns matched against module names
+deferred_modules: list[str] = [
+    r"yaml(\..*)?",
+    r"_yaml",
+    r"subprocess",
+    r"tempfile",
+    r"classes\.category_handlers\.(?!category_base$).*",
+]
+
+# Lines of '-X importtime' output: self time and cumulative time in microseconds, and the
+# module name, indented by the depth of the import
+_line_pattern = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+# Returns the top-level imports made by running the command, as {module: cumulative µs},
+# and every module imported
+def import_times(command: list[str]) -> tuple[dict[str, int], set[str]]:
+    result = subprocess.run([sys.executable, "-X", "importtime"] + command, capture_output=True, text=True)
+    top_level = {}
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = _line_pattern.match(line)
+        if not match:
+            continue
+        modules.add(match[4])
+        if len(match[3]) == 1:
+            top_level[match[4]] = int(match[2])
+    return top_level, modules
+
+
+def main() -> None:
+    argparser = ArgumentParser(description="Check run-sandbox's import time against a budget.")
+    # About 1.4 times the import time on a typical desktop, as measured with '-X importtime'
+    # (which makes imports slower). Pass a budget measured on the machine running the check.
+    argparser.add_argument("--budget-ms", type=float, default=60.0, help="Largest acceptable median import time, in milliseconds.")
+    argparser.add_argument("--runs", type=int, default=10, help="Number of times to import run-sandbox's modules.")
+    args = argparser.parse_args()
+
+    # Runs run-sandbox.py up to the creation of its argument parser
+    with open(run_sandbox, "r") as file:
+        header = file.read().split("\nargparser = ")[0]
+    command = ["-c", f"import sys\nsys.path.insert(0, {src_path!r})\n{header}"]
+
+    # Imported by the interpreter itself, so not counted
+    _, interpreter_modules = import_times(["-c", "pass"])
+
+    totals = []
+    imported = set()
+    for _ in range(args.runs):
+        top_level, modules = import_times(command)
+        totals.append(sum(time for module, time in top_level.items() if module not in interpreter_modules) / 1000)
+        imported |= modules - interpreter_modules
+
+    failed = False
+    total = median(totals)
+    print(f"run-sandbox imports: median {total:.1f} ms over {args.runs} runs (budget {args.budget_ms:.1f} ms), {len(imported)} modules.")
+    if total > args.budget_ms:
+        print(f"Import time is over the budget by {total - args.budget_ms:.1f} ms.")
+        failed = True
+    deferred = [module for module in sorted(imported) if any(re.fullmatch(pattern, module) for pattern in deferred_modules)]
+    for module in deferred:
+        # Submodules of a package that's already reported
+        if module.rpartition(".")[0] in deferred:
+            continue
+        print(f"'{module}' is imported at startup, but should only be imported when it's needed.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+import os
+import struct
+import threading
+from copy import deepcopy
+from classes.template import split_words, expand_word
+from typing import Any, Optional
+
+# Records which paths a sandbox opens while it runs (see '--trace-access'), so that the
+# filesystem permissions it never uses can be found and removed from its config.
+#
+# Paths are recorded as the sandbox sees them, i.e. they're the destinations of its binds.
+# The processes in the sandbox are bwrap's descendants, found through /proc. Two methods:
+#  - Sampling /proc: every few milliseconds, the files each process in the sandbox has open
+#    (fd), has mapped (maps, e.g. libraries) and its working directory are read. Needs no
+#    privileges, but files which are opened and closed between samples are missed.
+#  - fanotify, if this process has CAP_SYS_ADMIN: the filesystems of the bound paths are
+#    watched, and every open is recorded. Opens are attributed to the sandbox by the mount
+#    they were made through, since the sandbox's mounts are its own copies (listed in its
+#    mountinfo). /proc is still sampled, for filesystems which can't be watched.
+# Neither sees paths which are only stat()'d or looked up, e.g. to check that they exist,
+# so a report should be reviewed before entries are removed.
+
+_sample_interval = 0.01
+
+# fanotify_init() and fanotify_mark() flags
+_FAN_CLOEXEC = 0x1
+_FAN_NONBLOCK = 0x2
+_FAN_UNLIMITED_QUEUE = 0x10
+_FAN_MARK_ADD = 0x1
+_FAN_MARK_FILESYSTEM = 0x100
+_FAN_OPEN = 0x20
+_FAN_Q_OVERFLOW = 0x4000
+_FAN_ONDIR = 0x40000000
+_AT_FDCWD = -100
+# struct fanotify_event_metadata
+_event = struct.Struct("=IBBHQii")
+
+
+def _readlink(path: str) -> Optional[str]:
+    try:
+        target = os.readlink(path)
+    except OSError:
+        return None
+    if not target.startswith("/"):
+        # Pipes, sockets, etc.
+        return None
+    return target.removesuffix(" (deleted)")
+
+
+# Returns the pids of the processes a process has started which are still running
+def _children(pid: int) -> list[int]:
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", "r") as file:
+                children += map(int, file.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def _file_id(path: str) -> Optional[tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+class AccessTracer():
+    # 'fanotify' or 'proc'
+    method: str
+    # Paths the sandbox has opened, as it sees them
+    paths: set[str]
+    # Set if fanotify reported that events were lost
+    overflowed: bool
+    # Bound paths (outside the sandbox), whose filesystems are watched with fanotify
+    sources: list[str]
+    _fanotify_fd: int
+    # Paths opened through each mount, as {mount id: paths}, from fanotify
+    _mount_paths: dict[int, set[str]]
+    # Ids of the sandbox's mounts
+    _sandbox_mounts: set[int]
+    _mount_namespace: Optional[tuple[int, int]]
+    _bwrap_pid: int
+    _bwrap_exe: Optional[tuple[int, int]]
+    _thread: Optional[threading.Thread]
+    _stopping: threading.Event
+
+    # 'method' is 'auto', 'fanotify' or 'proc'. With 'auto', fanotify is used if possible.
+    def __init__(self, sources: list[str], method: str = "auto"):
+        self.method = "proc"
+        self.paths = set()
+        self.overflowed = False
+        self.sources = sources
+        self._fanotify_fd = -1
+        self._mount_paths = {}
+        self._sandbox_mounts = set()
+        self._mount_namespace = _file_id("/proc/self/ns/mnt")
+        self._bwrap_pid = 0
+        self._bwrap_exe = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+        if method != "proc":
+            try:
+                self._init_fanotify()
+                self.method = "fanotify"
+            except OSError as error:
+                if method == "fanotify":
+                    raise RuntimeError(f"Could not watch the sandbox's files with fanotify: {error}")
+
+    # Watches the filesystems of the sources, before the sandbox is started
+    def _init_fanotify(self) -> None:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+        libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+
+        fd = libc.fanotify_init(_FAN_CLOEXEC | _FAN_NONBLOCK | _FAN_UNLIMITED_QUEUE, os.O_RDONLY | os.O_LARGEFILE)
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        watched = set()
+        for source in self.sources:
+            device = _file_id(source)
+            if device is None or device[0] in watched:
+                continue
+            # Filesystems which can't be watched are left to the /proc samples
+            if libc.fanotify_mark(fd, _FAN_MARK_ADD | _FAN_MARK_FILESYSTEM, _FAN_OPEN | _FAN_ONDIR, _AT_FDCWD, os.fsencode(source)) == 0:
+                watched.add(device[0])
+        if not watched:
+            os.close(fd)
+            raise OSError("None of the bound paths' filesystems can be watched")
+        self._fanotify_fd = fd
+
+    # Starts recording what the sandbox started by the bwrap process opens
+    def attach(self, bwrap_pid: int) -> None:
+        self._bwrap_pid = bwrap_pid
+        self._thread = threading.Thread(target=self._run, name="access trace", daemon=True)
+        self._thread.start()
+
+    # Stops recording, once the sandbox has exited, and returns the recorded paths
+    def detach(self) -> set[str]:
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._fanotify_fd != -1:
+            self._read_events()
+            os.close(self._fanotify_fd)
+            self._fanotify_fd = -1
+            for mount_id in self._sandbox_mounts:
+                self.paths |= self._mount_paths.get(mount_id, set())
+        return self.paths
+
+    def _run(self) -> None:
+        import select
+        while not self._stopping.is_set():
+            if self._fanotify_fd != -1:
+                select.select([self._fanotify_fd], [], [], _sample_interval)
+                self._read_events()
+            else:
+                self._stopping.wait(_sample_interval)
+            self._sample()
+
+    # Returns the pids of the processes in the sandbox
+    def _sandbox_pids(self) -> list[int]:
+        pids = []
+        pending = _children(self._bwrap_pid)
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            pending += _children(pid)
+        return pids
+
+    def _sample(self) -> None:
+        # Read again, since bwrap may have been started through a wrapper which executes it
+        # (see CategoryBase.command_prefix)
+        self._bwrap_exe = _file_id(f"/proc/{self._bwrap_pid}/exe")
+        namespaces = set()
+        for pid in self._sandbox_pids():
+            namespace = _file_id(f"/proc/{pid}/ns/mnt")
+            # Still setting up the sandbox, or bwrap's own process in it
+            if namespace is None or namespace == self._mount_namespace or _file_id(f"/proc/{pid}/exe") == self._bwrap_exe:
+                continue
+            if namespace not in namespaces:
+                namespaces.add(namespace)
+                self._read_mounts(pid)
+
+            try:
+                fds = os.listdir(f"/proc/{pid}/fd")
+                with open(f"/proc/{pid}/maps", "r") as file:
+                    maps = file.read()
+            except OSError:
+                # Exited, or exec'd something this process can't inspect
+                continue
+            for fd in fds:
+                path = _readlink(f"/proc/{pid}/fd/{fd}")
+                if path:
+                    self.paths.add(path)
+            for line in maps.splitlines():
+                fields = line.split(maxsplit=5)
+                if len(fields) == 6 and fields[5].startswith("/"):
+                    self.paths.add(fields[5].removesuffix(" (deleted)"))
+            path = _readlink(f"/proc/{pid}/cwd")
+            if path:
+                self.paths.add(path)
+
+    # Adds the ids of the mounts in a sandbox process's mount namespace. Read again on every
+    # sample, since the namespace is created before bwrap has set up the sandbox's mounts.
+    def _read_mounts(self, pid: int) -> None:
+        if self._fanotify_fd == -1:
+            return
+        try:
+            with open(f"/proc/{pid}/mountinfo", "r") as file:
+                for line in file:
+                    self._sandbox_mounts.add(int(line.split(maxsplit=1)[0]))
+        except OSError:
+            pass
+
+    def _read_events(self) -> None:
+        while True:
+            try:
+                data = os.read(self._fanotify_fd, 1 << 16)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset + _event.size <= len(data):
+                length, _, _, _, mask, fd, _ = _event.unpack_from(data, offset)
+                offset += length
+                if mask & _FAN_Q_OVERFLOW:
+                    self.overflowed = True
+                if fd < 0:
+                    continue
+                try:
+                    path = _readlink(f"/proc/self/fd/{fd}")
+                    mount_id = self._mount_id(fd)
+                finally:
+                    os.close(fd)
+                if path and mount_id is not None:
+                    self._mount_paths.setdefault(mount_id, set()).add(path)
+
+    @staticmethod
+    def _mount_id(fd: int) -> Optional[int]:
+        try:
+            with open(f"/proc/self/fdinfo/{fd}", "r") as file:
+                for line in file:
+                    if line.startswith("mnt_id:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+
+# Returns the filesystem options which bind paths into the sandbox,
+# as {option: number of paths in each entry}
+def bind_options() -> dict[str, int]:
+    from classes.category_handlers.permissions import FilePermissions
+    options = {}
+    for name, template in FilePermissions({}).arg_templates.items():
+        if isinstance(template, list) and template[0].removesuffix("-try").endswith("bind"):
+            options[name] = 2 if "{1}" in template else 1
+    return options
+
+
+# Returns the bind entries of the config, as (option, entry, source, destination), with
+# the paths expanded like bwrap's args are
+def bind_entries(config: dict[str, Any], env: dict[str, str]) -> list[tuple[str, str, str, str]]:
+    filesystem = (config.get("permissions") or {}).get("filesystem") or {}
+    entries = []
+    for option, count in bind_options().items():
+        for entry in filesystem.get(option) or []:
+            words = [os.path.normpath(expand_word(word, env)) for word in split_words(entry)]
+            if len(words) == count:
+                entries.append((option, entry, words[0], words[-1]))
+    return entries
+
+
+# Returns the bind entries of the config which none of the paths were opened through,
+# as {option: [entry]}. Each path is attributed to the bind with the longest destination
+# containing it, since that's the mount it was opened through.
+def find_unused(config: dict[str, Any], env: dict[str, str], paths: set[str]) -> dict[str, list[str]]:
+    entries = bind_entries(config, env)
+    destinations = {destination for _, _, _, destination in entries}
+    used = set()
+    for path in paths:
+        while path not in destinations and path != "/":
+            path = os.path.dirname(path)
+        used.add(path)
+
+    unused: dict[str, list[str]] = {}
+    for option, entry, _, destination in entries:
+        if destination not in used:
+            unused.setdefault(option, []).append(entry)
+    return unused
+
+
+# Returns the unused entries declared by each of the config's files,
+# as {path: {option: [entry]}}. 'loaded_files' is ConfigLoader.loaded_files.
+def unused_by_file(unused: dict[str, list[str]], loaded_files: dict[str, list[str]]) -> dict[str, dict[str, list[str]]]:
+    from classes.config_loader import load_yaml
+    result = {}
+    for path, _ in loaded_files.values():
+        with open(path, "rb") as file:
+            config = load_yaml(file.read())
+        filesystem = ((config or {}).get("permissions") or {}).get("filesystem") or {}
+        declared = {}
+        for option, entries in unused.items():
+            found = [entry for entry in entries if entry in (filesystem.get(option) or [])]
+            if found:
+                declared[option] = found
+        if declared:
+            result[path] = declared
+    return result
+
+
+# Returns a copy of the (flattened) config without the unused entries
+def trim_config(config: dict[str, Any], unused: dict[str, list[str]]) -> dict[str, Any]:
+    config = deepcopy(config)
+    filesystem = (config.get("permissions") or {}).get("filesystem") or {}
+    for option, entries in unused.items():
+        kept = [entry for entry in filesystem.get(option) or [] if entry not in entries]
+        if kept:
+            filesystem[option] = kept
+        else:
+            filesystem.pop(option, None)
+    return config
@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+from typing import Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from classes.sandbox import Sandbox
+    from classes.usage_metrics import UsageMetrics
+
+# Runs the launches listed in a manifest from a single process (see '--batch'), e.g. for
+# load tests and batch jobs. A manifest looks like:
+#   jobs: 8        # Sandboxes running at once, defaults to the number of CPUs
+#   stagger: 0.1   # Seconds between starting sandboxes, defaults to 0
+#   launches:
+#     - config: build
+#       args: ["--target", "x86_64"]
+#       count: 20
+#     - config: lint
+#       run: make lint
+# or just the list of launches. Each config is resolved once, and all of its launches share
+# a Sandbox, so its handlers are only created once too. Launches are started in the order
+# they're listed, whenever fewer than 'jobs' sandboxes are running, with stdin set to
+# /dev/null. A launch that can't be started is recorded as failed, without stopping the rest.
+
+
+class BatchEntry():
+    config: str
+    # Replace the config's executable
+    run: Optional[str]
+    args: list[str]
+    # Number of times to launch it
+    count: int
+
+    def __init__(self, entry: Any):
+        if not isinstance(entry, dict) or not isinstance(entry.get("config"), str):
+            raise AttributeError(f"Each launch in a batch manifest needs a 'config'.")
+        for name in entry:
+            if name not in ["config", "run", "args", "count"]:
+                raise AttributeError(f"'{name}' is not a valid option for a launch in a batch manifest.")
+
+        self.config = entry["config"]
+        self.run = entry.get("run")
+        self.args = entry.get("args", [])
+        self.count = entry.get("count", 1)
+        if self.run is not None and not isinstance(self.run, str):
+            raise AttributeError(f"'run' of '{self.config}' in the batch manifest should be an executable.")
+        if not isinstance(self.args, list) or not all(isinstance(arg, str) for arg in self.args):
+            raise AttributeError(f"'args' of '{self.config}' in the batch manifest should be a list of strings.")
+        if not isinstance(self.count, int) or isinstance(self.count, bool) or self.count < 0:
+            raise AttributeError(f"'count' of '{self.config}' in the batch manifest should be a number of launches.")
+
+
+# Returns the launches and the options ('jobs' and 'stagger') of a manifest file
+def load_manifest(path: str) -> tuple[list[BatchEntry], dict[str, Any]]:
+    from classes.config_loader import load_yaml
+    with open(path, "rb") as file:
+        manifest = load_yaml(file.read())
+
+    options = {}
+    if isinstance(manifest, dict):
+        for name in manifest:
+            if name not in ["launches", "jobs", "stagger"]:
+                raise AttributeError(f"'{name}' is not a valid batch manifest option.")
+        options = {name: manifest[name] for name in ["jobs", "stagger"] if name in manifest}
+        manifest = manifest.get("launches")
+    if not isinstance(manifest, list):
+        raise AttributeError(f"The batch manifest '{path}' should contain a list of launches.")
+    return [BatchEntry(entry) for entry in manifest], options
+
+
+def _summarize(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        "min": values[0],
+        "mean": sum(values) / len(values),
+        "median": values[len(values) // 2],
+        "p95": values[min(len(values) - 1, int(len(values) * 0.95))],
+        "max": values[-1],
+    }
+
+
+class BatchRunner():
+    search_paths: list[str]
+    entries: list[BatchEntry]
+    # Sandboxes running at once
+    jobs: int
+    # Seconds between starting sandboxes
+    stagger: float
+    metrics: Optional["UsageMetrics"]
+    verbose: bool
+    # One for each config, by name
+    sandboxes: dict[str, "Sandbox"]
+    # One for each launch, in the order they finished:
+    # {"config", "exit_code", "error", "launch_seconds", "run_seconds"}
+    results: list[dict[str, Any]]
+    wall_seconds: float
+    # time.monotonic() value before which the next sandbox isn't started
+    _next_start: float
+
+    def __init__(self, search_paths: list[str], entries: list[BatchEntry], jobs: Optional[int] = None, stagger: float = 0.0, metrics: Optional["UsageMetrics"] = None, verbose: bool = False):
+        if jobs is not None and (not isinstance(jobs, int) or isinstance(jobs, bool) or jobs < 1):
+            raise AttributeError("'jobs' should be a number of sandboxes, at least 1.")
+        if not isinstance(stagger, (int, float)) or isinstance(stagger, bool) or stagger < 0:
+            raise AttributeError("'stagger' should be a number of seconds.")
+        self.search_paths = search_paths
+        self.entries = entries
+        self.jobs = jobs if jobs else os.cpu_count() or 1
+        self.stagger = stagger
+        self.metrics = metrics
+        self.verbose = verbose
+        self.sandboxes = {}
+        self.results = []
+        self.wall_seconds = 0.0
+        self._next_start = 0.0
+
+    # Resolves every config before anything is launched, so that a broken one is found first
+    def resolve(self) -> None:
+        from classes.config_loader import ConfigLoader
+        from classes.sandbox import Sandbox
+        config_loader = ConfigLoader(self.search_paths)
+        for entry in self.entries:
+            if entry.config not in self.sandboxes:
+                sandbox = Sandbox(config_loader.load(entry.config))
+                sandbox.metrics = self.metrics
+                self.sandboxes[entry.config] = sandbox
+
+    # Runs every launch, and returns the summary
+    def run(self) -> dict[str, Any]:
+        import asyncio
+        if not self.sandboxes:
+            self.resolve()
+        started = time.monotonic()
+        try:
+            asyncio.run(self._run_all())
+        finally:
+            self.wall_seconds = time.monotonic() - started
+        return self.summary()
+
+    async def _run_all(self) -> None:
+        import asyncio
+        slots = asyncio.Semaphore(self.jobs)
+        launches = []
+        for entry in self.entries:
+            launches += [self._launch(entry, slots) for _ in range(entry.count)]
+        await asyncio.gather(*launches)
+
+    async def _launch(self, entry: BatchEntry, slots: "asyncio.Semaphore") -> None:
+        import asyncio
+        from functools import partial
+        from subprocess import DEVNULL
+        loop = asyncio.get_running_loop()
+        sandbox = self.sandboxes[entry.config]
+        result = {"config": entry.config, "exit_code": None, "error": None, "launch_seconds": None, "run_seconds": None}
+
+        async with slots:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self.stagger
+            if start > now:
+                await asyncio.sleep(start - now)
+
+            launched = time.monotonic()
+            # Whatever goes wrong while preparing (e.g. an error in a handler), only this
+            # launch fails
+            try:
+                command = sandbox.create_command(entry.run, entry.args)
+                sandbox_process = await loop.run_in_executor(None, partial(sandbox.start, command, stdin=DEVNULL))
+            except Exception as error:
+                result.update(error=str(error), launch_seconds=time.monotonic() - launched)
+                self._record(result)
+                return
+
+            try:
+                result["exit_code"] = await sandbox_process.wait_async()
+            except asyncio.CancelledError:
+                sandbox_process.terminate()
+                await asyncio.shield(sandbox_process.wait_async())
+                raise
+            result["launch_seconds"] = sandbox_process.spawned - launched
+            result["run_seconds"] = sandbox_process.exited - sandbox_process.spawned
+            self._record(result)
+
+    def _record(self, result: dict[str, Any]) -> None:
+        self.results.append(result)
+        if self.verbose:
+            if result["error"] is not None:
+                print(f"{result['config']}: could not be launched: {result['error']}", file=sys.stderr)
+            else:
+                print(f"{result['config']}: exited with {result['exit_code']} after {result['run_seconds']:.2f} s.", file=sys.stderr)
+
+    # Returns the exit codes and durations of the launches, in total and for each config.
+    # Exit codes are counted as {"0": count, ...}, with "error" for launches that couldn't be
+    # started and negative numbers for sandboxes killed by a signal.
+    def summary(self) -> dict[str, Any]:
+        def aggregate(results: list[dict[str, Any]]) -> dict[str, Any]:
+            exit_codes: dict[str, int] = {}
+            for result in results:
+                key = "error" if result["error"] is not None else str(result["exit_code"])
+                exit_codes[key] = exit_codes.get(key, 0) + 1
+            return {
+                "launches": len(results),
+                "failed": sum(count for key, count in exit_codes.items() if key != "0"),
+                "exit_codes": exit_codes,
+                "launch_seconds": _summarize([result["launch_seconds"] for result in results if result["error"] is None]),
+                "run_seconds": _summarize([result["run_seconds"] for result in results if result["error"] is None]),
+            }
+
+        summary = aggregate(self.results)
+        summary["wall_seconds"] = self.wall_seconds
+        summary["jobs"] = self.jobs
+        summary["configs"] = {
+            name: aggregate([result for result in self.results if result["config"] == name]) for name in self.sandboxes
+        }
+        return summary
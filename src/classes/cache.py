@@ -0,0 +1,47 @@
+import os
+from hashlib import sha256
+from typing import Optional
+
+
+# Returns the path of a file or directory inside sandbox-manager's cache directory,
+# following the XDG base directory specification.
+def cache_path(*parts: str) -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "sandbox-manager", *parts)
+
+
+def digest(data: bytes) -> str:
+    return sha256(data).hexdigest()
+
+
+# Returns the digest of a file's contents, or None if it can't be read.
+def file_digest(path: str) -> Optional[str]:
+    try:
+        with open(path, "rb") as file:
+            return digest(file.read())
+    except OSError:
+        return None
+
+
+# Writes data to path atomically, so that concurrent readers never see a partial file.
+# Cache files are only an optimization, so failures are ignored and False is returned.
+def write_atomic(path: str, data: bytes) -> bool:
+    import tempfile
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    except OSError:
+        return False
+
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+
+    return True
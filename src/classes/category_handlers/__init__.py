@@ -1,30 +1,68 @@
-# Automatically populates 'handlers' from the scripts in this folder
-# when imported
-import os
+# Provides 'category_handlers', the handlers of the scripts in this folder by category name.
+# Each handler's module is imported the first time it is looked up.
 import importlib
+from collections.abc import Mapping, Iterator
 from classes.category_handlers.category_base import CategoryBase
 
-category_handlers = {}
-# List of files we shouldn't include in the search
-_excluded_files = ["__init__.py", "category_base.py", "__pycache__"]
-
-_parent_dir = os.path.dirname(__file__)
-# Get list of files at the location of __init__.py
-_file_list = os.listdir(_parent_dir)
-# Filter files
-_file_list = [file for file in _file_list if not file in _excluded_files]
-
-for file in _file_list:
-    handler_name = os.path.splitext(file)[0]
-    try:
-        a = importlib.import_module("classes.category_handlers." + handler_name)
-        handler = a.handler
-    except AttributeError:
-        print(f"Category handler '{file}' has no 'handler' variable. It will not be used.")
-        continue
-
-    if not issubclass(handler, CategoryBase):
-        print(f"Category handler '{file}' doesn't inherit from CategoryBase. It will not be used.")
-        continue
-    
-    category_handlers[handler_name] = handler
+
+class HandlerRegistry(Mapping):
+    _names: list[str]
+    # Handlers whose default_args() aren't empty
+    _with_defaults: list[str]
+    _handlers: dict[str, type[CategoryBase] | None]
+
+    def __init__(self, names: dict[str, bool]):
+        self._names = sorted(names)
+        self._with_defaults = [name for name in self._names if names[name]]
+        # None marks handlers that failed to load
+        self._handlers = {}
+
+    def _load(self, name: str) -> type[CategoryBase] | None:
+        if name in self._handlers:
+            return self._handlers[name]
+
+        handler = None
+        try:
+            a = importlib.import_module("classes.category_handlers." + name)
+            handler = a.handler
+        except AttributeError:
+            print(f"Category handler '{name}.py' has no 'handler' variable. It will not be used.")
+
+        if handler is not None and not issubclass(handler, CategoryBase):
+            print(f"Category handler '{name}.py' doesn't inherit from CategoryBase. It will not be used.")
+            handler = None
+
+        self._handlers[name] = handler
+        return handler
+
+    def __getitem__(self, name: str) -> type[CategoryBase]:
+        handler = self._load(name) if name in self._names else None
+        if handler is None:
+            raise KeyError(name)
+        return handler
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._names and self._load(name) is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name in self._names if self._load(name) is not None)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    # Returns the handlers with default args, which are only loaded when this is called
+    def with_default_args(self) -> list[type[CategoryBase]]:
+        return [handler for name in self._with_defaults if (handler := self._load(name)) is not None]
+
+
+# The scripts in this folder, as {category name: whether its handler has default args}.
+# Listed here rather than found with os.listdir(), which would run on every launch, so a new
+# handler has to be added to it.
+_handler_files: dict[str, bool] = {
+    "output": False,
+    "permissions": True,
+    "preprocess": False,
+    "resources": False,
+}
+
+category_handlers = HandlerRegistry(_handler_files)
@@ -1,10 +1,19 @@
+import os
 from abc import ABC, abstractmethod
 from typing import Optional, Any
-from collections.abc import Callable
+from collections.abc import Callable, Mapping
+from classes.prepare_scheduler import PrepareStep
 
 # Abstract base class (ABC) for a configuration category.
 # All categories must inherit from this.
 class CategoryBase(ABC):
+    # Names of the prepare steps (see prepare_steps()) which have to
+    # finish before this handler's prepare() is called
+    prepare_after: list[str] = []
+    # The environment of the sandbox being launched (see Sandbox.env), which prepare()
+    # should read variables such as appName from instead of os.environ
+    env: Mapping[str, str] = os.environ
+
     @abstractmethod
     def __init__(self, config: dict[str, Any]):
         pass
@@ -23,9 +32,50 @@ class CategoryBase(ABC):
     def default_args() -> list[str]:
         return []
     
+    # Called before prepare(), with the environment of the sandbox being launched
+    def set_env(self, env: Mapping[str, str]) -> None:
+        self.env = env
+
     # Called before the sandbox is run.
     # Returns either None, or a list of functions to call
     # after the sandbox terminates
     def prepare(self) -> Optional[list[Callable]]:
         pass
+
+    # Returns a command to run bwrap through, which has to execute the words that follow it
+    # (e.g. a shell which moves itself into a cgroup first). Called after prepare(). There
+    # is no way to run Python code in the child process, since that isn't safe between fork
+    # and exec while other threads (e.g. output capture) are running.
+    def command_prefix(self) -> list[str]:
+        return []
+
+    # Returns file descriptors to use as bwrap's stdio instead of the launcher's, as
+    # {'stdin', 'stdout' or 'stderr': fd}. Called after prepare().
+    def stdio(self) -> dict[str, int]:
+        return {}
+
+    # Called once bwrap has been started, in the process which started it.
+    # Releases anything prepare() created which only bwrap needed.
+    def started(self) -> None:
+        pass
+
+    # Returns True if prepare() has work to do, or if the output of to_args()
+    # differs between launches. Otherwise the args can be cached and reused
+    # without instantiating the handler again. Defaults to whether prepare() is
+    # overridden, so that a handler which doesn't say is never cached.
+    def needs_prepare(self) -> bool:
+        return self.has_prepare()
+
+    # Whether the handler's class overrides prepare()
+    def has_prepare(self) -> bool:
+        return type(self).prepare is not CategoryBase.prepare
+
+    # Returns the work done by prepare() as steps, which are run concurrently with
+    # the steps of other handlers. 'name' is the name of the handler's category.
+    # prepare() is called on every launch that isn't served from the cache, whatever
+    # needs_prepare() returns.
+    def prepare_steps(self, name: str) -> list[PrepareStep]:
+        if not self.has_prepare():
+            return []
+        return [PrepareStep(name, self.prepare, self.prepare_after)]
     
\ No newline at end of file
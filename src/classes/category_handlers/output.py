@@ -0,0 +1,121 @@
+import os
+import re
+from classes.category_handlers.category_base import CategoryBase
+from classes.template import expand_vars
+from typing import Any, Optional
+from collections.abc import Callable
+
+# Writes the sandbox's stdout and/or stderr to log files instead of passing on the stdio of
+# the process which started it (see OutputCapture). Streams which aren't given a file are
+# passed on as usual. Both can be written to the same file.
+
+_size_suffixes: dict[str, int] = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def _parse_size(name: str, value: Any) -> int:
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    match = re.fullmatch(r"(\d+)([KMG]?)", value.strip().upper()) if isinstance(value, str) else None
+    if match and int(match[1]) > 0:
+        return int(match[1]) * _size_suffixes.get(match[2], 1)
+    raise AttributeError(f"'{name}' should be a number of bytes, optionally followed by K, M or G.")
+
+
+class OutputHandler(CategoryBase):
+    # Log file of each stream, as {'stdout' or 'stderr': path}
+    files: dict[str, str]
+    # Size at which log files are rotated, None to never rotate them
+    max_size: Optional[int]
+    # Number of rotated files to keep
+    keep: int
+    timestamps: bool
+    # Bytes per second read from each stream
+    rate_limit: Optional[int]
+    # Write ends of the pipes of the launch being prepared, as {'stdout' or 'stderr': fd}
+    pipes: dict[str, int]
+
+    def __init__(self, config: dict[str, Any]):
+        if not isinstance(config, dict):
+            raise AttributeError(f"Config category 'output' has an invalid structure.")
+
+        self.files = {}
+        self.max_size = 10 << 20
+        self.keep = 5
+        self.timestamps = False
+        self.rate_limit = None
+        self.pipes = {}
+
+        for name, value in config.items():
+            self.parse_config(name, value)
+
+    def parse_config(self, name: str, value: Any) -> None:
+        match name:
+            case "stdout" | "stderr":
+                if not isinstance(value, str) or not value:
+                    raise AttributeError(f"'{name}' should be the path of a log file.")
+                self.files[name] = value
+            case "max-size":
+                self.max_size = None if value == "unlimited" else _parse_size(name, value)
+            case "keep":
+                if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                    raise AttributeError(f"'keep' should be a number of rotated log files to keep.")
+                self.keep = value
+            case "timestamps":
+                if not isinstance(value, bool):
+                    raise AttributeError(f"'timestamps' should be true or false.")
+                self.timestamps = value
+            case "rate-limit":
+                self.rate_limit = _parse_size(name, value)
+            case _:
+                raise AttributeError(f"'{name}' is not a valid output option.")
+
+    def prepare(self) -> list[Callable]:
+        from classes.output_capture import OutputCapture, LogFile, create_pipe
+
+        # Left over from an earlier launch by this process
+        self.close_pipes()
+        if not self.files:
+            return []
+        logs: dict[str, LogFile] = {}
+        streams = []
+        try:
+            for stream, path in self.files.items():
+                path = os.path.abspath(expand_vars(path, self.env))
+                if path not in logs:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    logs[path] = LogFile(path, self.max_size, self.keep)
+                read_fd, self.pipes[stream] = create_pipe()
+                streams.append((read_fd, logs[path]))
+        except OSError as error:
+            self.close_pipes()
+            for read_fd, _ in streams:
+                os.close(read_fd)
+            for log in logs.values():
+                log.close()
+            raise RuntimeError(f"Could not open the sandbox's log files: {error}")
+
+        capture = OutputCapture(streams, self.timestamps, self.rate_limit)
+        capture.start()
+        return [capture.finish]
+
+    # Passed to Popen, which makes them bwrap's stdout and stderr
+    def stdio(self) -> dict[str, int]:
+        return dict(self.pipes)
+
+    def close_pipes(self) -> None:
+        while self.pipes:
+            os.close(self.pipes.popitem()[1])
+
+    # bwrap has its own copies of the write ends, so the capture sees the end of the
+    # streams once the sandbox exits
+    def started(self) -> None:
+        self.close_pipes()
+
+    def needs_prepare(self) -> bool:
+        return len(self.files) > 0
+
+    def to_args(self) -> list[str]:
+        return []
+
+
+handler = OutputHandler
@@ -1,16 +1,28 @@
 import os
 import atexit
-import __main__ as main
 from classes.category_handlers.category_base import CategoryBase
-from subprocess import Popen
-from typing import Any, Optional
-from collections.abc import Callable
+from classes.prepare_scheduler import PrepareStep
+from classes import tracing
+from classes.template import split_words, quote_word, expand_word, expand_vars
+from typing import Any, Optional, TYPE_CHECKING
+from collections.abc import Callable, Mapping
 from abc import ABC, abstractmethod
 
+if TYPE_CHECKING:
+    from subprocess import Popen
+    from classes.seccomp import SeccompPolicy
+
 
 # Abstract base class (ABC) for a permission.
 # All permissions should inherit from this.
 class BasePermission(ABC):
+    # The name of the permission category, e.g. 'filesystem'
+    name: str
+    # See CategoryBase.prepare_after
+    prepare_after: list[str] = []
+    # See CategoryBase.env
+    env: Mapping[str, str] = os.environ
+
     @abstractmethod
     def to_args(self) -> list[str]:
         return ""
@@ -19,18 +31,33 @@ class BasePermission(ABC):
     def prepare(self) -> Optional[list[Callable]]:
         pass
 
+    # See CategoryBase.started
+    def started(self) -> None:
+        pass
+
+    # See CategoryBase.needs_prepare
+    def needs_prepare(self) -> bool:
+        return self.has_prepare()
+
+    # See CategoryBase.has_prepare
+    def has_prepare(self) -> bool:
+        return type(self).prepare is not BasePermission.prepare
+
 
 class PermissionHandler(CategoryBase):
     permission_list: list[BasePermission]
+    # Used when the config has no 'namespaces' permission
     defaults: list[str] = [
         "--unshare-all",
     ]
+    args: list[str]
 
     def __init__(self, config: dict[str, Any]):
         if not isinstance(config, dict):
             raise AttributeError(f"Config category 'permissions' has an invalid structure.")
         
         self.permission_list = []
+        self.args = list(self.defaults)
 
         for key, settings in config.items():
             new_perm = self.handle_permission_category(key, settings)
@@ -44,10 +71,12 @@ class PermissionHandler(CategoryBase):
             case "dbus":
                 return DbusPermissions(settings)
             case "namespaces":
-                self.defaults.remove("--unshare-all")
+                self.args = []
                 return NamespacePermissions(settings)
             case "environment":
                 return EnvironmentPermissions(settings)
+            case "seccomp":
+                return SeccompPermissions(settings)
             case _:
                 raise AttributeError(f"'{name}' is not a valid permission configuration category.")
 
@@ -61,8 +90,24 @@ class PermissionHandler(CategoryBase):
         
         return callbacks
 
+    def set_env(self, env: Mapping[str, str]) -> None:
+        self.env = env
+        for perm in self.permission_list:
+            perm.env = env
+
+    def started(self) -> None:
+        for perm in self.permission_list:
+            perm.started()
+
+    def needs_prepare(self) -> bool:
+        return any(perm.needs_prepare() for perm in self.permission_list)
+
+    # Each permission is prepared as a separate step, named e.g. 'permissions.dbus'
+    def prepare_steps(self, name: str) -> list[PrepareStep]:
+        return [PrepareStep(f"{name}.{perm.name}", perm.prepare, perm.prepare_after) for perm in self.permission_list if perm.has_prepare()]
+
     def to_args(self) -> list[str]:
-        args = []
+        args = list(self.args)
 
         for permission in self.permission_list:
             args += permission.to_args()
@@ -81,31 +126,51 @@ handler = PermissionHandler
 
 
 class FilePermissions(BasePermission):
+    name: str = "filesystem"
     args: list[str]
-    tempfiles: list[str]
-    arg_templates: dict[str, str | Callable]
+    # Open memfds holding the contents of created files
+    memfds: list[int]
+    # Files to create, as {destination: contents}
+    created_files: dict[str, str]
+    # Position of the 'create-files' args within args
+    created_files_index: int
+    created_files_args: list[str]
+    # Overlays, as lists of words: [destination] or [destination, upper directory]
+    overlays: list[list[str]]
+    # Position of the 'overlay' args within args
+    overlays_index: int
+    overlays_args: list[str]
+    # Each argument in the config is split into words, which replace {0}, {1}, etc.
+    arg_templates: dict[str, list[str] | Callable]
 
     def __init__(self, settings: dict[str, list[str] | dict[str, str]]):
-        self.tempfiles = []
+        self.memfds = []
         self.args = []
+        self.created_files = {}
+        self.created_files_index = 0
+        self.created_files_args = []
+        self.overlays = []
+        self.overlays_index = 0
+        self.overlays_args = []
         self.arg_templates = {
-            "ro-bind": "--ro-bind {0} {0}",
-            "ro-bind-opt": "--ro-bind-try {0} {0}",
-            "ro-bind-to": "--ro-bind {0}",
-            "ro-bind-to-opt": "--ro-bind-try {0}",
-            "bind-devices": "--dev-bind {0} {0}",
-            "bind-devices-opt": "--dev-bind-try {0} {0}",
-            "bind-devices-to": "--dev-bind {0}",
-            "bind-devices-to-opt": "--dev-bind-try {0}",
-            "bind": "--bind {0} {0}",
-            "bind-opt": "--bind-try {0} {0}",
-            "bind-to": "--bind {0}",
-            "bind-to-opt": "--bind-try {0}",
-            "link": "--symlink {0}",
-            "new-dev": "--dev {0}",
-            "new-tmpfs": "--tmpfs {0}",
-            "new-proc": "--proc {0}",
-            "create-files": self.handle_file_create
+            "ro-bind": ["--ro-bind", "{0}", "{0}"],
+            "ro-bind-opt": ["--ro-bind-try", "{0}", "{0}"],
+            "ro-bind-to": ["--ro-bind", "{0}", "{1}"],
+            "ro-bind-to-opt": ["--ro-bind-try", "{0}", "{1}"],
+            "bind-devices": ["--dev-bind", "{0}", "{0}"],
+            "bind-devices-opt": ["--dev-bind-try", "{0}", "{0}"],
+            "bind-devices-to": ["--dev-bind", "{0}", "{1}"],
+            "bind-devices-to-opt": ["--dev-bind-try", "{0}", "{1}"],
+            "bind": ["--bind", "{0}", "{0}"],
+            "bind-opt": ["--bind-try", "{0}", "{0}"],
+            "bind-to": ["--bind", "{0}", "{1}"],
+            "bind-to-opt": ["--bind-try", "{0}", "{1}"],
+            "link": ["--symlink", "{0}", "{1}"],
+            "new-dev": ["--dev", "{0}"],
+            "new-tmpfs": ["--tmpfs", "{0}"],
+            "new-proc": ["--proc", "{0}"],
+            "create-files": self.handle_file_create,
+            "overlay": self.handle_overlay,
         }
 
         for permission_name, permission in settings.items():
@@ -123,45 +188,201 @@ class FilePermissions(BasePermission):
         if not isinstance(args, list):
             raise AttributeError(f"'{name}' has an invalid argument. It should be a list.")
 
-        return [handler.format(arg) for arg in args]
+        # Number of paths each argument should contain
+        word_count = 2 if "{1}" in handler else 1
+        result = []
+        for arg in args:
+            words = split_words(arg) if isinstance(arg, str) else []
+            if len(words) != word_count:
+                raise AttributeError(f"'{arg}' is not a valid argument for '{name}'. It should contain {word_count} path(s). Use quotes around paths containing spaces.")
+            result += [template.format(*words) for template in handler]
+        return result
 
     def handle_file_create(self, config: dict[str, str]) -> list[str]:
-        import tempfile
         if not isinstance(config, dict):
             raise AttributeError(f"'create-files' needs to be a linked list of the form 'name: data'.")
 
-        if not os.path.exists("/tmp/sandbox_files"):
-            os.mkdir("/tmp/sandbox_files")
-        
-        args = []
         for bind_path, contents in config.items():
             if not isinstance(bind_path, str) or not isinstance(contents, str):
                 raise AttributeError(f"'create-files' has an invalid structure.")
-            
-            file = tempfile.NamedTemporaryFile(mode="w+", dir="/tmp/sandbox_files", prefix=os.environ.get("appName", ""), delete=False)
-            file.write(os.path.expanduser(os.path.expandvars(contents)))
-            self.tempfiles.append(file.name)
+            if len(split_words(bind_path)) != 1:
+                raise AttributeError(f"'{bind_path}' is not a valid path for 'create-files'. Use quotes around paths containing spaces.")
+
+        # The files are written in prepare(), and their args inserted here
+        self.created_files = config
+        self.created_files_index = len(self.args)
+        return []
+
+    def handle_overlay(self, overlays: list[str]) -> list[str]:
+        if not isinstance(overlays, list):
+            raise AttributeError(f"'overlay' has an invalid argument. It should be a list.")
+
+        for overlay in overlays:
+            words = split_words(overlay) if isinstance(overlay, str) else []
+            if len(words) not in [1, 2]:
+                raise AttributeError(f"'{overlay}' is not a valid argument for 'overlay'. It should contain a path, optionally followed by the path of a directory to keep changes in. Use quotes around paths containing spaces.")
+            self.overlays.append(words)
+
+        # The layers are set up in prepare(), and their args inserted here
+        self.overlays_index = len(self.args)
+        return []
+
+    def prepare(self) -> Optional[list[Callable]]:
+        callbacks = []
+        if self.overlays:
+            callbacks += self.create_overlays()
+
+        if self.created_files:
+            self.created_files_args = []
+            # Left over from an earlier launch by this process
+            self.close_memfds()
+            if hasattr(os, "memfd_create"):
+                try:
+                    self.create_memfds()
+                    return callbacks
+                except OSError:
+                    self.close_memfds()
+                    self.created_files_args = []
+            callbacks += self.create_tempfiles()
+
+        return callbacks
+
+    # Each overlay's lower layer is a base layer in the cache directory, kept per app name and
+    # destination. The first launch binds a new, empty base layer with write access instead,
+    # so that whatever the application sets up on its first run is saved in it. Later launches
+    # start from that state, and their changes either go to a temporary upper layer
+    # ('--tmp-overlay') or, if a directory was given, are kept in it ('--overlay').
+    def create_overlays(self) -> list[Callable]:
+        import tempfile
+        from hashlib import sha256
+        from classes.cache import cache_path
+
+        self.overlays_args = []
+        callbacks = []
+        for words in self.overlays:
+            destination = expand_word(words[0], self.env)
+            layers_dir = cache_path("overlays", self.env.get("appName") or "unnamed")
+            base = os.path.join(layers_dir, sha256(destination.encode()).hexdigest()[:16])
+
+            if not os.path.isdir(base):
+                os.makedirs(layers_dir, exist_ok=True)
+                seed = tempfile.mkdtemp(dir=layers_dir, prefix=".seed-")
+                self.overlays_args += ["--bind", quote_word(seed), words[0]]
+                callbacks.append(lambda seed=seed, base=base: self.save_base_layer(seed, base))
+                continue
+
+            self.overlays_args += ["--overlay-src", quote_word(base)]
+            if len(words) == 1:
+                self.overlays_args += ["--tmp-overlay", words[0]]
+                continue
+
+            # The work directory has to be empty and on the same filesystem as the upper layer
+            upper = os.path.normpath(expand_word(words[1], self.env))
+            work = os.path.join(os.path.dirname(upper), "." + os.path.basename(upper) + ".work")
+            os.makedirs(upper, exist_ok=True)
+            os.makedirs(work, exist_ok=True)
+            self.overlays_args += ["--overlay", quote_word(upper), quote_word(work), words[0]]
+
+        return callbacks
+
+    # Only the first of several concurrent first launches gets to save its state
+    @staticmethod
+    def save_base_layer(seed: str, base: str) -> None:
+        try:
+            os.rename(seed, base)
+        except OSError:
+            import shutil
+            shutil.rmtree(seed, ignore_errors=True)
+
+    # Passes each file to bwrap as a sealed, read-only memfd, which bwrap copies into the sandbox
+    # ('--ro-bind-data FD DEST'). Nothing is written to disk, and there is nothing to clean up:
+    # bwrap closes its copies, and this process's copies are closed once bwrap has started.
+    def create_memfds(self) -> None:
+        import fcntl
+        from hashlib import sha256
+
+        # Files with the same contents share a memfd
+        memfds: dict[str, int] = {}
+        for bind_path, contents in self.created_files.items():
+            data = expand_vars(contents, self.env).encode()
+            key = sha256(data).hexdigest()
+
+            if key in memfds:
+                # A new open file, since bwrap reads each fd from its current offset to the end
+                fd = os.open(f"/proc/self/fd/{memfds[key]}", os.O_RDONLY | os.O_CLOEXEC)
+            else:
+                fd = os.memfd_create("sandbox-file", os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING)
+                with open(fd, "wb", closefd=False) as file:
+                    file.write(data)
+                fcntl.fcntl(fd, fcntl.F_ADD_SEALS, fcntl.F_SEAL_WRITE | fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_SEAL)
+                os.lseek(fd, 0, os.SEEK_SET)
+                memfds[key] = fd
+
+            self.memfds.append(fd)
+            self.created_files_args += ["--ro-bind-data", str(fd), bind_path]
+
+    def close_memfds(self) -> None:
+        while self.memfds:
+            os.close(self.memfds.pop())
+
+    # bwrap has its own copies of the memfds
+    def started(self) -> None:
+        self.close_memfds()
+
+    # Fallback for systems without memfd_create
+    def create_tempfiles(self) -> list[Callable]:
+        import tempfile
+
+        if not os.path.exists("/tmp/sandbox_files"):
+            os.mkdir("/tmp/sandbox_files")
+
+        # Kept per launch, since a sandbox can be launched again before the last launch exits
+        tempfiles = []
+        for bind_path, contents in self.created_files.items():
+            file = tempfile.NamedTemporaryFile(mode="w+", dir="/tmp/sandbox_files", prefix=self.env.get("appName", ""), delete=False)
+            file.write(expand_vars(contents, self.env))
+            tempfiles.append(file.name)
             file.close()
 
-            args.append(f"--ro-bind {file.name} {bind_path}")
-        
-        atexit.register(self.cleanup_tempfiles)
+            self.created_files_args += ["--ro-bind", quote_word(file.name), bind_path]
 
-        return args
+        def cleanup_tempfiles() -> None:
+            atexit.unregister(cleanup_tempfiles)
+            while tempfiles:
+                os.remove(tempfiles.pop())
 
-    def cleanup_tempfiles(self):
-        for file in self.tempfiles:
-            os.remove(file)
+        # Also registered with atexit in case the sandbox never runs
+        atexit.register(cleanup_tempfiles)
+        return [cleanup_tempfiles]
+
+    # Temporary files have a different name on every launch, and
+    # overlays depend on whether their base layer exists yet
+    def needs_prepare(self) -> bool:
+        return len(self.created_files) > 0 or len(self.overlays) > 0
 
     def to_args(self) -> list[str]:
-        return self.args
+        # The memfds only become inheritable once their args are used, so that processes
+        # started while preparing (e.g. the D-Bus proxy) don't get a copy
+        for fd in self.memfds:
+            os.set_inheritable(fd, True)
+        inserts = sorted([(self.created_files_index, self.created_files_args), (self.overlays_index, self.overlays_args)], key=lambda insert: insert[0])
+        args = []
+        position = 0
+        for index, inserted_args in inserts:
+            args += self.args[position:index] + inserted_args
+            position = index
+        return args + self.args[position:]
 
 
 class DbusPermissions(BasePermission):
+    name: str = "dbus"
     see_names: list[str]
     talk_names: list[str]
     own_names: list[str]
-    proxy_process: Popen
+    # Seconds to wait for xdg-dbus-proxy to start
+    proxy_timeout: float
+    # xdg-dbus-proxy writes to this pipe once it's ready
+    proxy_ready_fd: int
 
     def __init__(self, settings: dict[str, list[str]]):
         if not isinstance(settings, dict):
@@ -170,11 +391,18 @@ class DbusPermissions(BasePermission):
         self.see_names = []
         self.talk_names = []
         self.own_names = []
+        self.proxy_timeout = 5.0
 
         for permission_name, permission in settings.items():
             self.parse_config(permission_name, permission)
     
     def parse_config(self, name: str, arg: list[str]) -> None:
+        if name == "proxy-timeout":
+            if not isinstance(arg, (int, float)) or isinstance(arg, bool) or arg <= 0:
+                raise AttributeError(f"'proxy-timeout' should be a positive number of seconds.")
+            self.proxy_timeout = arg
+            return
+
         if not isinstance(name, str) or not isinstance(arg, list):
             raise AttributeError(f"Permission category 'dbus' has an invalid structure.")
         
@@ -191,27 +419,45 @@ class DbusPermissions(BasePermission):
             case _:
                 raise AttributeError(f"'{name}' is not a valid dbus permission type.")
 
+    # Identifies the proxy for this policy. Sandboxes with the same policy share a proxy.
+    def proxy_id(self) -> str:
+        from hashlib import sha256
+        policy = [sorted(set(names)) for names in [self.see_names, self.talk_names, self.own_names]]
+        return sha256(repr(policy).encode()).hexdigest()[:16]
+
     def to_args(self) -> list[str]:
-        return ['--setenv DBUS_SESSION_BUS_ADDRESS unix:path="$XDG_RUNTIME_DIR"/bus', '--bind "$XDG_RUNTIME_DIR"/xdg-dbus-proxy/$appName.sock "$XDG_RUNTIME_DIR"/bus']
-    
-    def close_dbus_proxy(self) -> None:
-        self.proxy_process.terminate()
-        # Remove the socket so that xdg-dbus-proxy can use it again later
-        os.remove(os.path.expandvars("$XDG_RUNTIME_DIR/xdg-dbus-proxy/$appName.sock"))
-    
-    def prepare(self) -> Optional[list[Callable]]:
-        from time import sleep
+        return [
+            "--setenv", "DBUS_SESSION_BUS_ADDRESS", 'unix:path="$XDG_RUNTIME_DIR"/bus',
+            "--bind", f'"$XDG_RUNTIME_DIR"/xdg-dbus-proxy/{self.proxy_id()}.sock', '"$XDG_RUNTIME_DIR"/bus'
+        ]
+
+    # Blocks until xdg-dbus-proxy reports that it's listening on its socket.
+    # Raises an error if it exits or doesn't start in time.
+    def wait_for_proxy(self, process: "Popen") -> None:
+        import select
+        import signal
+
+        with tracing.span("wait for D-Bus proxy"):
+            ready, _, _ = select.select([self.proxy_ready_fd], [], [], self.proxy_timeout)
+        if ready and os.read(self.proxy_ready_fd, 1) == b"x":
+            return
+
+        os.killpg(process.pid, signal.SIGTERM)
+        if not ready:
+            raise RuntimeError(f"xdg-dbus-proxy didn't start within {self.proxy_timeout} seconds.")
+        # The pipe was closed without being written to, so the proxy exited
+        process.wait()
+        raise RuntimeError(f"xdg-dbus-proxy exited before it was ready (exit code {process.returncode}).")
+
+    # Starts xdg-dbus-proxy in its own sandbox and returns the PID of its bwrap process
+    def start_proxy(self) -> int:
+        import __main__ as main
         from classes.sandbox import Sandbox
         from classes.config_loader import ConfigLoader
 
-        # Using a list because we can't have trailing spaces (it becomes part of the arg)
-        args = []
-        if self.see_names:
-            args.append("--see=" + " --see=".join(self.see_names))
-        if self.talk_names:
-            args.append("--talk=" + " --talk=".join(self.talk_names))
-        if self.own_names:
-            args.append("--own=" + " --own=".join(self.own_names))
+        args = [quote_word("--see=" + name) for name in self.see_names]
+        args += [quote_word("--talk=" + name) for name in self.talk_names]
+        args += [quote_word("--own=" + name) for name in self.own_names]
         args = " ".join(args)
 
         # For security reasons, we only search for the dbus sandbox file
@@ -219,20 +465,46 @@ class DbusPermissions(BasePermission):
         script_path = os.path.dirname(main.__file__)
         config_loader = ConfigLoader([script_path])
         config_loader.load("dbus")
-        config_loader.config["name"] = os.environ["appName"]
-        config_loader.config["run"] += " " + args
-        dbus_sandbox = Sandbox(config_loader.config, blocking=False)
+        config_loader.config["name"] = self.env["appNameWspace"]
+
+        # The proxy writes to the pipe once it's ready, and the read end sees end-of-file
+        # if the proxy exits first. xdg-dbus-proxy also exits when every copy of the
+        # read end is closed, so it's given its own copy to outlive this process.
+        self.proxy_ready_fd, ready_write_fd = os.pipe()
+        run_words = split_words(config_loader.config["run"])
+        config_loader.config["run"] = " ".join(run_words[:1] + [f"--fd={ready_write_fd}"] + run_words[1:]) + " " + args
+        # dbusProxyId is used in the socket path in dbus.yaml
+        dbus_sandbox = Sandbox(config_loader.config, env=dict(self.env, dbusProxyId=self.proxy_id()))
+        # The proxy is shared and is stopped by DbusProxyBroker, not when this process exits
+        dbus_sandbox.detached = True
+
+        try:
+            process = dbus_sandbox.start(pass_fds=[self.proxy_ready_fd, ready_write_fd]).process
+        finally:
+            os.close(ready_write_fd)
+
+        try:
+            self.wait_for_proxy(process)
+        finally:
+            os.close(self.proxy_ready_fd)
+        return process.pid
+
+    def prepare(self) -> Optional[list[Callable]]:
+        from classes.dbus_broker import DbusProxyBroker
 
-        self.proxy_process = dbus_sandbox.run()
+        if not self.env.get("XDG_RUNTIME_DIR"):
+            raise RuntimeError("XDG_RUNTIME_DIR needs to be set to use D-Bus permissions.")
 
-        # Wait for xdg-dbus-proxy to open the socket.
-        while not os.path.exists(os.path.expandvars("$XDG_RUNTIME_DIR/xdg-dbus-proxy/$appName.sock")):
-            sleep(0.1)
+        broker = DbusProxyBroker(os.path.join(self.env["XDG_RUNTIME_DIR"], "xdg-dbus-proxy"), self.proxy_id())
+        broker.acquire(self.start_proxy)
+        return [broker.release]
 
-        return [self.close_dbus_proxy]
+    def needs_prepare(self) -> bool:
+        return True
         
 
 class NamespacePermissions(BasePermission):
+    name: str = "namespaces"
     # Using 'unshare-user-try' instead of 'unshare-user' because it makes
     # this method of getting args much easier. However, for transparency's sake,
     # I may want to add a warning if bwrap is unable to unshare.
@@ -256,7 +528,8 @@ class NamespacePermissions(BasePermission):
 
         for namespace in allowed_namespaces:
             if namespace in self.types.keys():
-                self.types_processed.pop(namespace)
+                # The same namespace can be listed by several inherited configs
+                self.types_processed.pop(namespace, None)
             else:
                 raise AttributeError(f"'{namespace}' is not a valid namespace permission.")
 
@@ -265,6 +538,7 @@ class NamespacePermissions(BasePermission):
 
 
 class EnvironmentPermissions(BasePermission):
+    name: str = "environment"
     args: list[str]
 
     def __init__(self, settings: dict[str, list[str]]):
@@ -285,13 +559,86 @@ class EnvironmentPermissions(BasePermission):
         
         match option_name:
             case "copyenv":
-                return [f"--setenv {name} ${name}" for name in variables]
+                args = []
+                for name in variables:
+                    args += ["--setenv", name, f'"${{{name}}}"']
+                return args
             case "setenv":
-                # Split on spaces, set first arg to first word,
-                # set other arg to everything else with spaces in between
-                return [f"--setenv {name.split(" ")[0]} \"{' '.join(name.split(" ")[1:])}\"" for name in variables]
+                # Split on the first space, set first arg to first word,
+                # set other arg to everything else (expanded as if in double quotes)
+                args = []
+                for variable in variables:
+                    name, _, value = variable.partition(" ")
+                    args += ["--setenv", name, f'"{value}"']
+                return args
             case _:
                 raise AttributeError(f"'{option_name}' is not a valid environment permission.")
 
     def to_args(self) -> list[str]:
         return self.args
+
+
+class SeccompPermissions(BasePermission):
+    name: str = "seccomp"
+    policy: "SeccompPolicy"
+    # The compiled filter, kept for later launches
+    program: Optional[bytes]
+    # Holds the filter for bwrap ('--seccomp FD') until it has started
+    fd: Optional[int]
+
+    def __init__(self, settings: dict[str, Any]):
+        from classes.seccomp import SeccompPolicy
+
+        if not isinstance(settings, dict):
+            raise AttributeError(f"Permission category 'seccomp' has an invalid structure.")
+
+        for option, value in settings.items():
+            match option:
+                case "allow" | "deny" | "architectures":
+                    if not isinstance(value, list):
+                        raise AttributeError(f"'{option}' has an invalid argument. It should be a list.")
+                case "action":
+                    if not isinstance(value, str):
+                        raise AttributeError(f"'action' should be 'kill', 'trap', 'log' or an errno name such as EPERM.")
+                case _:
+                    raise AttributeError(f"'{option}' is not a valid seccomp permission.")
+
+        self.policy = SeccompPolicy(settings.get("allow"), settings.get("deny", []), settings.get("action", "EPERM"), settings.get("architectures"))
+        self.program = None
+        self.fd = None
+
+    def prepare(self) -> Optional[list[Callable]]:
+        from classes.seccomp import load_filter
+
+        if self.program is None:
+            with tracing.span("load seccomp filter"):
+                self.program = load_filter(self.policy)
+
+        # Left over from an earlier launch by this process
+        self.close_fd()
+        if hasattr(os, "memfd_create"):
+            self.fd = os.memfd_create("seccomp-filter", os.MFD_CLOEXEC)
+        else:
+            import tempfile
+            self.fd = os.dup(tempfile.TemporaryFile().fileno())
+        with open(self.fd, "wb", closefd=False) as file:
+            file.write(self.program)
+        os.lseek(self.fd, 0, os.SEEK_SET)
+
+    def close_fd(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    # bwrap has its own copy of the filter
+    def started(self) -> None:
+        self.close_fd()
+
+    # The filter is passed through a new file descriptor on every launch
+    def needs_prepare(self) -> bool:
+        return True
+
+    def to_args(self) -> list[str]:
+        # Only inheritable once its args are used, like the memfds of created files
+        os.set_inheritable(self.fd, True)
+        return ["--seccomp", str(self.fd)]
@@ -1,5 +1,6 @@
 import os
 from classes.category_handlers.category_base import CategoryBase
+from classes.template import expand_vars
 
 class PreprocessingHandler(CategoryBase):
     directories: list[str]
@@ -26,7 +27,10 @@ class PreprocessingHandler(CategoryBase):
     def prepare(self) -> None:
         for directory in self.directories:
             # Permission mode follows umask
-            os.makedirs(os.path.expanduser(os.path.expandvars(directory)), exist_ok=True)
+            os.makedirs(expand_vars(directory, self.env), exist_ok=True)
+
+    def needs_prepare(self) -> bool:
+        return len(self.directories) > 0
 
     def to_args(self) -> list[str]:
         return []
@@ -0,0 +1,252 @@
+import os
+import re
+import itertools
+from classes.category_handlers.category_base import CategoryBase
+from classes.template import expand_vars
+from typing import Any, Optional
+from collections.abc import Callable
+
+# Places each sandbox in its own cgroup (v2), with the limits given in the config, and
+# collects the cgroup's usage counters when the sandbox exits. The cgroup is created in
+# the 'cgroup-root' directory, the SANDBOX_CGROUP_ROOT environment variable, or the parent
+# of this process's cgroup, in that order. The user needs to be able to create cgroups there
+# and move processes into them, e.g. in a cgroup delegated by systemd. Any directory can be
+# used as the root for testing, in which case the limits are only written to files.
+
+# The controller each limit needs
+_limits: dict[str, str] = {
+    "cpu.max": "cpu",
+    "cpu.weight": "cpu",
+    "memory.max": "memory",
+    "memory.high": "memory",
+    "pids.max": "pids",
+    "io.max": "io",
+}
+_size_suffixes: dict[str, int] = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+_io_keys: list[str] = ["rbps", "wbps", "riops", "wiops"]
+# Makes the names of cgroups created by the same process unique (e.g. for pools)
+_counter = itertools.count()
+
+
+def default_cgroup_root() -> str:
+    # Usually mounted at /sys/fs/cgroup, or /sys/fs/cgroup/unified on hybrid systems
+    mount_point = None
+    with open("/proc/self/mounts", "r") as file:
+        for line in file:
+            fields = line.split()
+            if len(fields) > 2 and fields[2] == "cgroup2":
+                mount_point = fields[1]
+                break
+
+    with open("/proc/self/cgroup", "r") as file:
+        for line in file:
+            # Only the cgroup v2 hierarchy has ID 0
+            if mount_point and line.startswith("0::"):
+                return os.path.join(mount_point, os.path.dirname(line[3:].strip()).lstrip("/"))
+    raise RuntimeError("This process isn't in a cgroup v2 hierarchy. Set 'cgroup-root' or SANDBOX_CGROUP_ROOT to use 'resources'.")
+
+
+# Parses sizes such as 512M, 2G or 'max' into what memory.max expects
+def _parse_size(name: str, value: Any) -> str:
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return str(value)
+    if isinstance(value, str):
+        if value == "max":
+            return value
+        match = re.fullmatch(r"(\d+)([KMGT]?)", value.strip().upper())
+        if match and int(match[1]) > 0:
+            return str(int(match[1]) * _size_suffixes.get(match[2], 1))
+    raise AttributeError(f"'{name}' should be a number of bytes, optionally followed by K, M, G or T, or 'max'.")
+
+
+class ResourcesHandler(CategoryBase):
+    # Values to write to the cgroup's interface files, as {file: value}
+    limits: dict[str, str]
+    # Lines of 'io.max', as [device, settings]. Devices are paths or MAJOR:MINOR
+    io_limits: list[list[str]]
+    cgroup_root: Optional[str]
+    # The cgroup of the last launch
+    cgroup: Optional[str]
+    # Usage counters of the cgroup of the last launch to exit, collected after it exits
+    usage: dict[str, int]
+
+    def __init__(self, config: dict[str, Any]):
+        if not isinstance(config, dict):
+            raise AttributeError(f"Config category 'resources' has an invalid structure.")
+
+        self.limits = {}
+        self.io_limits = []
+        self.cgroup_root = None
+        self.cgroup = None
+        self.usage = {}
+
+        for name, value in config.items():
+            self.parse_config(name, value)
+
+    def parse_config(self, name: str, value: Any) -> None:
+        match name:
+            case "cgroup-root":
+                if not isinstance(value, str):
+                    raise AttributeError(f"'cgroup-root' should be a path.")
+                self.cgroup_root = value
+            case "cpu.max":
+                # A percentage of one CPU, or the cgroup format: 'QUOTA [PERIOD]' in microseconds
+                if isinstance(value, str) and re.fullmatch(r"\d+(\.\d+)?%", value.strip()):
+                    quota = round(float(value.strip()[:-1]) * 1000)
+                    if quota <= 0:
+                        raise AttributeError(f"'cpu.max' should be more than 0%.")
+                    self.limits[name] = f"{quota} 100000"
+                elif isinstance(value, (str, int)) and not isinstance(value, bool) and re.fullmatch(r"(max|[1-9]\d*)( [1-9]\d*)?", str(value).strip()):
+                    self.limits[name] = str(value).strip()
+                else:
+                    raise AttributeError(f"'cpu.max' should be a percentage of one CPU (e.g. 150%), or 'QUOTA [PERIOD]' in microseconds.")
+            case "cpu.weight":
+                if not isinstance(value, int) or isinstance(value, bool) or not 1 <= value <= 10000:
+                    raise AttributeError(f"'cpu.weight' should be a number from 1 to 10000.")
+                self.limits[name] = str(value)
+            case "memory.max" | "memory.high":
+                self.limits[name] = _parse_size(name, value)
+            case "pids.max":
+                if value != "max" and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+                    raise AttributeError(f"'pids.max' should be a positive number or 'max'.")
+                self.limits[name] = str(value)
+            case "io.max":
+                if not isinstance(value, list):
+                    raise AttributeError(f"'io.max' should be a list of devices followed by their limits.")
+                for line in value:
+                    words = line.split() if isinstance(line, str) else []
+                    if len(words) < 2 or not all(re.fullmatch(f"({'|'.join(_io_keys)})=(max|\\d+)", word) for word in words[1:]):
+                        raise AttributeError(f"'{line}' is not a valid argument for 'io.max'. It should be a device (a path or MAJOR:MINOR) followed by limits, e.g. 'rbps=1048576'.")
+                    self.io_limits.append([words[0], " ".join(words[1:])])
+            case _:
+                raise AttributeError(f"'{name}' is not a valid resource limit.")
+
+    def prepare(self) -> list[Callable]:
+        root = expand_vars(self.cgroup_root or self.env.get("SANDBOX_CGROUP_ROOT") or default_cgroup_root(), self.env)
+        # The name comes from the config, and mustn't add path components or characters
+        # which are special in cgroupfs
+        app_name = re.sub(r"[^A-Za-z0-9_.-]", "_", self.env.get("appName") or "unnamed")
+        cgroup = os.path.join(root, f"sandbox-{app_name}-{os.getpid()}-{next(_counter)}")
+        self.cgroup = cgroup
+
+        controllers = sorted({_limits[name] for name in self.limits} | ({"io"} if self.io_limits else set()))
+        available = self.read_file(os.path.join(root, "cgroup.controllers"))
+        if available is not None and not set(controllers) <= set(available.split()):
+            missing = ", ".join(controller for controller in controllers if controller not in available.split())
+            raise RuntimeError(f"The cgroup controllers needed for the resource limits ({missing}) aren't available in '{root}'.")
+        try:
+            if controllers:
+                with open(os.path.join(root, "cgroup.subtree_control"), "w") as file:
+                    file.write(" ".join("+" + controller for controller in controllers))
+            os.mkdir(cgroup)
+        except OSError as error:
+            raise RuntimeError(f"Could not create a cgroup in '{root}': {error}. The user needs to be able to create cgroups there (see 'resources' in run-sandbox(1)).")
+
+        try:
+            for name, value in self.limits.items():
+                self.write(cgroup, name, value)
+            for device, settings in self.io_limits:
+                self.write(cgroup, "io.max", f"{self.device_number(device)} {settings}")
+        except (OSError, RuntimeError) as error:
+            self.remove(cgroup)
+            raise RuntimeError(f"Could not set the resource limits of '{cgroup}': {error}")
+        # The cgroup is passed along, since the sandbox can be launched again before it exits
+        return [lambda: self.finish(cgroup)]
+
+    @staticmethod
+    def write(cgroup: str, name: str, value: str) -> None:
+        with open(os.path.join(cgroup, name), "w") as file:
+            file.write(value)
+
+    def device_number(self, device: str) -> str:
+        if re.fullmatch(r"\d+:\d+", device):
+            return device
+        path = expand_vars(device, self.env)
+        try:
+            rdev = os.stat(path).st_rdev
+        except OSError as error:
+            raise RuntimeError(f"'{device}' isn't a device: {error}")
+        if not rdev:
+            raise RuntimeError(f"'{device}' isn't a device.")
+        return f"{os.major(rdev)}:{os.minor(rdev)}"
+
+    # Starts bwrap through a shell which moves itself into the cgroup and then executes bwrap,
+    # so that bwrap is in the cgroup before it starts anything else
+    def command_prefix(self) -> list[str]:
+        return ["/bin/sh", "-c", 'echo 0 > "$0" && exec "$@"', os.path.join(self.cgroup, "cgroup.procs")]
+
+    # Called after the sandbox exits
+    def finish(self, cgroup: str) -> None:
+        self.usage = self.read_usage(cgroup)
+        self.remove(cgroup)
+
+    def read_usage(self, cgroup: str) -> dict[str, int]:
+        usage = {}
+        # Flat keyed files, with the names they're reported under
+        keyed_files = {
+            "cpu.stat": {"usage_usec": "cpu_usec", "user_usec": "cpu_user_usec", "system_usec": "cpu_system_usec", "nr_throttled": "cpu_throttled", "throttled_usec": "cpu_throttled_usec"},
+            "memory.events": {"high": "memory_high_events", "max": "memory_max_events", "oom_kill": "oom_kills"},
+        }
+        for name, keys in keyed_files.items():
+            for line in self.read(cgroup, name).splitlines():
+                key, _, value = line.partition(" ")
+                if key in keys and value.isdigit():
+                    usage[keys[key]] = int(value)
+
+        for name, key in [("memory.peak", "memory_peak_bytes"), ("pids.peak", "pids_peak")]:
+            value = self.read(cgroup, name).strip()
+            if value.isdigit():
+                usage[key] = int(value)
+
+        # 'MAJOR:MINOR rbytes=N wbytes=N ...' for each device
+        for line in self.read(cgroup, "io.stat").splitlines():
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if key in ["rbytes", "wbytes", "rios", "wios"] and value.isdigit():
+                    usage["io_" + key] = usage.get("io_" + key, 0) + int(value)
+        return usage
+
+    # Returns the contents of one of the cgroup's files, or '' if it doesn't exist
+    def read(self, cgroup: str, name: str) -> str:
+        return self.read_file(os.path.join(cgroup, name)) or ""
+
+    @staticmethod
+    def read_file(path: str) -> Optional[str]:
+        try:
+            with open(path, "r") as file:
+                return file.read()
+        except OSError:
+            return None
+
+    # Removes the cgroup, killing anything the sandbox left running in it
+    def remove(self, cgroup: str) -> None:
+        import time
+        if os.path.exists(os.path.join(cgroup, "cgroup.kill")):
+            try:
+                self.write(cgroup, "cgroup.kill", "1")
+            except OSError:
+                pass
+        # Killed processes take a moment to leave the cgroup
+        for _ in range(50):
+            try:
+                os.rmdir(cgroup)
+                return
+            except FileNotFoundError:
+                return
+            except OSError:
+                # Not a real cgroup, so its files have to be removed first
+                if not os.path.exists(os.path.join(cgroup, "cgroup.controllers")):
+                    import shutil
+                    shutil.rmtree(cgroup, ignore_errors=True)
+                    return
+                time.sleep(0.01)
+
+    # Every launch gets a new cgroup
+    def needs_prepare(self) -> bool:
+        return True
+
+    def to_args(self) -> list[str]:
+        return []
+
+
+handler = ResourcesHandler
@@ -0,0 +1,46 @@
+import json
+from typing import Any, Optional
+
+
+# The result of resolving a config: the flattened config, and the bwrap args generated
+# from it. args is None when the config's handlers have to run on every launch
+# (see CategoryBase.needs_prepare), in which case only the config can be reused.
+class CompiledConfig():
+    config: dict[str, Any]
+    args: Optional[list[str]]
+
+    def __init__(self, config: dict[str, Any], args: Optional[list[str]] = None):
+        self.config = config
+        self.args = args
+
+
+# Self-contained compiled configs ("bundles") which can be run without any config lookup.
+bundle_format: str = "sandbox-manager-bundle"
+# Increment whenever the meaning of the stored args or config changes
+bundle_version: int = 2
+
+
+def write_bundle(path: str, compiled: CompiledConfig) -> None:
+    bundle = {
+        "format": bundle_format,
+        "version": bundle_version,
+        "config": compiled.config,
+        "args": compiled.args,
+    }
+    with open(path, "w") as file:
+        json.dump(bundle, file, separators=(",", ":"))
+
+
+def read_bundle(path: str) -> CompiledConfig:
+    with open(path, "r") as file:
+        try:
+            bundle = json.load(file)
+        except ValueError:
+            raise AttributeError(f"'{path}' is not a valid sandbox bundle.")
+
+    if not isinstance(bundle, dict) or bundle.get("format") != bundle_format:
+        raise AttributeError(f"'{path}' is not a valid sandbox bundle.")
+    if bundle.get("version") != bundle_version:
+        raise AttributeError(f"Sandbox bundle '{path}' has version {bundle.get('version')}, but only version {bundle_version} is supported. Compile it again with this version of run-sandbox.")
+
+    return CompiledConfig(bundle["config"], bundle["args"])
@@ -0,0 +1,192 @@
+import os
+import json
+import warnings
+from typing import Any, Optional
+from classes.cache import cache_path, digest, file_digest, write_atomic
+from classes.config_index import ConfigIndex
+from classes.config_loader import ConfigLoader, load_yaml
+
+
+# Resolves and validates every config file in a set of directories at once, on a pool of
+# worker processes. Each file is parsed once in total, and shared with every worker.
+#
+# Results are stored in the cache directory, keyed by the search paths. Later checks
+# only process configs whose inherit graph contains a file that has changed since then
+# (or which failed last time), and reuse the stored results for the rest.
+class ConfigChecker():
+    version: int = 1
+    index: ConfigIndex
+    # Number of worker processes, 1 checks everything in this process
+    jobs: int
+    # Whether to read and write stored results
+    use_state: bool
+    # Results of the last check, as {filename: result}, see check_config()
+    results: dict[str, dict[str, Any]]
+    # Names of the configs which were processed again by the last check
+    rechecked: list[str]
+    digests: dict[str, Optional[str]]
+
+    def __init__(self, index: ConfigIndex, jobs: Optional[int] = None, use_state: bool = True):
+        self.index = index
+        self.jobs = jobs if jobs else len(os.sched_getaffinity(0))
+        self.use_state = use_state
+        self.results = {}
+        self.rechecked = []
+        self.digests = {}
+
+    def state_path(self) -> str:
+        key = digest(json.dumps(self.index.search_paths).encode())
+        return cache_path("check", key[:32] + ".json")
+
+    # Returns the names of the config files to check, as {filename: path}.
+    # If directories are given, only configs inside them are included. Files which
+    # are hidden by a file with the same name in an earlier search path are skipped.
+    def find_configs(self, directories: Optional[list[str]] = None) -> dict[str, str]:
+        self.index.refresh()
+        configs = {}
+        for filename, path in sorted(self.index.names.items()):
+            if directories and not any(path.startswith(os.path.join(directory, "")) for directory in directories):
+                continue
+            configs[filename] = path
+        return configs
+
+    # Checks the given configs (see find_configs) and returns their results.
+    # If reuse is False, stored results are ignored and every config is checked again.
+    def check(self, configs: dict[str, str], reuse: bool = True) -> dict[str, dict[str, Any]]:
+        previous = self._read_state() if self.use_state and reuse else {}
+        self.results = {}
+        self.rechecked = []
+        self.digests = {}
+
+        for filename, path in configs.items():
+            result = previous.get(filename)
+            if result is not None and result["path"] == path and self._is_current(result):
+                self.results[filename] = result
+            else:
+                self.rechecked.append(filename)
+
+        # Parse every file needed by the configs being checked again up front, as far as
+        # it's known from the last check. Files inherited for the first time are parsed
+        # by the workers themselves.
+        needed = {filename: configs[filename] for filename in self.rechecked}
+        for filename in self.rechecked:
+            if filename in previous:
+                for inherited, (path, _) in previous[filename]["files"].items():
+                    needed.setdefault(inherited, path)
+
+        if self.jobs > 1 and len(self.rechecked) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            chunksize = max(1, len(needed) // (self.jobs * 4))
+            with ProcessPoolExecutor(self.jobs) as executor:
+                parsed_files = list(executor.map(parse_file, needed.values(), chunksize=chunksize))
+            parsed = {filename: result for filename, result in zip(needed, parsed_files) if result}
+
+            chunksize = max(1, len(self.rechecked) // (self.jobs * 4))
+            with ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(self.index.search_paths, parsed)) as executor:
+                results = list(executor.map(_check_in_worker, self.rechecked, chunksize=chunksize))
+        else:
+            loader = ConfigLoader(self.index.search_paths, self.index)
+            results = [check_config(loader, filename) for filename in self.rechecked]
+
+        for filename, result in zip(self.rechecked, results):
+            result["path"] = configs[filename]
+            self.results[filename] = result
+
+        self.results = dict(sorted(self.results.items()))
+        if self.use_state:
+            self._write_state(previous)
+        return self.results
+
+    # A stored result can be reused if it succeeded, and every file it was built from
+    # still resolves to the same path and has the same contents
+    def _is_current(self, result: dict[str, Any]) -> bool:
+        if result["error"] is not None:
+            return False
+        for filename, (path, file_hash) in result["files"].items():
+            if self.index.find(filename) != path:
+                return False
+            if path not in self.digests:
+                self.digests[path] = file_digest(path)
+            if self.digests[path] != file_hash:
+                return False
+        return True
+
+    def _read_state(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.state_path(), "r") as file:
+                state = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(state, dict) or state.get("version") != self.version or state.get("search_paths") != self.index.search_paths:
+            return {}
+        return state.get("configs", {})
+
+    # Results of configs which weren't part of this check are kept, unless they were deleted
+    def _write_state(self, previous: dict[str, dict[str, Any]]) -> None:
+        configs = {filename: result for filename, result in previous.items() if os.path.exists(result["path"])}
+        state = {
+            "version": self.version,
+            "search_paths": self.index.search_paths,
+            "configs": configs | self.results,
+        }
+        write_atomic(self.state_path(), json.dumps(state, separators=(",", ":")).encode())
+
+
+# Returns [path, digest, config] for a config file, or None if it can't be parsed.
+# Errors are reported when the file is parsed again by the config that uses it.
+def parse_file(path: str) -> Optional[list[Any]]:
+    try:
+        with open(path, "rb") as file:
+            data = file.read()
+        config = load_yaml(data)
+    except Exception:
+        return None
+    if not isinstance(config, dict):
+        return None
+    return [path, digest(data), config]
+
+
+# Resolves a config file with the given loader and checks that every category in it is valid.
+# Returns a result of the form:
+#   config    the flattened config, or None if it's invalid
+#   files     the files it was built from, as {filename: [path, digest]}
+#   error     the error message if it's invalid, otherwise None
+#   warnings  any warnings about the configs it inherits directly
+def check_config(loader: ConfigLoader, filename: str) -> dict[str, Any]:
+    from classes.config_parser import ConfigParser
+    config_name = os.path.splitext(filename)[0]
+    result = {"config": None, "files": {}, "error": None, "warnings": []}
+    # It may have been resolved already while checking another config, in which case
+    # the warnings about its inherits would go missing
+    loader.resolved.pop(config_name, None)
+
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        try:
+            config = loader.load(config_name)
+            # 'name' and 'run' are handled by Sandbox, and are optional in configs which are only inherited
+            categories = {key: value for key, value in config.items() if key not in ["name", "run"]}
+            ConfigParser(categories)
+            result["config"] = config
+        except Exception as error:
+            result["error"] = str(error)
+    result["files"] = loader.loaded_files
+    result["warnings"] = [str(warning.message) for warning in caught]
+
+    return result
+
+
+# Each worker process keeps one loader, so that configs inherited by several of the
+# configs it checks are only resolved once
+_worker_loader: Optional[ConfigLoader] = None
+
+
+def _init_worker(search_paths: list[str], parsed: dict[str, list[Any]]) -> None:
+    global _worker_loader
+    # The parent process has just refreshed the index cache, so this only revalidates it
+    _worker_loader = ConfigLoader(search_paths, ConfigIndex(search_paths), parsed)
+
+
+def _check_in_worker(filename: str) -> dict[str, Any]:
+    return check_config(_worker_loader, filename)
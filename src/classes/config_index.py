@@ -0,0 +1,154 @@
+import os
+import json
+import time
+from hashlib import sha256
+from typing import Any, Optional
+from classes.cache import cache_path, write_atomic
+from classes import tracing
+
+
+# Maps config file names to their paths within a set of search paths.
+# Equivalent to walking every search path with os.walk and taking the first match,
+# but the directory tree is persisted to a cache file and only directories whose
+# mtime has changed since the last run are rescanned.
+class ConfigIndex():
+    version: int = 1
+    # Only files with this extension are indexed, other lookups fall back to a walk
+    extension: str = ".yaml"
+    # Directories modified this recently may still be changing within the
+    # filesystem's timestamp granularity, so they are always rescanned next time.
+    mtime_slack: float = 2.0
+
+    search_paths: list[str]
+    cache_file: Optional[str]
+    directories: dict[str, dict[str, Any]]
+    names: dict[str, str]
+    loaded: bool
+    changed: bool
+
+    def __init__(self, search_paths: list[str], cache_file: Optional[str] = ""):
+        self.search_paths = search_paths
+        # An empty string selects the default cache file, None disables persistence
+        if cache_file == "":
+            cache_file = self.default_cache_file(search_paths)
+        self.cache_file = cache_file
+        self.directories = {}
+        self.names = {}
+        self.loaded = False
+        self.changed = False
+
+    @staticmethod
+    def default_cache_file(search_paths: list[str]) -> str:
+        key = sha256("\0".join(os.path.abspath(path) for path in search_paths).encode()).hexdigest()
+        return cache_path("index", key[:32] + ".json")
+
+    def find(self, filename: str) -> Optional[str]:
+        if not filename.endswith(self.extension):
+            return self._walk_find(filename)
+
+        if not self.loaded:
+            self.refresh()
+        return self.names.get(filename)
+
+    # Revalidates the index against the filesystem. Called automatically on the first lookup,
+    # long-running processes should call it again whenever the config files may have changed.
+    def refresh(self) -> None:
+        with tracing.span("refresh config index"):
+            self._refresh()
+
+    def _refresh(self) -> None:
+        if not self.loaded:
+            self.directories = self._read_cache()
+
+        old_directories = self.directories
+        self.directories = {}
+        self.names = {}
+        self.changed = False
+        scan_time = time.time()
+
+        for path in self.search_paths:
+            self._update(path, old_directories, scan_time)
+
+        if self.changed or len(self.directories) != len(old_directories):
+            self._write_cache()
+        self.loaded = True
+
+    # Visits directories in the same (top-down) order as os.walk, so the first
+    # directory to register a name is the one os.walk would have found first.
+    def _update(self, directory: str, old_directories: dict[str, dict[str, Any]], scan_time: float) -> None:
+        # os.walk can visit the same directory twice if search paths overlap
+        if directory in self.directories:
+            record = self.directories[directory]
+        else:
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                return
+
+            record = old_directories.get(directory)
+            if record is None or record["mtime"] != mtime:
+                record = self._scan_directory(directory, mtime, scan_time)
+                self.changed = True
+            self.directories[directory] = record
+
+        for file in record["files"]:
+            self.names.setdefault(file, os.path.join(directory, file))
+        for subdirectory in record["subdirs"]:
+            self._update(os.path.join(directory, subdirectory), old_directories, scan_time)
+
+    def _scan_directory(self, directory: str, mtime: int, scan_time: float) -> dict[str, Any]:
+        files = []
+        subdirs = []
+
+        if scan_time - mtime / 1e9 < self.mtime_slack:
+            mtime = None
+
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Mirror os.walk: symlinks to directories are not followed
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if not entry.is_symlink():
+                            subdirs.append(entry.name)
+                    elif entry.name.endswith(self.extension):
+                        files.append(entry.name)
+        except OSError:
+            mtime = None
+
+        return {"mtime": mtime, "files": files, "subdirs": subdirs}
+
+    def _walk_find(self, filename: str) -> Optional[str]:
+        for path in self.search_paths:
+            for directory,_,file_list in os.walk(path):
+                if filename in file_list:
+                    return os.path.join(directory, filename)
+        return None
+
+    def _read_cache(self) -> dict[str, dict[str, Any]]:
+        if not self.cache_file:
+            return {}
+
+        try:
+            with open(self.cache_file, "r") as file:
+                cache = json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+        if not isinstance(cache, dict) or cache.get("version") != self.version or cache.get("search_paths") != self.search_paths:
+            return {}
+        return cache.get("directories", {})
+
+    def _write_cache(self) -> None:
+        if not self.cache_file:
+            return
+
+        cache = {
+            "version": self.version,
+            "search_paths": self.search_paths,
+            "directories": self.directories,
+        }
+        write_atomic(self.cache_file, json.dumps(cache, separators=(",", ":")).encode())
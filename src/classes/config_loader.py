@@ -1,58 +1,124 @@
 import warnings
-from typing import Any
-from os import walk
-from os.path import join as pathjoin
-from yaml import safe_load
+from copy import deepcopy
+from typing import Any, Optional
 from classes.merger import simple_merge
+from classes.config_index import ConfigIndex
+from classes.cache import digest
+from classes import tracing
+
+
+# PyYAML is only imported when a config file actually has to be parsed,
+# and its C implementation (libyaml) is used if it's available.
+def load_yaml(data: bytes) -> Any:
+    import yaml
+    return yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
 
 
 class ConfigLoader():
     search_paths: list[str]
     config: dict[str, Any]
+    index: ConfigIndex
+    # Every file the last loaded config was built from, as {filename: [path, digest]}.
+    # Covers the whole inherit graph.
+    loaded_files: dict[str, list[str]]
+    # Configs which have already been resolved, so that each file in the inherit graph
+    # is only parsed and merged once, even if it is inherited from several places.
+    # Kept for the lifetime of the loader, so create a new one to pick up changed files.
+    resolved: dict[str, dict[str, Any]]
+    # The files each resolved config was built from, in the same format as loaded_files
+    resolved_files: dict[str, dict[str, list[str]]]
+    # Files which have already been parsed elsewhere (e.g. by another process),
+    # as {filename: [path, digest, config]}. Only used if the path still matches.
+    parsed: dict[str, list[Any]]
 
-    def __init__(self, search_paths: list[str]):
+    # The index can be shared between loaders with the same search paths
+    def __init__(self, search_paths: list[str], index: Optional[ConfigIndex] = None, parsed: Optional[dict[str, list[Any]]] = None):
         self.search_paths = search_paths
         self.config = {}
-    
+        self.index = index if index else ConfigIndex(search_paths)
+        self.loaded_files = {}
+        self.resolved = {}
+        self.resolved_files = {}
+        self.parsed = parsed if parsed else {}
+
+    # Can be called several times with different configs, sharing already resolved files
     def load(self, config_name: str) -> dict[str, Any]:
-        config_file = self.find_file(config_name + ".yaml")
-        with open(config_file, "r") as file:
-            config: dict[str, Any] = safe_load(file)
-        
+        self.loaded_files = {}
+        self.config = self.resolve(config_name, [])
+        return self.config
+
+    # Returns a new copy of the config with its inherits merged in.
+    # 'chain' holds the configs currently being resolved, for cycle detection.
+    def resolve(self, config_name: str, chain: list[str]) -> dict[str, Any]:
+        if config_name in chain:
+            cycle = " -> ".join(chain[chain.index(config_name):] + [config_name])
+            raise RuntimeError(f"Config '{config_name}' inherits from itself: {cycle}")
+
+        if config_name not in self.resolved:
+            # Collect the files read for this config separately from its parents'
+            parent_files = self.loaded_files
+            self.loaded_files = {}
+            try:
+                self.resolved[config_name] = self._resolve_uncached(config_name, chain + [config_name])
+                self.resolved_files[config_name] = self.loaded_files
+            finally:
+                self.loaded_files = parent_files
+        self.loaded_files.update(self.resolved_files.get(config_name, {}))
+        # Merging modifies configs in place, so never hand out the cached copy
+        return deepcopy(self.resolved[config_name])
+
+    def _resolve_uncached(self, config_name: str, chain: list[str]) -> dict[str, Any]:
+        config = self.parse(config_name)
+
         config_inherits = config.pop("inherit", None)
         if not config_inherits:
-            self.config = config
             return config
-        
-        inherit_loader = ConfigLoader(self.search_paths)
+        if not isinstance(config_inherits, list):
+            raise AttributeError(f"'inherit' in config '{config_name}' should be a list.")
 
         inherited_configs: list[dict[str, Any]] = []
         for inherited_name in config_inherits:
-            inherit_loader.load(inherited_name)
-            inherited_config = inherit_loader.config
-            
+            inherited_config = self.resolve(inherited_name, chain)
+
             # Remove name and run statements
             inherited_config.pop("name", None)
             if inherited_config.pop("run", None):
                 warnings.warn(f"Inherited config '{inherited_name}' includes a run statement. It will be ignored. If you wanted to run it, start a seperate sandbox.", RuntimeWarning)
-            
+
             inherited_configs.append(inherited_config)
-            inherit_loader.config = {}
-        
-        self.config = inherited_configs[0]
-        # If there's only one inherit then the list will be empty
-        for other_config in inherited_configs[1:]:
-            # First arg becomes returned value after merge
-            simple_merge(self.config, other_config)
-        
-        return simple_merge(self.config, config)
-        
-        
+
+        with tracing.span(f"merge {config_name}"):
+            merged_config = inherited_configs[0]
+            # If there's only one inherit then the list will be empty
+            for other_config in inherited_configs[1:]:
+                # First arg becomes returned value after merge
+                simple_merge(merged_config, other_config)
+
+            return simple_merge(merged_config, config)
+
+    def parse(self, config_name: str) -> dict[str, Any]:
+        filename = config_name + ".yaml"
+        with tracing.span(f"find {filename}"):
+            config_file = self.find_file(filename)
+
+        if filename in self.parsed and self.parsed[filename][0] == config_file:
+            _, file_hash, config = self.parsed[filename]
+            self.loaded_files[filename] = [config_file, file_hash]
+            # Resolving modifies the config, so keep the shared copy intact
+            return deepcopy(config)
+
+        with tracing.span(f"parse {filename}"):
+            with open(config_file, "rb") as file:
+                data = file.read()
+            self.loaded_files[filename] = [config_file, digest(data)]
+
+            config = load_yaml(data)
+        if not isinstance(config, dict):
+            raise AttributeError(f"Config file '{config_file}' has an invalid structure.")
+        return config
+
     def find_file(self, filename: str) -> str:
-        for path in self.search_paths:
-            generator = walk(path)
-            for directory,_,file_list in generator:
-                for file in file_list:
-                    if file == filename:
-                        return pathjoin(directory, file)
+        path = self.index.find(filename)
+        if path:
+            return path
         raise FileNotFoundError(f"Could not find config file '{filename}'")
@@ -1,9 +1,16 @@
 from typing import Any, Callable
+from collections.abc import Iterator, Mapping
 from classes.category_handlers import CategoryBase, category_handlers
+from classes.prepare_scheduler import PrepareStep, run_steps
+from classes import tracing
 
 class ConfigParser():
     args: list[str]
     handlers: list[CategoryBase]
+    # The category name of each handler
+    categories: list[str]
+    # The steps run by the last call to prepare(), with their timings
+    steps: list[PrepareStep]
 
     def __init__(self, config: dict[str, Any]):
         if not isinstance(config, dict):
@@ -11,30 +18,65 @@ class ConfigParser():
 
         self.args = []
         self.handlers = []
+        self.categories = []
+        self.steps = []
 
         # Add config handlers and instantiate with configs
         for category, settings in config.items():
             if category not in category_handlers:
                 raise AttributeError(f"'{category}' is not a valid configuration category.")
-            self.handlers.append(category_handlers[category](settings))
+            with tracing.span(f"create handler {category}"):
+                self.handlers.append(category_handlers[category](settings))
+            self.categories.append(category)
         
-        # Add default args
-        for handler in category_handlers.values():
-            if type(handler) not in self.handlers:
+        # Add default args of the categories missing from the config
+        used_handlers = [type(handler) for handler in self.handlers]
+        for handler in category_handlers.with_default_args():
+            if handler not in used_handlers:
                 self.args += handler.default_args()
     
-    def prepare(self) -> list[Callable]:
-        callbacks = []
+    # Runs the handlers' prepare steps concurrently (see run_steps) and returns their termination
+    # callbacks. 'env' is the environment of the sandbox being launched.
+    def prepare(self, env: Mapping[str, str]) -> list[Callable]:
+        self.steps = []
+        for category, handler in zip(self.categories, self.handlers):
+            handler.set_env(env)
+            self.steps += handler.prepare_steps(category)
 
+        return run_steps(self.steps)
+
+    # Returns the commands to run bwrap through, from every handler (see CategoryBase.command_prefix)
+    def command_prefix(self) -> list[str]:
+        prefix = []
         for handler in self.handlers:
-            callback = handler.prepare()
-            if callback:
-                callbacks += callback
-        
-        return callbacks
+            prefix += handler.command_prefix()
+        return prefix
 
-    def to_args(self) -> list[str]:
+    # Returns the stdio file descriptors for bwrap from every handler (see CategoryBase.stdio)
+    def stdio(self) -> dict[str, int]:
+        stdio = {}
+        for handler in self.handlers:
+            stdio.update(handler.stdio())
+        return stdio
+
+    def started(self) -> None:
         for handler in self.handlers:
-            self.args += handler.to_args()
+            handler.started()
+
+    def needs_prepare(self) -> bool:
+        return any(handler.needs_prepare() for handler in self.handlers)
+
+    # Yields the args of each handler in turn
+    def iter_args(self) -> Iterator[list[str]]:
+        yield self.args
+        for category, handler in zip(self.categories, self.handlers):
+            with tracing.span(f"args {category}"):
+                args = handler.to_args()
+            yield args
+
+    def to_args(self) -> list[str]:
+        args = []
+        for handler_args in self.iter_args():
+            args += handler_args
         
-        return self.args
\ No newline at end of file
+        return args
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import signal
+import socket
+import struct
+from typing import Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from selectors import BaseSelector
+    from classes.sandbox import Sandbox
+    from classes.config_index import ConfigIndex
+    from classes.sandbox_pool import SandboxPool
+    from classes.usage_metrics import UsageMetrics
+
+# Messages between run-sandbox-client and the daemon are JSON objects, prefixed with their
+# length as a 4 byte unsigned integer. File descriptors are sent along with the first part
+# of a message.
+#
+# The client sends one request:
+#   {"config": name, "args": [...], "run": executable or null, "env": {...}, "cwd": path}
+# along with its stdin, stdout and stderr. The daemon replies with either
+# {"error": message} or, once the sandbox has exited, {"exit": exit code}.
+# If the client disconnects first, the sandbox is terminated. While the sandbox runs, the client
+# passes on the signals it gets from its terminal (see relayed_signals) as {"signal": number},
+# which are sent to the sandbox's process group.
+# A request of {"stats": true}, without file descriptors, is answered with the statistics
+# of each pool: {"stats": {config name: {...}}} (see SandboxPool.stats).
+
+_header = struct.Struct("!I")
+# Largest message accepted, which mostly consists of the client's environment
+max_message_size: int = 16 * 1024 * 1024
+# Signals which the client's terminal sends to it rather than to the sandbox, since the
+# terminal can't also be the sandbox's controlling terminal (it already is the client's)
+relayed_signals: list[int] = [signal.SIGINT, signal.SIGQUIT, signal.SIGWINCH]
+
+
+def socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        raise RuntimeError("XDG_RUNTIME_DIR needs to be set to use the sandbox-manager daemon.")
+    return os.path.join(runtime_dir, "sandbox-manager", "daemon.sock")
+
+
+def send_message(sock: socket.socket, message: dict[str, Any], fds: list[int] = []) -> None:
+    data = json.dumps(message, separators=(",", ":")).encode()
+    data = _header.pack(len(data)) + data
+    if fds:
+        sent = socket.send_fds(sock, [data], fds)
+        data = data[sent:]
+    # The other end may already have replied and closed the connection
+    if data:
+        sock.sendall(data)
+
+
+# Returns the message and any file descriptors received with it.
+# Raises EOFError if the connection is closed before a whole message was received.
+def recv_message(sock: socket.socket, max_fds: int = 0) -> tuple[dict[str, Any], list[int]]:
+    data = b""
+    fds = []
+    while len(data) < _header.size or len(data) < _header.size + _header.unpack_from(data)[0]:
+        if len(data) >= _header.size and _header.unpack_from(data)[0] > max_message_size:
+            raise RuntimeError("Message is too large.")
+        if max_fds and not fds:
+            chunk, new_fds, _, _ = socket.recv_fds(sock, 65536, max_fds)
+            fds += new_fds
+        else:
+            chunk = sock.recv(65536)
+        if not chunk:
+            for fd in fds:
+                os.close(fd)
+            raise EOFError("Connection closed before a whole message was received.")
+        data += chunk
+
+    message = json.loads(data[_header.size:])
+    if not isinstance(message, dict):
+        raise RuntimeError("Invalid message.")
+    return message, fds
+
+
+# Reads a message the client sent while its sandbox runs. Returns the signal to pass on to
+# the sandbox (0 if there is none), or None if the client has disconnected.
+def recv_signal(sock: socket.socket) -> Optional[int]:
+    try:
+        message, _ = recv_message(sock)
+    except (OSError, EOFError, RuntimeError, ValueError):
+        return None
+    signum = message.get("signal")
+    return signum if signum in relayed_signals else 0
+
+
+# Keeps resolved configs and their handlers in memory, and launches sandboxes for clients.
+# Each launch happens in a forked child, so that it gets the client's environment, working
+# directory and stdio without affecting the daemon or other launches. Cached sandboxes are
+# only used if every file they were built from still resolves to the same path and has
+# the same contents.
+class SandboxDaemon():
+    search_paths: list[str]
+    index: "ConfigIndex"
+    path: str
+    # Resolved configs, as {name: (sandbox, {filename: [path, digest]})}
+    sandboxes: dict[str, tuple["Sandbox", dict[str, list[str]]]]
+    # Pools of sandboxes which have already been set up, by config name
+    pools: dict[str, "SandboxPool"]
+    selector: Optional["BaseSelector"]
+    verbose: bool
+    # Where launches record what they consumed (see UsageMetrics)
+    metrics: Optional["UsageMetrics"]
+
+    def __init__(self, search_paths: list[str], path: Optional[str] = None, verbose: bool = False, metrics: Optional["UsageMetrics"] = None):
+        from classes.config_index import ConfigIndex
+        self.search_paths = search_paths
+        self.index = ConfigIndex(search_paths)
+        self.path = path if path else socket_path()
+        self.sandboxes = {}
+        self.pools = {}
+        self.selector = None
+        self.verbose = verbose
+        self.metrics = metrics
+
+    # Keeps 'size' sandboxes of the config set up and waiting for commands (see SandboxPool)
+    def add_pool(self, config_name: str, size: int, max_age: Optional[float] = None, max_uses: int = 1) -> None:
+        from classes.sandbox_pool import SandboxPool
+        self.pools[config_name] = SandboxPool(config_name, size, max_age, max_uses, log=self._log)
+
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message, file=sys.stderr)
+
+    # Returns a sandbox for the config, resolving it again if any of its files have changed
+    def get_sandbox(self, config_name: str) -> "Sandbox":
+        from classes.cache import file_digest
+        from classes.config_loader import ConfigLoader
+        from classes.sandbox import Sandbox
+
+        self.index.refresh()
+        if config_name in self.sandboxes:
+            sandbox, files = self.sandboxes[config_name]
+            if all(self.index.find(filename) == path and file_digest(path) == file_hash for filename, (path, file_hash) in files.items()):
+                return sandbox
+            self._log(f"Config '{config_name}' has changed, resolving it again.")
+
+        config_loader = ConfigLoader(self.search_paths, self.index)
+        config = config_loader.load(config_name)
+        sandbox = Sandbox(config)
+        sandbox.metrics = self.metrics
+        self.sandboxes[config_name] = (sandbox, config_loader.loaded_files)
+        return sandbox
+
+    def _bind(self) -> socket.socket:
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+        except OSError:
+            # Replace the socket if it was left behind by a daemon that has exited
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except OSError:
+                os.remove(self.path)
+                server.bind(self.path)
+            else:
+                raise RuntimeError(f"A sandbox-manager daemon is already listening on '{self.path}'.")
+            finally:
+                probe.close()
+        os.chmod(self.path, 0o600)
+        server.listen()
+        return server
+
+    def serve(self) -> None:
+        import selectors
+        server = self._bind()
+        # Exit cleanly (removing the socket) when terminated
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        # Each registered file is paired with the function to call when it's ready
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(server, selectors.EVENT_READ, lambda: self._accept(server))
+        self._log(f"Listening on '{self.path}'.")
+
+        try:
+            for name, pool in self.pools.items():
+                pool.start(self.get_sandbox(name), self.selector)
+            while True:
+                timeout = min((expiry for pool in self.pools.values() if (expiry := pool.next_expiry()) is not None), default=None)
+                for key, _ in self.selector.select(timeout):
+                    # Earlier callbacks can unregister files which were also ready
+                    if self.selector.get_map().get(key.fd) is key:
+                        key.data()
+                for pool in self.pools.values():
+                    pool.expire()
+        finally:
+            for name, pool in self.pools.items():
+                pool.close()
+                self._log(f"Pool for '{name}': {json.dumps(pool.stats())}")
+            self.selector.close()
+            server.close()
+            os.remove(self.path)
+
+    # Handles a new connection, by launching a sandbox for it in a forked child or
+    # running its command in a sandbox from a pool
+    def _accept(self, server: socket.socket) -> None:
+        connection, _ = server.accept()
+        fds = []
+        try:
+            # Only accept requests from the user running the daemon
+            credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+            _, uid, _ = struct.unpack("3i", credentials)
+            if uid != os.getuid():
+                raise RuntimeError("Connection from another user refused.")
+
+            connection.settimeout(5)
+            request, fds = recv_message(connection, max_fds=3)
+            connection.settimeout(None)
+            if request.get("stats"):
+                send_message(connection, {"stats": {name: pool.stats() for name, pool in self.pools.items()}})
+                connection.close()
+                return
+            if len(fds) != 3:
+                raise RuntimeError("The client should send its stdin, stdout and stderr.")
+
+            sandbox = self.get_sandbox(request["config"])
+            pool = self.pools.get(request["config"])
+            if pool:
+                pool.set_sandbox(sandbox)
+                if pool.dispatch(connection, request, fds):
+                    self._log(f"Ran '{request['config']}' in a pooled sandbox.")
+                    return
+                self._log(f"No pooled sandbox of '{request['config']}' was ready.")
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                self._launch(sandbox, request, fds)
+            self._log(f"Launched '{request['config']}' as process {pid}.")
+            self._watch_launch(pid, connection)
+        except Exception as error:
+            self._log(f"Request failed: {error}")
+            try:
+                send_message(connection, {"error": str(error)})
+            except OSError:
+                pass
+            connection.close()
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    # Sends the exit code of a launch to its client, passes on the client's signals, and
+    # terminates the launch if the client disconnects
+    def _watch_launch(self, pid: int, connection: socket.socket) -> None:
+        import selectors
+        pidfd = os.pidfd_open(pid)
+
+        def client_message() -> None:
+            signum = recv_signal(connection)
+            if signum is None:
+                self._log(f"Client of process {pid} disconnected, terminating it.")
+                os.kill(pid, signal.SIGTERM)
+                self.selector.unregister(connection)
+            elif signum:
+                # The launch is the leader of its process group, which bwrap is also in
+                try:
+                    os.killpg(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+        def exited() -> None:
+            _, status = os.waitpid(pid, 0)
+            exit_code = os.waitstatus_to_exitcode(status)
+            # Report signals in the same way as a shell
+            if exit_code < 0:
+                exit_code = 128 - exit_code
+            try:
+                send_message(connection, {"exit": exit_code})
+            except OSError:
+                pass
+            self.selector.unregister(pidfd)
+            if connection in [key.fileobj for key in self.selector.get_map().values()]:
+                self.selector.unregister(connection)
+            os.close(pidfd)
+            connection.close()
+
+        self.selector.register(pidfd, selectors.EVENT_READ, exited)
+        self.selector.register(connection, selectors.EVENT_READ, client_message)
+
+    # Runs in the forked child, and never returns
+    @staticmethod
+    def _launch(sandbox: "Sandbox", request: dict[str, Any], fds: list[int]) -> None:
+        import atexit
+        exit_code = 1
+        try:
+            os.setsid()
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            # The client passes these on, so they shouldn't stay ignored if the daemon was
+            # started with them ignored (e.g. in the background)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            # Only possible if the terminal isn't the controlling terminal of another session,
+            # which it usually is (the client's). Otherwise the client relays its signals.
+            if os.isatty(0):
+                import fcntl
+                import termios
+                try:
+                    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+                except OSError:
+                    pass
+
+            # Also replaced in os.environ, for anything that doesn't use the sandbox's environment
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            # The sandbox's environment is a copy of the daemon's
+            sandbox.env = dict(request["env"])
+            if sandbox.app_name:
+                sandbox._set_app_name(sandbox.app_name)
+
+            sandbox.extra_args = request["args"]
+            if request.get("run"):
+                sandbox.executable = request["run"]
+            # Nothing is left to do after bwrap exits, unless there are termination callbacks
+            # or its usage is recorded
+            sandbox.use_exec = True
+
+            process = sandbox.run()
+            exit_code = process.returncode
+            if exit_code < 0:
+                exit_code = 128 - exit_code
+        except KeyboardInterrupt:
+            exit_code = 130
+        except BaseException as error:
+            print(f"run-sandbox: {error}", file=sys.stderr)
+        finally:
+            # Terminates bwrap and removes created files if the launch was interrupted
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
@@ -0,0 +1,145 @@
+import os
+import sys
+import fcntl
+import signal
+from collections.abc import Callable
+from typing import Optional
+
+
+# Shares one xdg-dbus-proxy between every sandbox with the same D-Bus policy,
+# including sandboxes started by other run-sandbox processes.
+#
+# Each proxy is identified by a key (a hash of its policy) and uses these files in 'directory':
+#   <key>.sock   the proxy's socket
+#   <key>.pid    the process ID of the proxy's bwrap process
+#   <key>.lock   locked exclusively while a proxy is being started or stopped
+#   <key>.users  every sandbox using the proxy holds a shared lock on this file
+# Locks are released by the kernel if a process dies, so the last user to exit
+# (gracefully or not) can always tell that it was the last one. A user which is killed
+# can't stop the proxy itself though, so each proxy also has a supervisor process (this
+# file run as a script, see supervise()), which stops it once it has no users left.
+class DbusProxyBroker():
+    directory: str
+    key: str
+    users_fd: int
+
+    def __init__(self, directory: str, key: str):
+        self.directory = directory
+        self.key = key
+        self.users_fd = -1
+
+    def _path(self, extension: str) -> str:
+        return os.path.join(self.directory, self.key + extension)
+
+    @property
+    def socket_path(self) -> str:
+        return self._path(".sock")
+
+    # Registers a new user of the proxy, starting it if it isn't already running.
+    # start_proxy must start the proxy, wait for it to open its socket and return its PID.
+    # The proxy has to be in its own process group, which is terminated by release().
+    def acquire(self, start_proxy: Callable[[], int]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        lock_fd = self._lock()
+        try:
+            if not os.path.exists(self.socket_path) or self._proxy_pid() is None:
+                self._stop_proxy()
+                pid = start_proxy()
+                with open(self._path(".pid"), "w") as file:
+                    file.write(str(pid))
+                self._start_supervisor(pid)
+
+            self.users_fd = os.open(self._path(".users"), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+            fcntl.flock(self.users_fd, fcntl.LOCK_SH)
+        finally:
+            os.close(lock_fd)
+
+    # Unregisters this user, and stops the proxy if there are no users left.
+    def release(self) -> None:
+        if self.users_fd < 0:
+            return
+
+        lock_fd = self._lock()
+        try:
+            fcntl.flock(self.users_fd, fcntl.LOCK_UN)
+            try:
+                # Only succeeds if nobody else holds a shared lock
+                fcntl.flock(self.users_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            self._stop_proxy()
+        finally:
+            os.close(self.users_fd)
+            self.users_fd = -1
+            os.close(lock_fd)
+
+    # Starts the supervisor of the proxy (see supervise()), detached from this process
+    def _start_supervisor(self, pid: int) -> None:
+        from subprocess import Popen, DEVNULL
+        Popen([sys.executable, "-I", os.path.abspath(__file__), self.directory, self.key, str(pid)],
+              stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+
+    def _lock(self, blocking: bool = True) -> int:
+        lock_fd = os.open(self._path(".lock"), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(lock_fd)
+            raise
+        return lock_fd
+
+    # Returns the PID of the proxy's bwrap process if it's still running, otherwise None
+    def _proxy_pid(self) -> Optional[int]:
+        try:
+            with open(self._path(".pid"), "r") as file:
+                pid = int(file.read())
+            # Guard against the PID having been reused by an unrelated process
+            with open(f"/proc/{pid}/cmdline", "rb") as file:
+                if b"xdg-dbus-proxy" not in file.read():
+                    return None
+        except (OSError, ValueError):
+            return None
+        return pid
+
+    def _stop_proxy(self) -> None:
+        pid = self._proxy_pid()
+        if pid is not None:
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for extension in [".sock", ".pid"]:
+            try:
+                os.remove(self._path(extension))
+            except FileNotFoundError:
+                pass
+
+
+# Waits until the proxy has no users left, then stops it, unless it has been stopped or
+# replaced in the meantime. Runs in its own process, which only needs the standard library.
+def supervise(directory: str, key: str, pid: int) -> None:
+    broker = DbusProxyBroker(directory, key)
+    users_fd = os.open(broker._path(".users"), os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    while True:
+        fcntl.flock(users_fd, fcntl.LOCK_EX)
+        try:
+            lock_fd = broker._lock(blocking=False)
+        except BlockingIOError:
+            # A user is being added or removed, which needs a shared lock on the users file
+            # while holding the lock file, so waiting for it here would deadlock
+            fcntl.flock(users_fd, fcntl.LOCK_UN)
+            os.close(broker._lock())
+            continue
+
+        try:
+            if broker._proxy_pid() == pid:
+                broker._stop_proxy()
+            return
+        finally:
+            os.close(lock_fd)
+
+
+if __name__ == "__main__":
+    supervise(sys.argv[1], sys.argv[2], int(sys.argv[3]))
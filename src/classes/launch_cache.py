@@ -0,0 +1,55 @@
+import json
+from typing import Optional
+from classes.cache import cache_path, digest, file_digest, write_atomic
+from classes.config_index import ConfigIndex
+from classes.compiled_config import CompiledConfig
+
+
+# Content-addressed cache of compiled configs, keyed by the config name and search paths.
+# An entry is only used if every file in its inherit graph still resolves to the
+# same path and has the same contents as when the entry was stored.
+class LaunchCache():
+    version: int = 2
+    index: ConfigIndex
+    hit: Optional[bool]
+
+    def __init__(self, index: ConfigIndex):
+        self.index = index
+        # None until lookup() is called
+        self.hit = None
+
+    def entry_path(self, config_name: str) -> str:
+        key = digest(json.dumps([config_name, self.index.search_paths]).encode())
+        return cache_path("launch", key[:32] + ".json")
+
+    def lookup(self, config_name: str) -> Optional[CompiledConfig]:
+        self.hit = False
+        try:
+            with open(self.entry_path(config_name), "r") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if not isinstance(entry, dict) or entry.get("version") != self.version:
+            return None
+        if entry.get("name") != config_name or entry.get("search_paths") != self.index.search_paths:
+            return None
+
+        for filename, (path, file_hash) in entry["files"].items():
+            if self.index.find(filename) != path or file_digest(path) != file_hash:
+                return None
+
+        self.hit = True
+        return CompiledConfig(entry["config"], entry["args"])
+
+    # loaded_files is ConfigLoader.loaded_files after loading config_name
+    def store(self, config_name: str, loaded_files: dict[str, list[str]], compiled: CompiledConfig) -> None:
+        entry = {
+            "version": self.version,
+            "name": config_name,
+            "search_paths": self.index.search_paths,
+            "files": loaded_files,
+            "config": compiled.config,
+            "args": compiled.args,
+        }
+        write_atomic(self.entry_path(config_name), json.dumps(entry, separators=(",", ":")).encode())
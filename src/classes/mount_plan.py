@@ -0,0 +1,260 @@
+import os
+from typing import Optional
+
+# Removes mounts from a list of (expanded) bwrap options which don't change the result:
+#   - binds with '-try' whose source doesn't exist, which bwrap would skip anyway
+#   - mounts that repeat one which is already in place at the same destination
+#   - binds of a path which is already visible at the destination, because an ancestor
+#     directory was bound from the same place in the same way
+# bwrap applies mounts in order, and a mount hides everything previously mounted at or
+# below its destination. So a mount is only removed if the mount that makes it redundant
+# is the latest one on the path to its destination, and nothing has been mounted at or
+# below its destination since.
+#
+# Whether a mount is redundant only depends on the options before it, so options are
+# optimized as they're generated (see feed()), without building the whole list first. Once
+# an option that isn't understood is found, it and everything after it are passed through
+# unchanged, since it might affect later mounts.
+
+# Mount options and the number of arguments they take.
+# The kind groups options which have the same effect when they succeed.
+_mount_options: dict[str, tuple[int, str]] = {
+    "--bind": (2, "bind"),
+    "--bind-try": (2, "bind"),
+    "--ro-bind": (2, "ro-bind"),
+    "--ro-bind-try": (2, "ro-bind"),
+    "--dev-bind": (2, "dev-bind"),
+    "--dev-bind-try": (2, "dev-bind"),
+    "--symlink": (2, "symlink"),
+    "--tmpfs": (1, "tmpfs"),
+    "--dev": (1, "dev"),
+    "--proc": (1, "proc"),
+    "--mqueue": (1, "mqueue"),
+    "--dir": (1, "dir"),
+    "--ro-bind-data": (2, "data"),
+    "--bind-data": (2, "data"),
+    "--file": (2, "data"),
+    "--overlay": (3, "overlay"),
+    "--tmp-overlay": (1, "overlay"),
+    "--ro-overlay": (1, "overlay"),
+    # Not mounts, but they change what's at their destination
+    "--remount-ro": (1, "remount"),
+    "--chmod": (2, "chmod"),
+}
+# Kinds which are never removed
+_unique_kinds = ["data", "dir", "overlay", "remount", "chmod"]
+_bind_kinds = ["bind", "ro-bind", "dev-bind"]
+
+# Other options and the number of arguments they take.
+# Any option not listed here disables the optimization, since it might affect mounts.
+_other_options: dict[str, int] = {
+    "--new-session": 0,
+    "--die-with-parent": 0,
+    "--clearenv": 0,
+    "--as-pid-1": 0,
+    "--share-net": 0,
+    "--unshare-all": 0,
+    "--unshare-user": 0,
+    "--unshare-user-try": 0,
+    "--unshare-ipc": 0,
+    "--unshare-pid": 0,
+    "--unshare-net": 0,
+    "--unshare-uts": 0,
+    "--unshare-cgroup": 0,
+    "--unshare-cgroup-try": 0,
+    # Lower layers of the next overlay
+    "--overlay-src": 1,
+    "--setenv": 2,
+    "--unsetenv": 1,
+    "--chdir": 1,
+    "--hostname": 1,
+    "--uid": 1,
+    "--gid": 1,
+    "--cap-add": 1,
+    "--cap-drop": 1,
+    "--seccomp": 1,
+    "--add-seccomp-fd": 1,
+    "--sync-fd": 1,
+    "--block-fd": 1,
+    "--info-fd": 1,
+    "--json-status-fd": 1,
+}
+
+
+# A mount in the plan. 'source' is the target of symlinks.
+class Mount():
+    sequence: int
+    kind: str
+    source: Optional[str]
+    destination: str
+    optional: bool
+
+    def __init__(self, sequence: int, kind: str, source: Optional[str], destination: str, optional: bool):
+        self.sequence = sequence
+        self.kind = kind
+        self.source = source
+        self.destination = destination
+        self.optional = optional
+
+
+# A directory in the sandbox's filesystem
+class _Node():
+    children: dict[str, "_Node"]
+    # The latest mount at exactly this path
+    mount: Optional[Mount]
+    # The sequence number of the latest mount at or below this path
+    latest: int
+
+    def __init__(self):
+        self.children = {}
+        self.mount = None
+        self.latest = -1
+
+
+class MountPlan():
+    # Results of looking up host paths, shared between calls to optimize()
+    exists_cache: dict[str, bool]
+    realpath_cache: dict[str, str]
+    # Number of mounts removed since start() was last called
+    removed: int
+    root: _Node
+    # Options whose arguments haven't all been fed yet
+    _pending: list[str]
+    # Set once an option that isn't understood has been found
+    _passthrough: bool
+    # Number of mounts fed, used as their sequence numbers
+    _sequence: int
+
+    def __init__(self):
+        self.exists_cache = {}
+        self.realpath_cache = {}
+        self.start()
+
+    def exists(self, path: str) -> bool:
+        if path not in self.exists_cache:
+            self.exists_cache[path] = os.path.exists(path)
+        return self.exists_cache[path]
+
+    def realpath(self, path: str) -> str:
+        if path not in self.realpath_cache:
+            self.realpath_cache[path] = os.path.realpath(path)
+        return self.realpath_cache[path]
+
+    # Starts a new list of options
+    def start(self) -> None:
+        self.removed = 0
+        self.root = _Node()
+        self._pending = []
+        self._passthrough = False
+        self._sequence = 0
+
+    # Returns the options with redundant mounts removed
+    def optimize(self, args: list[str]) -> list[str]:
+        self.start()
+        return self.feed(args) + self.finish()
+
+    # Takes the next options in the list, and returns those of them which should be kept.
+    # Options can be fed in pieces of any size; an option whose arguments are split between
+    # pieces is returned with the piece that completes it.
+    def feed(self, args: list[str]) -> list[str]:
+        if self._pending:
+            args = self._pending + args
+            self._pending = []
+        if self._passthrough:
+            return args
+
+        result = []
+        i = 0
+        while i < len(args):
+            option = args[i]
+            if option in _other_options:
+                count = _other_options[option]
+            elif option in _mount_options:
+                count = _mount_options[option][0]
+            else:
+                self._passthrough = True
+                return result + args[i:]
+            if i + count >= len(args):
+                self._pending = args[i:]
+                break
+
+            option_args = args[i + 1:i + count + 1]
+            i += count + 1
+            if option in _other_options:
+                result += [option] + option_args
+                continue
+            if not os.path.isabs(option_args[-1]):
+                self._passthrough = True
+                return result + [option] + option_args + args[i:]
+
+            self._sequence += 1
+            source = option_args[0] if count == 2 else None
+            mount = Mount(self._sequence, _mount_options[option][1], source, os.path.normpath(option_args[-1]), option.endswith("-try"))
+            if self._is_redundant(mount):
+                self.removed += 1
+                continue
+
+            self._add(mount)
+            result.append(option)
+            result += option_args
+
+        return result
+
+    # Returns what's left once every option has been fed: an option missing some of its
+    # arguments, which is passed on for bwrap to report
+    def finish(self) -> list[str]:
+        pending = self._pending
+        self._pending = []
+        return pending
+
+    def _path_nodes(self, destination: str, create: bool = False) -> list[_Node]:
+        nodes = [self.root]
+        for name in destination.split("/"):
+            if not name:
+                continue
+            node = nodes[-1].children.get(name)
+            if node is None:
+                if not create:
+                    break
+                node = nodes[-1].children[name] = _Node()
+            nodes.append(node)
+        return nodes
+
+    def _add(self, mount: Mount) -> None:
+        nodes = self._path_nodes(mount.destination, create=True)
+        nodes[-1].mount = mount
+        for node in nodes:
+            node.latest = mount.sequence
+
+    def _is_redundant(self, mount: Mount) -> bool:
+        if mount.kind in _bind_kinds and mount.optional and not self.exists(mount.source):
+            return True
+        if mount.kind in _unique_kinds:
+            return False
+
+        nodes = self._path_nodes(mount.destination)
+        # The latest mount on the path decides what's currently at the destination
+        mounts = [node.mount for node in nodes if node.mount]
+        if not mounts:
+            return False
+        covering = max(mounts, key=lambda other: other.sequence)
+        if covering.kind != mount.kind:
+            return False
+
+        reached = len(nodes) - 1 == len([name for name in mount.destination.split("/") if name])
+        # Something else has been mounted at or below the destination since
+        if reached and nodes[-1].latest > covering.sequence:
+            return False
+
+        if covering.destination == mount.destination:
+            return covering.source == mount.source
+
+        if mount.kind not in _bind_kinds:
+            return False
+        # A non-optional bind of a missing path is an error, which has to be kept
+        if not mount.optional and not self.exists(mount.source):
+            return False
+        # The source has to be at the same place relative to the ancestor's source,
+        # without any symlinks that lead elsewhere
+        relative = os.path.relpath(mount.destination, covering.destination)
+        return self.realpath(mount.source) == os.path.normpath(os.path.join(self.realpath(covering.source), relative))
@@ -0,0 +1,284 @@
+import os
+import time
+import errno
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Moves what a sandbox writes to its stdout and stderr into log files (see OutputHandler),
+# on a thread in the process which started it. Without timestamps, the data is moved from
+# the pipes to the files with splice(), so it's never copied into this process. With them,
+# it's read in large chunks and written back with a timestamp at the start of each line.
+#
+# Memory use doesn't depend on how much the sandbox writes: nothing is buffered beyond the
+# chunk being moved. Log files are rotated once they reach their maximum size, and only a
+# fixed number of old files are kept. Several launches (in this process or others) can write
+# to the same log file: each chunk is written at the end of the file while holding a lock on
+# path.lock, which is also held while rotating. With a rate limit, a stream isn't read while it's over
+# its limit, so the pipe fills up and the sandbox blocks on its writes until it catches up.
+
+_chunk_size = 1 << 16
+# Larger pipes mean fewer wakeups for chatty sandboxes. Limited by /proc/sys/fs/pipe-max-size.
+_pipe_size = 1 << 20
+_F_SETPIPE_SZ = 1031
+
+
+# Returns a new pipe as (read end, write end), with a larger buffer if possible
+def create_pipe() -> tuple[int, int]:
+    import fcntl
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, _F_SETPIPE_SZ, _pipe_size)
+    except OSError:
+        pass
+    return read_fd, write_fd
+
+
+class LogFile():
+    path: str
+    # Size at which the file is rotated, None to never rotate it
+    max_size: Optional[int]
+    # Number of rotated files to keep, as path.1 (the newest), path.2, etc.
+    keep: int
+    fd: int
+    # Size of the file, as of the last time the lock was taken
+    size: int
+    # path.lock, locked while writing or rotating
+    lock_fd: int
+
+    def __init__(self, path: str, max_size: Optional[int] = None, keep: int = 0):
+        self.path = path
+        self.max_size = max_size
+        self.keep = keep
+        self.fd = -1
+        self.size = 0
+        self.lock_fd = os.open(path + ".lock", os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        self.open()
+
+    # Not opened for appending, since splice() can't write to such files. Writes go to the
+    # end of the file anyway, since it's found again whenever the lock is taken.
+    def open(self) -> None:
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        self.size = os.lseek(self.fd, 0, os.SEEK_END)
+
+    # Held while writing to the file. Reopens it if another launch has rotated it.
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        import fcntl
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            opened = os.fstat(self.fd)
+            try:
+                current = os.stat(self.path)
+                rotated = (current.st_dev, current.st_ino) != (opened.st_dev, opened.st_ino)
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                os.close(self.fd)
+                self.open()
+            else:
+                self.size = os.lseek(self.fd, 0, os.SEEK_END)
+            yield
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    # Returns the number of bytes which can be written before the file has to be rotated.
+    # Only called with the lock held.
+    def room(self) -> Optional[int]:
+        if self.max_size is None:
+            return None
+        if self.size >= self.max_size:
+            self.rotate()
+        return self.max_size - self.size
+
+    def rotate(self) -> None:
+        os.close(self.fd)
+        for number in range(self.keep - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{number}"):
+                os.replace(f"{self.path}.{number}", f"{self.path}.{number + 1}")
+        if self.keep > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        self.size += len(data)
+
+    def close(self) -> None:
+        if self.fd != -1:
+            os.close(self.fd)
+            os.close(self.lock_fd)
+            self.fd = -1
+
+
+# The read end of one of the sandbox's output pipes
+class _Stream():
+    fd: int
+    log: LogFile
+    # Whether the next byte starts a line, for timestamps
+    line_start: bool
+    # Bytes which can be read before the stream is over its rate limit
+    allowance: float
+    last_read: float
+    # time.monotonic() value until which the stream isn't read, or None
+    paused_until: Optional[float]
+
+    def __init__(self, fd: int, log: LogFile, rate_limit: Optional[int]):
+        self.fd = fd
+        self.log = log
+        self.line_start = True
+        self.allowance = float(rate_limit or 0)
+        self.last_read = time.monotonic()
+        self.paused_until = None
+
+
+class OutputCapture():
+    streams: list[_Stream]
+    logs: list[LogFile]
+    timestamps: bool
+    # Bytes per second read from each stream, None for no limit
+    rate_limit: Optional[int]
+    # Set if splice() isn't supported for the files, after which data is copied instead
+    use_splice: bool
+    _thread: threading.Thread
+    # Written to by finish() to wake the thread
+    _wake_read: int
+    _wake_write: int
+    _stopping: bool
+
+    # 'streams' are (read end, log file) pairs. Several streams can share a log file.
+    def __init__(self, streams: list[tuple[int, LogFile]], timestamps: bool = False, rate_limit: Optional[int] = None):
+        self.streams = []
+        self.logs = []
+        for fd, log in streams:
+            os.set_blocking(fd, False)
+            self.streams.append(_Stream(fd, log, rate_limit))
+            if log not in self.logs:
+                self.logs.append(log)
+        self.timestamps = timestamps
+        self.rate_limit = rate_limit
+        self.use_splice = hasattr(os, "splice") and not timestamps
+        self._wake_read, self._wake_write = os.pipe()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="output capture", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    # Called after the sandbox exits. Moves whatever is left in the pipes and closes them,
+    # without waiting for processes the sandbox may have left running to close their ends.
+    def finish(self) -> None:
+        self._stopping = True
+        os.write(self._wake_write, b"x")
+        self._thread.join()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _run(self) -> None:
+        import selectors
+        selector = selectors.DefaultSelector()
+        selector.register(self._wake_read, selectors.EVENT_READ)
+        for stream in self.streams:
+            selector.register(stream.fd, selectors.EVENT_READ, stream)
+        active = list(self.streams)
+
+        try:
+            while active and not self._stopping:
+                now = time.monotonic()
+                for stream in active:
+                    if stream.paused_until is not None and stream.paused_until <= now:
+                        stream.paused_until = None
+                        selector.register(stream.fd, selectors.EVENT_READ, stream)
+                paused = [stream.paused_until for stream in active if stream.paused_until is not None]
+                timeout = max(0.0, min(paused) - now) if paused else None
+
+                for key, _ in selector.select(timeout):
+                    stream = key.data
+                    if stream is None or stream.paused_until is not None:
+                        continue
+                    if not self._move(stream):
+                        selector.unregister(stream.fd)
+                        active.remove(stream)
+                    elif stream.paused_until is not None:
+                        selector.unregister(stream.fd)
+
+            # The sandbox has exited, so only what's already in the pipes is left
+            for stream in active:
+                while self._move(stream, limited=False):
+                    pass
+        except OSError as error:
+            import sys
+            print(f"run-sandbox: Could not write the sandbox's output: {error}", file=sys.stderr)
+        finally:
+            selector.close()
+            for stream in self.streams:
+                os.close(stream.fd)
+            for log in self.logs:
+                log.close()
+
+    # Moves a chunk from the stream to its log file. Returns False at the end of the
+    # stream, or when it's empty if the sandbox has exited.
+    def _move(self, stream: _Stream, limited: bool = True) -> bool:
+        count = _chunk_size
+        if limited and self.rate_limit:
+            now = time.monotonic()
+            stream.allowance = min(float(self.rate_limit), stream.allowance + (now - stream.last_read) * self.rate_limit)
+            stream.last_read = now
+            # Waits for a whole chunk, rather than waking up for every few bytes
+            wanted = min(_chunk_size, self.rate_limit)
+            if stream.allowance < wanted:
+                stream.paused_until = now + (wanted - stream.allowance) / self.rate_limit
+                return True
+            count = min(count, int(stream.allowance))
+
+        try:
+            with stream.log.locked():
+                room = stream.log.room()
+                if room is not None:
+                    count = min(count, room)
+                if self.use_splice:
+                    moved = self._splice(stream, count)
+                else:
+                    moved = self._copy(stream, count)
+        except BlockingIOError:
+            return not self._stopping
+        if limited and self.rate_limit:
+            stream.allowance -= moved
+        return moved > 0
+
+    def _splice(self, stream: _Stream, count: int) -> int:
+        try:
+            moved = os.splice(stream.fd, stream.log.fd, count, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except OSError as error:
+            if error.errno not in [errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP]:
+                raise
+            # Not supported by the log file's filesystem
+            self.use_splice = False
+            return self._copy(stream, count)
+        stream.log.size += moved
+        return moved
+
+    def _copy(self, stream: _Stream, count: int) -> int:
+        data = os.read(stream.fd, count)
+        if not data or not self.timestamps:
+            stream.log.write(data)
+            return len(data)
+
+        now = time.time()
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)).encode() + b".%06dZ " % int(now % 1 * 1000000)
+        parts = []
+        start = 0
+        while start < len(data):
+            end = data.find(b"\n", start) + 1 or len(data)
+            if stream.line_start:
+                parts.append(prefix)
+            parts.append(data[start:end])
+            stream.line_start = data[end - 1] == ord("\n")
+            start = end
+        stream.log.write(b"".join(parts))
+        return len(data)
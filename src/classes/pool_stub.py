@@ -0,0 +1,89 @@
+# Runs inside each sandbox of a pool (see SandboxPool), as 'python -c <source of this file> FD'.
+# Can't import anything from sandbox-manager, since only the source is passed into the sandbox.
+#
+# FD is a SOCK_SEQPACKET socket connected to the daemon. Once the sandbox is set up, the stub
+# sends {"ready": true}. Then, for each command, it receives {"argv": [...], "cwd": path} along
+# with the client's stdin, stdout and stderr, runs the command and replies with
+# {"exit": exit code, "rusage": {...}}, where 'rusage' is the command's resource usage
+# (the fields of resource.struct_rusage, without 'ru_'). While a command is running, the daemon
+# can send {"signal": number}, which is sent to the command's process group. If the socket is
+# closed while a command is running, the command is terminated. The stub exits when the
+# socket is closed.
+import os
+import sys
+import json
+import select
+import signal
+import socket
+
+sock = socket.socket(fileno=int(sys.argv[1]))
+# Commands shouldn't get a copy
+os.set_inheritable(sock.fileno(), False)
+try:
+    sock.send(b'{"ready":true}')
+except OSError:
+    # Retired before it was ready
+    sys.exit(0)
+
+while True:
+    try:
+        data, fds, _, _ = socket.recv_fds(sock, 1 << 20, 3)
+    except OSError:
+        break
+    if not data:
+        break
+
+    request = json.loads(data)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            # The daemon passes these on from the client, so they shouldn't stay ignored
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGQUIT, signal.SIG_DFL)
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+            for fd in fds:
+                os.close(fd)
+            try:
+                os.chdir(request["cwd"])
+            except OSError:
+                pass
+            os.execvp(request["argv"][0], request["argv"])
+        except BaseException as error:
+            print(f"run-sandbox: {error}", file=sys.stderr)
+        os._exit(127)
+
+    for fd in fds:
+        os.close(fd)
+    pidfd = os.pidfd_open(pid)
+    closed = False
+    while pidfd not in select.select([sock, pidfd], [], [])[0]:
+        try:
+            data = sock.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            closed = True
+            break
+        try:
+            os.killpg(pid, json.loads(data)["signal"])
+        except ProcessLookupError:
+            pass
+    if closed:
+        # The daemon has closed the socket
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+        break
+
+    _, status, rusage = os.wait4(pid, 0)
+    os.close(pidfd)
+    exit_code = os.waitstatus_to_exitcode(status)
+    # Report signals in the same way as a shell
+    if exit_code < 0:
+        exit_code = 128 - exit_code
+    usage = {name[3:]: getattr(rusage, name) for name in dir(rusage) if name.startswith("ru_")}
+    sock.send(json.dumps({"exit": exit_code, "pid": pid, "rusage": usage}).encode())
@@ -0,0 +1,110 @@
+import time
+from collections.abc import Callable
+from typing import Optional
+from classes import tracing
+
+
+# A unit of work done before the sandbox starts, e.g. starting the D-Bus proxy.
+# 'function' returns None or a list of functions to call after the sandbox terminates,
+# like CategoryBase.prepare(). 'after' contains the names of steps which have to finish first.
+class PrepareStep():
+    name: str
+    function: Callable[[], Optional[list[Callable]]]
+    after: list[str]
+    # Set by run_steps(), as time.perf_counter() values
+    start: Optional[float]
+    end: Optional[float]
+
+    def __init__(self, name: str, function: Callable[[], Optional[list[Callable]]], after: list[str] = []):
+        self.name = name
+        self.function = function
+        self.after = after
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self) -> float:
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+    def run(self) -> Optional[list[Callable]]:
+        self.start = time.perf_counter()
+        try:
+            with tracing.span(f"prepare {self.name}"):
+                return self.function()
+        finally:
+            self.end = time.perf_counter()
+
+
+# Runs the steps on separate threads, each as soon as the steps it comes after have finished,
+# and returns their termination callbacks in the order the steps were given.
+# If a step fails, no more steps are started, the termination callbacks of every step that
+# finished are called once the running steps are done, and the first error is raised.
+def run_steps(steps: list[PrepareStep]) -> list[Callable]:
+    names = [step.name for step in steps]
+    for step in steps:
+        for name in step.after:
+            if name not in names:
+                raise RuntimeError(f"Prepare step '{step.name}' comes after '{name}', which doesn't exist.")
+
+    results: dict[str, list[Callable]] = {}
+    error: Optional[BaseException] = None
+
+    if len(steps) == 1 and not steps[0].after:
+        # Not worth starting a thread for
+        results[steps[0].name] = steps[0].run() or []
+    elif steps:
+        # Threads are used directly, since importing concurrent.futures takes longer than most steps
+        import threading
+        from queue import SimpleQueue
+        finished: SimpleQueue = SimpleQueue()
+        waiting = list(steps)
+        running = 0
+
+        def run_step(step: PrepareStep) -> None:
+            try:
+                finished.put((step.name, step.run() or [], None))
+            except BaseException as step_error:
+                finished.put((step.name, None, step_error))
+
+        while waiting or running:
+            if error is None:
+                for step in [step for step in waiting if all(name in results for name in step.after)]:
+                    waiting.remove(step)
+                    threading.Thread(target=run_step, args=(step,), name=f"prepare {step.name}", daemon=True).start()
+                    running += 1
+            if not running:
+                if error is None:
+                    cycle = ", ".join(step.name for step in waiting)
+                    error = RuntimeError(f"Prepare steps depend on each other: {cycle}")
+                break
+
+            name, step_callbacks, step_error = finished.get()
+            running -= 1
+            if step_error is None:
+                results[name] = step_callbacks
+            elif error is None:
+                error = step_error
+
+    callbacks = []
+    for name in names:
+        callbacks += results.get(name, [])
+
+    if error is not None:
+        for callback in callbacks:
+            callback()
+        raise error
+    return callbacks
+
+
+# Returns the chain of steps which determined how long preparing took: the step that
+# finished last, preceded by whichever of its dependencies finished last, and so on.
+def critical_path(steps: list[PrepareStep]) -> list[PrepareStep]:
+    finished = {step.name: step for step in steps if step.end is not None}
+    path = []
+    step = max(finished.values(), key=lambda step: step.end, default=None)
+    while step is not None:
+        path.insert(0, step)
+        step = max((finished[name] for name in step.after if name in finished), key=lambda step: step.end, default=None)
+    return path
@@ -1,20 +1,202 @@
 import warnings
 import os
+import sys
+import time
 import atexit
+import threading
 from classes.config_parser import ConfigParser
-from collections.abc import Callable
-from typing import Any
-from subprocess import Popen
+from classes.template import split_words, expand_word
+from classes import tracing
+from collections.abc import Callable, Iterator, Mapping
+from typing import Any, Optional, TYPE_CHECKING
 from re import sub
 
+if TYPE_CHECKING:
+    from subprocess import Popen
+    from classes.usage_metrics import UsageMetrics
+    from classes.access_trace import AccessTracer
+
+# Held while bwrap is being started. File descriptors meant for a sandbox (e.g. memfds of
+# created files) are only inheritable while this is held, so that sandboxes started from
+# other threads at the same time don't get a copy.
+_spawn_lock = threading.Lock()
+
+
+# A running sandbox, returned by Sandbox.start(). Calls the termination callbacks of its
+# launch once it has exited and has been waited for, whichever way that happens.
+# bwrap is reaped with wait4, so what the sandbox consumed is known once it has exited
+# (see UsageMetrics).
+class SandboxProcess():
+    process: "Popen"
+    pid: int
+    app_name: str
+    termination_callbacks: list[Callable]
+    metrics: Optional["UsageMetrics"]
+    # time.monotonic() values: when the launch started, when bwrap was executed and when
+    # it was reaped
+    launched: float
+    spawned: float
+    exited: Optional[float]
+    # Fields of the resource.struct_rusage reported for bwrap, without 'ru_'
+    rusage: Optional[dict[str, Any]]
+    _lock: threading.Lock
+    _reap_lock: threading.Lock
+    _finished: bool
+
+    def __init__(self, process: "Popen", termination_callbacks: list[Callable], app_name: str = "", launched: Optional[float] = None, metrics: Optional["UsageMetrics"] = None):
+        self.process = process
+        self.pid = process.pid
+        self.app_name = app_name
+        self.termination_callbacks = termination_callbacks
+        self.metrics = metrics
+        self.spawned = time.monotonic()
+        self.launched = self.spawned if launched is None else launched
+        self.exited = None
+        self.rusage = None
+        self._lock = threading.Lock()
+        self._reap_lock = threading.Lock()
+        self._finished = False
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.process.returncode
+
+    def _finish(self) -> None:
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        if self.termination_callbacks:
+            with tracing.span("termination callbacks"):
+                for callback in self.termination_callbacks:
+                    callback()
+        if self.metrics is not None and self.rusage is not None:
+            self.metrics.record(self.app_name, self.pid, self.process.returncode, self.spawned - self.launched, self.exited - self.spawned, self.rusage)
+
+    # Reaps bwrap if it has exited (or once it has, if 'block' is set) and returns its
+    # exit code, or None if it's still running
+    def _reap(self, block: bool) -> Optional[int]:
+        with self._reap_lock:
+            if self.process.returncode is not None:
+                return self.process.returncode
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                # Already reaped elsewhere, so the usage isn't known
+                return self.process.wait()
+            if pid == 0:
+                return None
+            self.exited = time.monotonic()
+            from classes.usage_metrics import rusage_fields
+            self.rusage = {field: getattr(rusage, "ru_" + field) for field in rusage_fields}
+            # Popen doesn't try to reap it again once this is set
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            return self.process.returncode
+
+    # Returns the exit code if the sandbox has exited, otherwise None
+    def poll(self) -> Optional[int]:
+        returncode = self._reap(block=False)
+        if returncode is not None:
+            self._finish()
+        return returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        if timeout is None:
+            returncode = self._reap(block=True)
+        else:
+            from subprocess import TimeoutExpired
+            deadline = time.monotonic() + timeout
+            delay = 0.0005
+            # The same as Popen.wait() with a timeout
+            while (returncode := self._reap(block=False)) is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutExpired(self.process.args, timeout)
+                delay = min(delay * 2, remaining, 0.05)
+                time.sleep(delay)
+        self._finish()
+        return returncode
+
+    # Returns the run time and resource usage of the sandbox (see UsageMetrics),
+    # or None if it hasn't been reaped yet
+    def usage(self) -> Optional[dict[str, Any]]:
+        if self.rusage is None:
+            return None
+        from classes.usage_metrics import rusage_record
+        return dict(launch_seconds=self.spawned - self.launched, run_seconds=self.exited - self.spawned, **rusage_record(self.rusage))
+
+    # Waits for the sandbox to exit without blocking the event loop, using a pidfd where the
+    # kernel supports them. The termination callbacks are run in the loop's default executor.
+    async def wait_async(self) -> int:
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if self.process.returncode is None:
+            try:
+                pidfd = os.pidfd_open(self.pid)
+            except (AttributeError, OSError):
+                pidfd = None
+
+            if pidfd is None:
+                await loop.run_in_executor(None, self._reap, True)
+            else:
+                exited = loop.create_future()
+                loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+                try:
+                    await exited
+                finally:
+                    loop.remove_reader(pidfd)
+                    os.close(pidfd)
+                # Doesn't block, since the process has exited
+                self._reap(block=True)
+
+        await loop.run_in_executor(None, self._finish)
+        return self.process.returncode
+
+    def __await__(self):
+        return self.wait_async().__await__()
+
+    def terminate(self) -> None:
+        if self.process.returncode is None:
+            self.process.terminate()
+
+    def kill(self) -> None:
+        if self.process.returncode is None:
+            self.process.kill()
+
 
 class Sandbox():
     blocking: bool
-    config_parser: ConfigParser
-    termination_callbacks: list[Callable]
+    # Replace this process with bwrap instead of waiting for it, if nothing
+    # needs to be done after the sandbox exits
+    use_exec: bool
+    # Pass the args from the config to bwrap through a file descriptor ('--args FD')
+    # instead of the command line, for configs with a very large number of args
+    use_args_fd: bool
+    # Keep running after this process exits, in a new session
+    detached: bool
+    # Print how long preparing took to stderr
+    verbose: bool
+    # Remove redundant mounts before starting bwrap (see MountPlan)
+    optimize_mounts: bool
+    # Where to record what each launch consumed once it exits. bwrap is always waited for
+    # if this is set, instead of replacing this process with it.
+    metrics: Optional["UsageMetrics"]
+    # Records the paths the sandbox opens while run() waits for it. bwrap is always waited
+    # for if this is set.
+    access_tracer: Optional["AccessTracer"]
+    config_parser: Optional[ConfigParser]
+    # Precompiled bwrap args, used instead of parsing the config (see CompiledConfig)
+    args: Optional[list[str]]
+    # The environment the config's values are expanded with, and bwrap is started with.
+    # A copy of this process's environment when the sandbox was created, plus the app name
+    # variables, so that sandboxes created in the same process don't affect each other.
+    env: dict[str, str]
     app_name: str
     executable: str
     extra_args: list[str]
+    # Held while the sandbox is prepared and started, since the handlers keep the state
+    # of the launch being prepared
+    _lock: threading.Lock
     # Args always prepended to bwrap args regardless of config
     constant_args: list[str] = [
         "--new-session",
@@ -23,12 +205,21 @@ class Sandbox():
     ]
 
     # Config is the output of yaml.safe_load()
-    def __init__(self, config: dict[str, Any], extra_args: list[str] = [], blocking: bool = True):
+    def __init__(self, config: dict[str, Any], extra_args: list[str] = [], blocking: bool = True, args: Optional[list[str]] = None, env: Optional[Mapping[str, str]] = None):
         self.blocking = blocking
-        self.termination_callbacks = []
+        self.use_exec = False
+        self.use_args_fd = False
+        self.detached = False
+        self.verbose = False
+        self.optimize_mounts = True
+        self.metrics = None
+        self.access_tracer = None
+        self.args = args
+        self.env = dict(os.environ if env is None else env)
         self.app_name = ""
         self.executable = ""
         self.extra_args = extra_args
+        self._lock = threading.Lock()
 
         # Guarantee that the app name env variable will be set regardless
         # of its position in the config (needed for dbus)
@@ -45,39 +236,226 @@ class Sandbox():
         if not isinstance(config, dict):
             raise AttributeError("Invalid config file.")
 
-        self.config_parser = ConfigParser(config)
+        self.config_parser = ConfigParser(config) if args is None else None
     
     def _set_app_name(self, name: str) -> None:
         self.app_name = name
-        os.environ["appNameWspace"] = self.app_name
-        os.environ["appName"] = sub(r"\s+", "", self.app_name)
+        self.env["appNameWspace"] = self.app_name
+        self.env["appName"] = sub(r"\s+", "", self.app_name)
+
+    # Returns the bwrap args generated from the config if they can be
+    # reused for later launches, otherwise None
+    def compile_args(self) -> Optional[list[str]]:
+        if self.config_parser is None:
+            return self.args
+        if self.config_parser.needs_prepare():
+            return None
+        return self.config_parser.to_args()
+
+    # Yields lists of bwrap options (everything before the executable), as shell-like words
+    def _iter_option_words(self) -> Iterator[list[str]]:
+        if self.detached:
+            yield [arg for arg in self.constant_args if arg not in ["--die-with-parent", "--new-session"]]
+        else:
+            yield self.constant_args
+        if self.config_parser is None:
+            yield self.args
+        else:
+            yield from self.config_parser.iter_args()
 
-    def create_bwrap_command(self) -> str:
+    # Yields the bwrap options in pieces, as each handler generates them, with the shell-like
+    # words from the config expanded here instead of by a shell and redundant mounts removed
+    def _iter_options(self) -> Iterator[list[str]]:
+        mount_plan = None
+        if self.optimize_mounts:
+            from classes.mount_plan import MountPlan
+            mount_plan = MountPlan()
+
+        for words in self._iter_option_words():
+            options = [expand_word(word, self.env) for word in words]
+            yield mount_plan.feed(options) if mount_plan else options
+
+        if mount_plan:
+            yield mount_plan.finish()
+            if self.verbose:
+                print(f"Removed {mount_plan.removed} redundant mounts.", file=sys.stderr)
+
+    # Returns the bwrap options
+    def create_options(self) -> list[str]:
+        options = []
+        with tracing.span("generate args"):
+            for piece in self._iter_options():
+                options += piece
+        return options
+
+    # Returns the argument vector for bwrap. Extra args are passed through as they are.
+    # If args_fd is given, the options are expected to be passed through it instead.
+    # If executable is given, it's run instead of the config's executable and extra args.
+    def create_bwrap_command(self, args_fd: Optional[int] = None, executable: Optional[list[str]] = None) -> list[str]:
         command = ["bwrap"]
-        command += self.constant_args
-        command += self.config_parser.to_args()
-        command.append(self.executable)
-        command += self.extra_args
+        if args_fd is None:
+            command += self.create_options()
+        else:
+            command += ["--args", str(args_fd)]
+
+        if executable is not None:
+            return command + executable
+        return command + self.create_command()
 
-        return " ".join(command)
+    # Returns the command run in the sandbox: the executable (the config's by default) as
+    # expanded words, followed by the extra args (the sandbox's by default)
+    def create_command(self, executable: Optional[str] = None, extra_args: Optional[list[str]] = None) -> list[str]:
+        command = [expand_word(word, self.env) for word in split_words(executable or self.executable)]
+        return command + (self.extra_args if extra_args is None else extra_args)
+
+    # Writes the bwrap options to an anonymous file, as NUL-terminated strings, and
+    # returns its file descriptor. Each handler's options are written as they're generated,
+    # so the whole list is never built.
+    def create_args_fd(self) -> int:
+        if hasattr(os, "memfd_create"):
+            fd = os.memfd_create("bwrap-args", 0)
+        else:
+            import tempfile
+            fd = os.dup(tempfile.TemporaryFile().fileno())
+        os.set_inheritable(fd, True)
+
+        with tracing.span("generate args"), open(fd, "wb", closefd=False) as file:
+            for options in self._iter_options():
+                file.write(b"".join(option.encode() + b"\0" for option in options))
+        os.lseek(fd, 0, os.SEEK_SET)
+        return fd
     
-    def _prepare(self) -> None:
-        self.termination_callbacks += self.config_parser.prepare()
+    # Returns the termination callbacks of the launch
+    def _prepare(self) -> list[Callable]:
+        if not self.config_parser:
+            return []
+
+        start = time.perf_counter()
+        with tracing.span("prepare"):
+            callbacks = self.config_parser.prepare(self.env)
+        if self.verbose and self.config_parser.steps:
+            from classes.prepare_scheduler import critical_path
+            path = " -> ".join(f"{step.name} ({step.duration * 1000:.1f} ms)" for step in critical_path(self.config_parser.steps))
+            print(f"Prepared in {(time.perf_counter() - start) * 1000:.1f} ms, critical path: {path}", file=sys.stderr)
+        return callbacks
+
+    # Returns the commands to run bwrap through (see CategoryBase.command_prefix)
+    def _command_prefix(self) -> list[str]:
+        if self.config_parser:
+            return self.config_parser.command_prefix()
+        return []
+
+    # Returns the usage counters of the sandbox's cgroup, if the config has a 'resources'
+    # category and the sandbox has exited (see ResourcesHandler.read_usage)
+    def resource_usage(self) -> Optional[dict[str, int]]:
+        if self.config_parser is None or "resources" not in self.config_parser.categories:
+            return None
+        return self.config_parser.handlers[self.config_parser.categories.index("resources")].usage
 
-    def run(self) -> Popen:
-        self._prepare()
-        command = self.create_bwrap_command()
+    # Returns the stdio file descriptors the handlers want bwrap to have, as Popen arguments
+    # (see CategoryBase.stdio)
+    def _stdio(self) -> dict[str, int]:
+        if self.config_parser:
+            return self.config_parser.stdio()
+        return {}
+
+    # Called once bwrap has been started (see CategoryBase.started)
+    def _started(self) -> None:
+        if self.config_parser:
+            self.config_parser.started()
+
+    # Starts bwrap, replacing this process with it if 'use_exec' is set and there are no
+    # termination callbacks. The termination callbacks are called if starting it fails.
+    def _spawn(self, callbacks: list[Callable], use_exec: bool = False, executable: Optional[list[str]] = None, pass_fds: list[int] = [], **popen_args: Any) -> "Popen":
+        from subprocess import Popen
+        try:
+            with _spawn_lock:
+                args_fd = self.create_args_fd() if self.use_args_fd else None
+                command = self._command_prefix() + self.create_bwrap_command(args_fd, executable)
+                # Arguments given by the caller take precedence
+                popen_args = {**self._stdio(), **popen_args}
+                for fd in pass_fds:
+                    os.set_inheritable(fd, True)
+
+                if use_exec and not callbacks:
+                    # Nothing runs after exec, so the trace has to be written now
+                    now = time.perf_counter()
+                    tracing.add_span("exec bwrap", now, now)
+                    tracing.finish()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os.execvpe(command[0], command, self.env)
+
+                try:
+                    with tracing.span("spawn bwrap"):
+                        process = Popen(command, close_fds=False, start_new_session=self.detached, env=self.env, **popen_args)
+                finally:
+                    # bwrap has its own copies now
+                    if args_fd is not None:
+                        os.close(args_fd)
+                    for fd in pass_fds:
+                        os.set_inheritable(fd, False)
+                    self._started()
+        except BaseException:
+            for callback in callbacks:
+                callback()
+            raise
+        return process
+
+    # Prepares and starts the sandbox without waiting for it, and returns a handle for it.
+    # Can be called from any thread, and again before earlier launches have exited.
+    # 'executable' replaces the config's executable and extra args, 'pass_fds' are made
+    # inheritable by bwrap, and any other arguments are passed to Popen (e.g. stdout).
+    def start(self, executable: Optional[list[str]] = None, pass_fds: list[int] = [], **popen_args: Any) -> SandboxProcess:
+        launched = time.monotonic()
+        with self._lock:
+            callbacks = self._prepare()
+            process = self._spawn(callbacks, executable=executable, pass_fds=pass_fds, **popen_args)
+        return SandboxProcess(process, callbacks, self.app_name, launched, self.metrics)
+
+    # Runs the sandbox until it exits, without blocking the event loop, and returns its exit
+    # code. Preparing happens in the loop's default executor, since it can block (e.g. while
+    # waiting for the D-Bus proxy). If the task is cancelled, the sandbox is terminated.
+    async def run_async(self, executable: Optional[list[str]] = None, **popen_args: Any) -> int:
+        import asyncio
+        from functools import partial
+        loop = asyncio.get_running_loop()
+        sandbox_process = await loop.run_in_executor(None, partial(self.start, executable, **popen_args))
+        try:
+            return await sandbox_process.wait_async()
+        except asyncio.CancelledError:
+            sandbox_process.terminate()
+            await asyncio.shield(sandbox_process.wait_async())
+            raise
+
+    def run(self) -> "Popen":
+        launched = time.monotonic()
+        with self._lock:
+            callbacks = self._prepare()
+            process = self._spawn(callbacks, use_exec=self.use_exec and self.blocking and self.metrics is None and self.access_tracer is None)
+        sandbox_process = SandboxProcess(process, callbacks, self.app_name, launched, self.metrics)
+        if self.access_tracer:
+            self.access_tracer.attach(process.pid)
 
-        process = Popen(command, shell=True, close_fds=False)
-        
         # Always block and run in background since
         # it's difficult to terminate the sandbox otherwise
         if self.blocking:
             atexit.register(process.terminate)
-            process.wait()
-        
-        if len(self.termination_callbacks) > 0:
-            for callback in self.termination_callbacks:
-                callback()
-        
+            with tracing.span("sandbox running"):
+                sandbox_process.wait()
+            atexit.unregister(process.terminate)
+        if self.access_tracer:
+            self.access_tracer.detach()
+        # Without blocking, the callbacks are called straight away.
+        # Use start() to call them when the sandbox exits instead.
+        sandbox_process._finish()
+
+        usage = self.resource_usage()
+        if self.verbose and usage:
+            print("Resource usage: " + ", ".join(f"{key}={value}" for key, value in usage.items()), file=sys.stderr)
+        usage = sandbox_process.usage()
+        if self.verbose and usage:
+            print(f"Launched in {usage['launch_seconds'] * 1000:.1f} ms, ran for {usage['run_seconds']:.2f} s, "
+                  f"CPU time {usage['cpu_user_seconds'] + usage['cpu_system_seconds']:.2f} s, max RSS {usage['max_rss_bytes'] // 1024} KiB", file=sys.stderr)
+
         return process
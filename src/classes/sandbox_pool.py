@@ -0,0 +1,359 @@
+import os
+import sys
+import json
+import time
+import socket
+from collections.abc import Callable
+from typing import Any, Optional, TYPE_CHECKING
+from classes.template import split_words, expand_word
+
+if TYPE_CHECKING:
+    from selectors import BaseSelector
+    from classes.sandbox import Sandbox, SandboxProcess
+
+# Pools of sandboxes which have already been set up, for the daemon (see SandboxDaemon).
+# Each sandbox in a pool runs a stub (pool_stub.py) instead of the config's executable,
+# which waits for a command from the daemon and runs it with the client's stdio. Starting
+# a command in a waiting sandbox skips creating its namespaces and mounts, and starting
+# Python and bwrap. Replacements are started as soon as a sandbox is taken from the pool,
+# and become available once their stub reports that it's ready.
+#
+# The sandboxes are set up with the daemon's environment, not the client's. The stub is
+# run with the Python interpreter running the daemon, so it has to be visible in the sandbox.
+
+_stub_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pool_stub.py")
+# Number of sandboxes in a row which can exit before they're ready,
+# before the pool stops starting new ones
+max_failures: int = 3
+
+
+class PoolInstance():
+    process: "SandboxProcess"
+    pidfd: int
+    # The daemon's end of the connection to the stub
+    sock: socket.socket
+    # One of 'starting', 'idle', 'busy' or 'retired'
+    state: str
+    # time.monotonic() values
+    started: float
+    ready: Optional[float]
+    # Number of commands it has been given
+    uses: int
+    # time.monotonic() values: when the running command was received, and when it was
+    # handed to the stub
+    dispatched: float
+    command_started: float
+    # Connection to the client of the running command
+    connection: Optional[socket.socket]
+
+    def __init__(self, process: "SandboxProcess", sock: socket.socket, started: float):
+        self.process = process
+        self.pidfd = os.pidfd_open(process.pid)
+        self.sock = sock
+        self.state = "starting"
+        self.started = started
+        self.ready = None
+        self.uses = 0
+        self.dispatched = 0.0
+        self.command_started = 0.0
+        self.connection = None
+
+
+class SandboxPool():
+    name: str
+    # Number of sandboxes to keep ready
+    size: int
+    # Seconds after which an idle sandbox is replaced, None to keep them until they're used
+    max_age: Optional[float]
+    # Number of commands a sandbox runs before it's replaced. Commands run one at a time,
+    # and see what earlier commands left in the sandbox (e.g. in its tmpfs).
+    max_uses: int
+    sandbox: Optional["Sandbox"]
+    selector: Optional["BaseSelector"]
+    instances: list[PoolInstance]
+    # Number of sandboxes in a row which exited before they were ready
+    failures: int
+    # Set once too many sandboxes have failed
+    disabled: bool
+    hits: int
+    misses: int
+    spawned: int
+    failed: int
+    # Number of retired sandboxes, by reason
+    retired: dict[str, int]
+    # Seconds from starting a sandbox until it was ready: the total, the longest and the latest
+    refill_count: int
+    refill_total: float
+    refill_max: float
+    refill_last: float
+    log: Callable[[str], None]
+    stub_source: str
+
+    def __init__(self, name: str, size: int, max_age: Optional[float] = None, max_uses: int = 1, log: Callable[[str], None] = lambda _: None):
+        self.name = name
+        self.size = size
+        self.max_age = max_age
+        self.max_uses = max_uses
+        self.sandbox = None
+        self.selector = None
+        self.instances = []
+        self.failures = 0
+        self.disabled = False
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.failed = 0
+        self.retired = {}
+        self.refill_count = 0
+        self.refill_total = 0.0
+        self.refill_max = 0.0
+        self.refill_last = 0.0
+        self.log = log
+        with open(_stub_path, "r") as file:
+            self.stub_source = file.read()
+
+    def start(self, sandbox: "Sandbox", selector: "BaseSelector") -> None:
+        self.sandbox = sandbox
+        self.selector = selector
+        self.fill()
+
+    # Replaces the sandboxes if the config has been resolved again
+    def set_sandbox(self, sandbox: "Sandbox") -> None:
+        if sandbox is self.sandbox:
+            return
+        self.log(f"Config '{self.name}' has changed, replacing its pool.")
+        self.sandbox = sandbox
+        self.failures = 0
+        self.disabled = False
+        for instance in list(self.instances):
+            if instance.state in ["starting", "idle"]:
+                self.retire(instance, "config changed")
+            else:
+                # Not reused once its command has finished
+                instance.uses = self.max_uses
+        self.fill()
+
+    # Starts sandboxes until there are enough which are, or will become, ready for a command
+    def fill(self) -> None:
+        if self.sandbox is None or self.disabled:
+            return
+        available = [instance for instance in self.instances if instance.state in ["starting", "idle"] or (instance.state == "busy" and instance.uses < self.max_uses)]
+        for _ in range(self.size - len(available)):
+            self._spawn()
+
+    def _spawn(self) -> None:
+        import selectors
+        from subprocess import DEVNULL
+        daemon_end, stub_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        started = time.monotonic()
+
+        try:
+            executable = [sys.executable, "-c", self.stub_source, str(stub_end.fileno())]
+            process = self.sandbox.start(executable, pass_fds=[stub_end.fileno()], stdin=DEVNULL, stdout=DEVNULL)
+        except Exception as error:
+            daemon_end.close()
+            self._failed(f"Could not start a sandbox: {error}")
+            return
+        finally:
+            stub_end.close()
+        # The commands run in it are recorded instead
+        process.metrics = None
+
+        instance = PoolInstance(process, daemon_end, started)
+        self.instances.append(instance)
+        self.spawned += 1
+        self.selector.register(instance.sock, selectors.EVENT_READ, lambda: self._on_message(instance))
+        self.selector.register(instance.pidfd, selectors.EVENT_READ, lambda: self._on_exit(instance))
+
+    def _failed(self, message: str) -> None:
+        self.failed += 1
+        self.failures += 1
+        self.log(f"Pool for '{self.name}': {message}")
+        if self.failures >= max_failures:
+            self.disabled = True
+            self.log(f"Pool for '{self.name}' disabled after {self.failures} failures in a row. Is '{sys.executable}' visible in the sandbox?")
+
+    # Takes a sandbox from the pool and runs the requested command in it, with the given
+    # stdin, stdout and stderr. The exit code is sent to the client once it finishes.
+    # Returns False if no sandbox was ready.
+    def dispatch(self, connection: socket.socket, request: dict[str, Any], fds: list[int]) -> bool:
+        import selectors
+        dispatched = time.monotonic()
+        instance = next((instance for instance in self.instances if instance.state == "idle"), None)
+        if instance is None:
+            self.misses += 1
+            self.fill()
+            return False
+
+        executable = request.get("run") or self.sandbox.executable
+        argv = [expand_word(word, self.sandbox.env) for word in split_words(executable)] + request["args"]
+        try:
+            socket.send_fds(instance.sock, [json.dumps({"argv": argv, "cwd": request["cwd"]}).encode()], fds)
+        except OSError:
+            self.retire(instance, "failed")
+            self.misses += 1
+            self.fill()
+            return False
+
+        self.hits += 1
+        instance.state = "busy"
+        instance.uses += 1
+        instance.dispatched = dispatched
+        instance.command_started = time.monotonic()
+        instance.connection = connection
+        self.selector.register(connection, selectors.EVENT_READ, lambda: self._on_client_message(instance))
+        self.fill()
+        return True
+
+    def _on_message(self, instance: PoolInstance) -> None:
+        from classes.daemon import send_message
+        try:
+            data = instance.sock.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            # The stub has exited, and the sandbox will follow
+            self.selector.unregister(instance.sock)
+            return
+        message = json.loads(data)
+
+        if instance.state == "starting" and message.get("ready"):
+            instance.state = "idle"
+            instance.ready = time.monotonic()
+            self.refill_last = instance.ready - instance.started
+            self.refill_count += 1
+            self.refill_total += self.refill_last
+            self.refill_max = max(self.refill_max, self.refill_last)
+            self.failures = 0
+            return
+
+        if instance.state == "busy" and "exit" in message:
+            if self.sandbox.metrics is not None and "rusage" in message:
+                self.sandbox.metrics.record(self.sandbox.app_name, message.get("pid", 0), message["exit"], instance.command_started - instance.dispatched,
+                                            time.monotonic() - instance.command_started, message["rusage"], pooled=True)
+            connection = self._release_connection(instance)
+            try:
+                send_message(connection, {"exit": message["exit"]})
+            except OSError:
+                pass
+            connection.close()
+
+            if instance.uses >= self.max_uses:
+                self.retire(instance, "max uses")
+            elif self._expired(instance):
+                self.retire(instance, "max age")
+            else:
+                instance.state = "idle"
+            self.fill()
+
+    # Passes on a signal from the client to the stub, or terminates the command if the client
+    # has disconnected
+    def _on_client_message(self, instance: PoolInstance) -> None:
+        from classes.daemon import recv_signal
+        signum = recv_signal(instance.connection)
+        if signum is None:
+            self.log(f"Client of a pooled sandbox of '{self.name}' disconnected, terminating it.")
+            self.retire(instance, "client disconnected")
+            self.fill()
+        elif signum:
+            try:
+                instance.sock.send(json.dumps({"signal": signum}).encode())
+            except OSError:
+                pass
+
+    def _release_connection(self, instance: PoolInstance) -> socket.socket:
+        connection = instance.connection
+        instance.connection = None
+        self.selector.unregister(connection)
+        return connection
+
+    def _on_exit(self, instance: PoolInstance) -> None:
+        exit_code = instance.process.wait()
+        self.selector.unregister(instance.pidfd)
+        os.close(instance.pidfd)
+        if instance.sock.fileno() != -1:
+            if instance.sock in [key.fileobj for key in self.selector.get_map().values()]:
+                self.selector.unregister(instance.sock)
+            instance.sock.close()
+        self.instances.remove(instance)
+
+        if instance.state == "starting":
+            self._failed(f"A sandbox exited with code {exit_code} before it was ready.")
+        elif instance.state == "idle":
+            self.retired["exited"] = self.retired.get("exited", 0) + 1
+        elif instance.state == "busy":
+            from classes.daemon import send_message
+            connection = self._release_connection(instance)
+            try:
+                send_message(connection, {"exit": exit_code if exit_code >= 0 else 128 - exit_code})
+            except OSError:
+                pass
+            connection.close()
+            self.retired["exited"] = self.retired.get("exited", 0) + 1
+        self.fill()
+
+    # Stops the stub, which terminates its command if it's running one.
+    # The sandbox is removed once it has exited.
+    def retire(self, instance: PoolInstance, reason: str) -> None:
+        if instance.state == "retired":
+            return
+        if instance.connection is not None:
+            self._release_connection(instance).close()
+        if instance.sock in [key.fileobj for key in self.selector.get_map().values()]:
+            self.selector.unregister(instance.sock)
+        instance.sock.close()
+        instance.state = "retired"
+        self.retired[reason] = self.retired.get(reason, 0) + 1
+
+    def _expired(self, instance: PoolInstance) -> bool:
+        return self.max_age is not None and time.monotonic() - instance.started >= self.max_age
+
+    # Retires idle sandboxes which have reached their max age
+    def expire(self) -> None:
+        for instance in list(self.instances):
+            if instance.state == "idle" and self._expired(instance):
+                self.retire(instance, "max age")
+        self.fill()
+
+    # Returns the number of seconds until an idle sandbox reaches its max age, or None
+    def next_expiry(self) -> Optional[float]:
+        if self.max_age is None:
+            return None
+        idle = [instance.started + self.max_age for instance in self.instances if instance.state == "idle"]
+        if not idle:
+            return None
+        return max(0.0, min(idle) - time.monotonic())
+
+    # Stops every sandbox and waits for them to exit
+    def close(self) -> None:
+        for instance in list(self.instances):
+            self.retire(instance, "daemon exited")
+        for instance in self.instances:
+            try:
+                instance.process.wait(timeout=5)
+            except Exception:
+                instance.process.kill()
+                instance.process.wait()
+            os.close(instance.pidfd)
+        self.instances = []
+
+    def stats(self) -> dict[str, Any]:
+        states = [instance.state for instance in self.instances]
+        refill = {"count": self.refill_count}
+        if self.refill_count:
+            refill["mean_ms"] = self.refill_total / self.refill_count * 1000
+            refill["max_ms"] = self.refill_max * 1000
+            refill["last_ms"] = self.refill_last * 1000
+        return {
+            "size": self.size,
+            "starting": states.count("starting"),
+            "idle": states.count("idle"),
+            "busy": states.count("busy"),
+            "hits": self.hits,
+            "misses": self.misses,
+            "spawned": self.spawned,
+            "failed": self.failed,
+            "disabled": self.disabled,
+            "retired": self.retired,
+            "refill": refill,
+        }
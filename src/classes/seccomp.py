@@ -0,0 +1,205 @@
+import errno
+import struct
+import platform
+from classes import syscall_tables
+from classes.cache import cache_path, digest, write_atomic
+from typing import Optional
+
+# Compiles seccomp policies (see SeccompPermissions) to classic BPF programs, in the form
+# bwrap expects for '--seccomp FD': an array of struct sock_filter in native byte order.
+#
+# The program checks the architecture the syscall was made with, then finds the action for
+# the syscall number with a binary search over the ranges of numbers that share an action.
+# A policy with a few hundred syscalls takes about ten comparisons per syscall, instead of
+# one for each syscall listed. Syscalls made with an architecture that isn't in the policy
+# kill the process, since their numbers mean something else.
+#
+# Compiled programs are cached by a hash of the policy, in $XDG_CACHE_HOME/sandbox-manager/seccomp.
+
+# Changes whenever the compiled programs change, so that cached programs aren't reused
+_compiler_version: int = 1
+
+# {name: (AUDIT_ARCH_* value, syscall table)}
+supported_architectures: dict[str, tuple[int, dict[str, int]]] = {
+    "x86_64": (0xc000003e, syscall_tables.x86_64),
+    "x86": (0x40000003, syscall_tables.x86),
+    "aarch64": (0xc00000b7, syscall_tables.aarch64),
+}
+# The architectures a process on each machine can make syscalls with (see platform.machine())
+_machine_architectures: dict[str, list[str]] = {
+    "x86_64": ["x86_64", "x86"],
+    "i386": ["x86"],
+    "i686": ["x86"],
+    "aarch64": ["aarch64"],
+    "arm64": ["aarch64"],
+}
+
+# Return values of seccomp filters
+SECCOMP_RET_KILL_PROCESS = 0x80000000
+SECCOMP_RET_TRAP = 0x00030000
+SECCOMP_RET_ERRNO = 0x00050000
+SECCOMP_RET_LOG = 0x7ffc0000
+SECCOMP_RET_ALLOW = 0x7fff0000
+
+# Offsets in struct seccomp_data
+_nr_offset = 0
+_arch_offset = 4
+# Syscalls of the x32 ABI have this bit set, and are made with the x86_64 architecture
+_x32_syscall_bit = 0x40000000
+
+# Opcodes of the instructions used
+_BPF_LD_W_ABS = 0x20
+_BPF_JMP_JA = 0x05
+_BPF_JMP_JEQ_K = 0x15
+_BPF_JMP_JGE_K = 0x35
+_BPF_RET_K = 0x06
+# Conditional jumps can only skip up to this many instructions
+_max_jump = 255
+# BPF_MAXINSNS
+max_instructions = 4096
+
+_instruction = struct.Struct("=HBBI")
+
+
+def default_architectures() -> list[str]:
+    machine = platform.machine()
+    if machine not in _machine_architectures:
+        raise RuntimeError(f"Seccomp filters aren't supported on '{machine}'. Supported architectures are: {', '.join(supported_architectures)}.")
+    return _machine_architectures[machine]
+
+
+# Returns the return value for an action: 'allow', 'kill', 'trap', 'log' or an errno name
+def action_value(action: str) -> int:
+    match action:
+        case "allow":
+            return SECCOMP_RET_ALLOW
+        case "kill":
+            return SECCOMP_RET_KILL_PROCESS
+        case "trap":
+            return SECCOMP_RET_TRAP
+        case "log":
+            return SECCOMP_RET_LOG
+    number = getattr(errno, action, None) if action.isupper() else None
+    if not isinstance(number, int):
+        raise AttributeError(f"'{action}' is not a valid seccomp action. It should be 'kill', 'trap', 'log' or an errno name such as EPERM.")
+    return SECCOMP_RET_ERRNO | number
+
+
+# A syscall filter for one or more architectures. Syscalls are names, or numbers which are
+# used as they are on every architecture.
+class SeccompPolicy():
+    # Syscalls which are allowed. If None, every syscall which isn't denied is allowed.
+    allow: Optional[list[str | int]]
+    deny: list[str | int]
+    # What denied syscalls do (see action_value)
+    action: str
+    architectures: list[str]
+
+    def __init__(self, allow: Optional[list[str | int]], deny: list[str | int], action: str = "EPERM", architectures: Optional[list[str]] = None):
+        self.allow = allow
+        self.deny = deny
+        self.action = action
+        self.architectures = architectures if architectures is not None else default_architectures()
+
+        action_value(action)
+        for name in self.architectures:
+            if name not in supported_architectures:
+                raise AttributeError(f"'{name}' is not a supported seccomp architecture. Supported architectures are: {', '.join(supported_architectures)}.")
+        for syscall in (allow or []) + deny:
+            if isinstance(syscall, str) and not any(syscall in table for _, table in supported_architectures.values()):
+                raise AttributeError(f"'{syscall}' is not a known syscall.")
+            if not isinstance(syscall, (str, int)) or isinstance(syscall, bool) or (isinstance(syscall, int) and not 0 <= syscall < _x32_syscall_bit):
+                raise AttributeError(f"'{syscall}' is not a valid syscall. It should be a name or a number.")
+
+    # Identifies the compiled program
+    def key(self) -> str:
+        policy = [
+            _compiler_version,
+            None if self.allow is None else sorted(set(map(str, self.allow))),
+            sorted(set(map(str, self.deny))),
+            self.action,
+            self.architectures,
+        ]
+        return digest(repr(policy).encode())[:32]
+
+    # Returns the ranges of syscall numbers which share an action on an architecture,
+    # as a sorted list of (first number, return value) covering every number
+    def ranges(self, architecture: str) -> list[tuple[int, int]]:
+        _, table = supported_architectures[architecture]
+        deny_value = action_value(self.action)
+        default = SECCOMP_RET_ALLOW if self.allow is None else deny_value
+
+        actions: dict[int, int] = {}
+        # Denied syscalls take precedence, and names missing on this architecture are skipped
+        for syscalls, value in [(self.allow or [], SECCOMP_RET_ALLOW), (self.deny, deny_value)]:
+            for syscall in syscalls:
+                number = table.get(syscall) if isinstance(syscall, str) else syscall
+                if number is not None:
+                    actions[number] = value
+
+        ranges = [(0, default)]
+        for number in sorted(actions):
+            ranges.append((number, actions[number]))
+            ranges.append((number + 1, default))
+        if architecture == "x86_64":
+            ranges.append((_x32_syscall_bit, deny_value))
+
+        # Drop empty ranges, then merge neighbours with the same action
+        merged: list[tuple[int, int]] = []
+        for start, value in ranges:
+            if merged and merged[-1][0] == start:
+                merged.pop()
+            if not merged or merged[-1][1] != value:
+                merged.append((start, value))
+        return merged
+
+    def compile(self) -> bytes:
+        # Load the architecture, and jump to its search tree
+        trees = []
+        for name in self.architectures:
+            trees.append([(_BPF_LD_W_ABS, 0, 0, _nr_offset)] + _search_tree(self.ranges(name)))
+
+        program = [(_BPF_LD_W_ABS, 0, 0, _arch_offset)]
+        # Each check is a comparison and a jump, followed by the kill for other architectures
+        offset = 2 * (len(trees) - 1) + 1
+        for name, tree in zip(self.architectures, trees):
+            program += [(_BPF_JMP_JEQ_K, 0, 1, supported_architectures[name][0]), (_BPF_JMP_JA, 0, 0, offset)]
+            offset += len(tree) - 2
+        program.append((_BPF_RET_K, 0, 0, SECCOMP_RET_KILL_PROCESS))
+        for tree in trees:
+            program += tree
+
+        if len(program) > max_instructions:
+            raise RuntimeError(f"The seccomp filter is too large ({len(program)} instructions, the limit is {max_instructions}).")
+        return b"".join(_instruction.pack(*instruction) for instruction in program)
+
+
+# Returns instructions which return the value of the range the syscall number
+# (in the accumulator) is in, by comparing it with the middle range's first number
+def _search_tree(ranges: list[tuple[int, int]]) -> list[tuple[int, int, int, int]]:
+    if len(ranges) == 1:
+        return [(_BPF_RET_K, 0, 0, ranges[0][1])]
+
+    middle = len(ranges) // 2
+    below = _search_tree(ranges[:middle])
+    above = _search_tree(ranges[middle:])
+    if len(below) <= _max_jump:
+        return [(_BPF_JMP_JGE_K, len(below), 0, ranges[middle][0])] + below + above
+    # Too far for a conditional jump, so jump over the instructions below with 'ja'
+    return [(_BPF_JMP_JGE_K, 0, 1, ranges[middle][0]), (_BPF_JMP_JA, 0, 0, len(below))] + below + above
+
+
+# Returns the compiled program for the policy, from the cache if it has been compiled before
+def load_filter(policy: SeccompPolicy) -> bytes:
+    path = cache_path("seccomp", policy.key() + ".bpf")
+    try:
+        with open(path, "rb") as file:
+            program = file.read()
+        if program and len(program) % _instruction.size == 0:
+            return program
+    except OSError:
+        pass
+
+    program = policy.compile()
+    write_atomic(path, program)
+    return program
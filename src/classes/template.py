@@ -0,0 +1,186 @@
+import os
+from collections.abc import Mapping
+from functools import lru_cache
+
+# Config values and bwrap args are written as shell words, e.g. '"$XDG_RUNTIME_DIR"/bus'
+# or '~/.config'. This module implements the subset of shell syntax that they use
+# (quoting, backslash escapes, $VAR, ${VAR} and leading ~) so that they can be expanded
+# without starting a shell. Unlike a shell, the result of an expansion is never split
+# into several words and globs are never expanded.
+
+_whitespace = " \t\n"
+_name_start = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_"
+_name_chars = _name_start + "0123456789"
+# Characters that can be escaped by a backslash within double quotes
+_double_quote_escapes = "$`\"\\\n"
+
+
+# A word compiled into a list of literal strings and variables,
+# stored as (name,) tuples. ("~user",) tuples are home directories.
+class Template():
+    parts: list[str | tuple[str]]
+
+    def __init__(self, parts: list[str | tuple[str]]):
+        self.parts = parts
+
+    def expand(self, env: Mapping[str, str]) -> str:
+        result = []
+        for part in self.parts:
+            if isinstance(part, str):
+                result.append(part)
+            elif part[0].startswith("~"):
+                result.append(_home_directory(part[0][1:], env))
+            else:
+                result.append(env.get(part[0], ""))
+        return "".join(result)
+
+
+def _home_directory(user: str, env: Mapping[str, str]) -> str:
+    if not user and env.get("HOME"):
+        return env["HOME"]
+    return os.path.expanduser("~" + user)
+
+
+# Parses text into words. Returns a list of (raw text, parts) tuples,
+# where raw text is the source of the word including its quotes.
+def _parse(text: str) -> list[tuple[str, list[str | tuple[str]]]]:
+    words = []
+    parts: list[str | tuple[str]] = []
+    literal = []
+    start = None
+    i = 0
+
+    def flush_literal():
+        if literal:
+            parts.append("".join(literal))
+            literal.clear()
+
+    def parse_variable(i: int) -> int:
+        # i points at the character after '$'
+        if i < len(text) and text[i] == "{":
+            end = text.find("}", i)
+            name = text[i + 1:end]
+            if end == -1 or not name or name[0] not in _name_start or any(c not in _name_chars for c in name):
+                raise AttributeError(f"Invalid variable reference in '{text}'.")
+            flush_literal()
+            parts.append((name,))
+            return end + 1
+        if i < len(text) and text[i] in _name_start:
+            end = i
+            while end < len(text) and text[end] in _name_chars:
+                end += 1
+            flush_literal()
+            parts.append((text[i:end],))
+            return end
+        # A lone '$' is kept as is
+        literal.append("$")
+        return i
+
+    while i < len(text):
+        char = text[i]
+
+        if char in _whitespace:
+            if start is not None:
+                flush_literal()
+                words.append((text[start:i], parts))
+                parts = []
+                start = None
+            i += 1
+            continue
+
+        if start is None:
+            start = i
+            if char == "~":
+                end = i + 1
+                while end < len(text) and text[end] not in _whitespace + "/\"'\\$":
+                    end += 1
+                # Only a plain '~' or '~user' followed by a slash or the end of the word is expanded
+                if end == len(text) or text[end] in _whitespace + "/":
+                    parts.append((text[i:end],))
+                    i = end
+                    continue
+
+        if char == "'":
+            end = text.find("'", i + 1)
+            if end == -1:
+                raise AttributeError(f"Unterminated quote in '{text}'.")
+            literal.append(text[i + 1:end])
+            # Make sure that '' still produces a (empty) word
+            parts.append("")
+            i = end + 1
+        elif char == "\"":
+            parts.append("")
+            i += 1
+            while True:
+                if i >= len(text):
+                    raise AttributeError(f"Unterminated quote in '{text}'.")
+                char = text[i]
+                if char == "\"":
+                    i += 1
+                    break
+                if char == "\\" and i + 1 < len(text) and text[i + 1] in _double_quote_escapes:
+                    literal.append(text[i + 1])
+                    i += 2
+                elif char == "$":
+                    i = parse_variable(i + 1)
+                else:
+                    literal.append(char)
+                    i += 1
+        elif char == "\\":
+            if i + 1 < len(text):
+                literal.append(text[i + 1])
+            i += 2
+        elif char == "$":
+            i = parse_variable(i + 1)
+        else:
+            literal.append(char)
+            i += 1
+
+    if start is not None:
+        flush_literal()
+        words.append((text[start:], parts))
+
+    return words
+
+
+# Splits text into words, without expanding them. Each word can be passed to expand_word().
+def split_words(text: str) -> list[str]:
+    return [raw for raw, _ in _parse(text)]
+
+
+@lru_cache(maxsize=4096)
+def compile_word(word: str) -> Template:
+    words = _parse(word)
+    if len(words) > 1:
+        raise AttributeError(f"'{word}' should be a single word. Use quotes around values containing spaces.")
+    if not words:
+        return Template([])
+    return Template([part for part in words[0][1] if part != ""])
+
+
+def expand_word(word: str, env: Mapping[str, str]) -> str:
+    return compile_word(word).expand(env)
+
+
+# Returns a word which expands to exactly the given text
+def quote_word(text: str) -> str:
+    if text and all(c in _name_chars + "-./=:,+@%" for c in text):
+        return text
+    return "'" + text.replace("'", "'\\''") + "'"
+
+
+# Same as os.path.expanduser(os.path.expandvars(text)), but with the variables taken from
+# 'env' instead of this process's environment. Used for values which aren't shell words,
+# such as the contents of created files. Undefined variables are left as they are.
+def expand_vars(text: str, env: Mapping[str, str]) -> str:
+    import re
+
+    def replace(match: "re.Match") -> str:
+        name = match[1] if match[1] is not None else match[2]
+        return env.get(name, match[0])
+
+    text = re.sub(r"\$(\w+)|\$\{([^}]*)\}", replace, text)
+    if text.startswith("~"):
+        user, separator, rest = text[1:].partition("/")
+        return _home_directory(user, env) + separator + rest
+    return text
@@ -0,0 +1,123 @@
+import os
+import sys
+import time
+import threading
+from typing import Any, Optional
+
+# Opt-in timing of the phases of a launch. Code marks a phase with:
+#   with tracing.span("parse base.yaml"):
+#       ...
+# When tracing isn't enabled, span() returns a shared object which does nothing,
+# so the only cost is a function call.
+
+# When this module was first imported, which is as early as possible in run-sandbox
+import_time: float = time.perf_counter()
+enabled: bool = False
+# Where to write the results when finish() is called, '-' for stderr
+output: Optional[str] = None
+# One of 'table', 'jsonl' or 'chrome'
+output_format: str = "table"
+
+# Finished spans, as (name, start, end, thread ID, depth, args)
+_spans: list[tuple[str, float, float, int, int, dict[str, Any]]] = []
+_local = threading.local()
+_finished: bool = False
+
+
+class _Span():
+    name: str
+    args: dict[str, Any]
+    start: float
+    # Number of spans this one is nested in, on the same thread
+    depth: int
+
+    def __init__(self, name: str, args: dict[str, Any]):
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> "_Span":
+        self.depth = getattr(_local, "depth", 0)
+        _local.depth = self.depth + 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_) -> None:
+        end = time.perf_counter()
+        _local.depth = self.depth
+        _spans.append((self.name, self.start, end, threading.get_ident(), self.depth, self.args))
+
+
+class _NullSpan():
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *_) -> None:
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def span(name: str, **args: Any) -> _Span | _NullSpan:
+    if not enabled:
+        return _null_span
+    return _Span(name, args)
+
+
+# Records a span which has already finished, e.g. one that started before tracing was enabled
+def add_span(name: str, start: float, end: float, **args: Any) -> None:
+    if enabled:
+        _spans.append((name, start, end, threading.get_ident(), getattr(_local, "depth", 0), args))
+
+
+def enable(path: str = "-", format: str = "table") -> None:
+    global enabled, output, output_format
+    enabled = True
+    output = path
+    output_format = format
+
+
+# Writes the results. Only does anything the first time it's called, so that it can
+# be called both before exec() and at exit.
+def finish() -> None:
+    global _finished
+    if not enabled or _finished:
+        return
+    _finished = True
+
+    spans = sorted(_spans, key=lambda span: span[1])
+    if output == "-":
+        _write(sys.stderr, spans)
+        sys.stderr.flush()
+    else:
+        with open(output, "w") as file:
+            _write(file, spans)
+
+
+def _write(file: Any, spans: list[tuple[str, float, float, int, int, dict[str, Any]]]) -> None:
+    import json
+    # Threads are numbered in the order they first appear, starting with the main thread
+    threads = {threading.main_thread().ident: 0}
+    for _, _, _, thread, _, _ in spans:
+        threads.setdefault(thread, len(threads))
+
+    if output_format == "chrome":
+        events = [{
+            "name": name,
+            "ph": "X",
+            "ts": (start - import_time) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threads[thread],
+            "args": args,
+        } for name, start, end, thread, _, args in spans]
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+        file.write("\n")
+    elif output_format == "jsonl":
+        for name, start, end, thread, depth, args in spans:
+            event = {"name": name, "start_ms": (start - import_time) * 1000, "duration_ms": (end - start) * 1000, "thread": threads[thread], "depth": depth, "args": args}
+            file.write(json.dumps(event) + "\n")
+    else:
+        file.write(f"{'start (ms)':>10} {'duration (ms)':>14} {'thread':>6}  phase\n")
+        for name, start, end, thread, depth, _ in spans:
+            file.write(f"{(start - import_time) * 1000:>10.2f} {(end - start) * 1000:>14.2f} {threads[thread]:>6}  {'  ' * depth}{name}\n")
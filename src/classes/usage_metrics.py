@@ -0,0 +1,139 @@
+import os
+import re
+import json
+import time
+from typing import Any, Optional
+
+# Records what each sandbox consumed once it has exited, tagged with its config's name.
+# Records are appended to a JSON lines file, and added to the totals in a file for the
+# Prometheus node exporter's textfile collector. Both files can be shared by any number
+# of processes (e.g. run-sandbox, the daemon and its launches).
+#
+# The resource usage is what the kernel reports when bwrap is reaped (wait4), which covers
+# bwrap and every process in the sandbox which was waited for, i.e. all of them once the
+# sandbox has exited. A record looks like:
+#   {"time": 1700000000.0, "app": "Firefox", "pid": 1234, "exit_code": 0,
+#    "launch_seconds": 0.05, "run_seconds": 12.5, "cpu_user_seconds": 3.2, ...}
+# 'launch_seconds' is the time from starting the launch (before preparing) until bwrap was
+# executed, and 'run_seconds' the time from then until it exited. For commands run in a
+# pooled sandbox, 'launch_seconds' is the time taken to hand the command to the sandbox.
+
+# Fields of resource.struct_rusage (without 'ru_') and the names they're recorded under
+rusage_fields: dict[str, str] = {
+    "utime": "cpu_user_seconds",
+    "stime": "cpu_system_seconds",
+    "maxrss": "max_rss_bytes",
+    "minflt": "minor_page_faults",
+    "majflt": "major_page_faults",
+    "nvcsw": "voluntary_context_switches",
+    "nivcsw": "involuntary_context_switches",
+    "inblock": "block_input_operations",
+    "oublock": "block_output_operations",
+}
+
+# Prometheus metrics, as {name: (type, help, [(record field, extra labels)])}.
+# Counters are added to, gauges keep the largest value.
+_metrics: dict[str, tuple[str, str, list[tuple[str, str]]]] = {
+    "sandbox_runs_total": ("counter", "Number of sandboxes which have exited.", [("runs", "")]),
+    "sandbox_failed_runs_total": ("counter", "Number of sandboxes which exited with a non-zero exit code.", [("failed", "")]),
+    "sandbox_launch_seconds_total": ("counter", "Time from starting a launch until bwrap was executed.", [("launch_seconds", "")]),
+    "sandbox_run_seconds_total": ("counter", "Time sandboxes were running for.", [("run_seconds", "")]),
+    "sandbox_cpu_seconds_total": ("counter", "CPU time used by sandboxes.", [("cpu_user_seconds", 'mode="user"'), ("cpu_system_seconds", 'mode="system"')]),
+    "sandbox_max_rss_bytes": ("gauge", "Largest resident set size of a process in any sandbox.", [("max_rss_bytes", "")]),
+    "sandbox_page_faults_total": ("counter", "Page faults in sandboxes.", [("minor_page_faults", 'type="minor"'), ("major_page_faults", 'type="major"')]),
+    "sandbox_context_switches_total": ("counter", "Context switches in sandboxes.", [("voluntary_context_switches", 'type="voluntary"'), ("involuntary_context_switches", 'type="involuntary"')]),
+    "sandbox_block_io_operations_total": ("counter", "Block I/O operations by sandboxes.", [("block_input_operations", 'direction="read"'), ("block_output_operations", 'direction="write"')]),
+}
+_series_pattern = re.compile(r"([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{.*\})?) (\S+)")
+
+
+# Returns the resource usage reported by wait4 (or the pool stub) as record fields.
+# 'usage' has the fields of resource.struct_rusage, without 'ru_'.
+def rusage_record(usage: dict[str, Any]) -> dict[str, Any]:
+    record = {}
+    for field, name in rusage_fields.items():
+        if field in usage:
+            record[name] = usage[field]
+    # Linux reports it in KiB
+    if "max_rss_bytes" in record:
+        record["max_rss_bytes"] *= 1024
+    return record
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class UsageMetrics():
+    # JSON lines file each record is appended to
+    log_path: Optional[str]
+    # Prometheus textfile collector file (*.prom)
+    textfile_path: Optional[str]
+
+    def __init__(self, log_path: Optional[str] = None, textfile_path: Optional[str] = None):
+        self.log_path = log_path
+        self.textfile_path = textfile_path
+
+    def record(self, app_name: str, pid: int, exit_code: Optional[int], launch_seconds: float, run_seconds: float, usage: dict[str, Any], pooled: bool = False) -> dict[str, Any]:
+        record = {
+            "time": round(time.time(), 3),
+            "app": app_name,
+            "pid": pid,
+            "exit_code": exit_code,
+            "pooled": pooled,
+            "launch_seconds": round(launch_seconds, 6),
+            "run_seconds": round(run_seconds, 6),
+        }
+        record.update(rusage_record(usage))
+
+        if self.log_path:
+            # A single write to a file opened for appending isn't interleaved with others
+            with open(self.log_path, "a") as file:
+                file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        if self.textfile_path:
+            self.update_textfile(record)
+        return record
+
+    # Adds the record to the totals in the textfile. The collector may read it at any time,
+    # so it's replaced with a complete new file.
+    def update_textfile(self, record: dict[str, Any]) -> None:
+        import fcntl
+        labels = f'app="{_escape_label(record["app"])}"'
+        values = dict(record, runs=1, failed=int(record["exit_code"] not in [0, None]))
+
+        with open(self.textfile_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            series = self.read_textfile()
+            for name, (metric_type, _, fields) in _metrics.items():
+                for field, extra_labels in fields:
+                    if field not in values:
+                        continue
+                    key = f"{name}{{{labels}{',' + extra_labels if extra_labels else ''}}}"
+                    if metric_type == "gauge":
+                        series[key] = max(series.get(key, 0), values[field])
+                    else:
+                        series[key] = series.get(key, 0) + values[field]
+
+            temp_path = f"{self.textfile_path}.{os.getpid()}.tmp"
+            with open(temp_path, "w") as file:
+                for name, (metric_type, description, _) in _metrics.items():
+                    keys = sorted(key for key in series if key.partition("{")[0] == name)
+                    if not keys:
+                        continue
+                    file.write(f"# HELP {name} {description}\n# TYPE {name} {metric_type}\n")
+                    for key in keys:
+                        file.write(f"{key} {float(series[key])!r}\n")
+            os.replace(temp_path, self.textfile_path)
+
+    # Returns the series in the textfile, as {'name{labels}': value}
+    def read_textfile(self) -> dict[str, float]:
+        series = {}
+        try:
+            with open(self.textfile_path, "r") as file:
+                for line in file:
+                    match = _series_pattern.fullmatch(line.strip())
+                    if match and not line.startswith("#"):
+                        series[match[1]] = float(match[2])
+        except FileNotFoundError:
+            pass
+        return series
@@ -0,0 +1,70 @@
+# Launches a sandbox through a running sandbox-manager daemon ('run-sandbox --daemon').
+# Kept as small as possible, since its startup time is part of every launch.
+from classes.daemon import socket_path, send_message, recv_message, relayed_signals
+import signal
+import socket
+import sys
+import os
+
+usage = "usage: run-sandbox-client [-h] [--pool-stats] [--run EXECUTABLE] filename [args ...]"
+
+arguments = sys.argv[1:]
+run = None
+if arguments and arguments[0] in ["-h", "--help"]:
+    print(usage)
+    print("\nRun the config file 'filename' through a running sandbox-manager daemon. \
+See run-sandbox(1) for the meaning of the arguments. With '--pool-stats', print the \
+statistics of the daemon's pools as JSON instead.")
+    sys.exit(0)
+if arguments and arguments[0] == "--run":
+    if len(arguments) < 2:
+        sys.exit(f"{usage}\nrun-sandbox-client: error: argument --run: expected one argument")
+    run = arguments[1]
+    arguments = arguments[2:]
+if not arguments:
+    sys.exit(f"{usage}\nrun-sandbox-client: error: the following arguments are required: filename")
+
+client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+try:
+    client.connect(socket_path())
+except OSError as error:
+    sys.exit(f"run-sandbox-client: Could not connect to the sandbox-manager daemon: {error}")
+
+if arguments == ["--pool-stats"]:
+    import json
+    send_message(client, {"stats": True})
+    reply, _ = recv_message(client)
+    print(json.dumps(reply["stats"], indent=2))
+    sys.exit(0)
+
+request = {
+    "config": arguments[0],
+    "args": arguments[1:],
+    "run": run,
+    "env": dict(os.environ),
+    "cwd": os.getcwd(),
+}
+try:
+    send_message(client, request, [0, 1, 2])
+except OSError as error:
+    sys.exit(f"run-sandbox-client: Could not send the request to the sandbox-manager daemon: {error}")
+
+# Pass on the signals the terminal sends to this process instead of the sandbox, e.g. Ctrl-C
+# and window size changes
+def relay_signal(signum: int, frame) -> None:
+    try:
+        send_message(client, {"signal": signum})
+    except OSError:
+        pass
+
+for signum in relayed_signals:
+    signal.signal(signum, relay_signal)
+
+try:
+    reply, _ = recv_message(client)
+except EOFError:
+    sys.exit("run-sandbox-client: The sandbox-manager daemon exited before the sandbox did.")
+
+if "error" in reply:
+    sys.exit(f"run-sandbox-client: {reply['error']}")
+sys.exit(reply["exit"])
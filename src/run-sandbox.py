@@ -1,9 +1,14 @@
+# Imported first, so that the time spent on imports can be traced
+from classes import tracing
 from classes.sandbox import Sandbox
 from classes.config_loader import ConfigLoader
-from yaml import safe_dump
+from classes.config_index import ConfigIndex
+from classes.launch_cache import LaunchCache
+from classes.compiled_config import CompiledConfig, read_bundle, write_bundle
 from argparse import ArgumentParser
 import sys
 import os
+import time
 
 argparser = ArgumentParser(
     prog="run-sandbox",
@@ -21,6 +26,93 @@ argparser.add_argument(
     print out a new configuration file with the dependencies integrated, then exit. \
     Useful for determining exactly what a program will be given access to."
 )
+argparser.add_argument(
+    "--compile", "-c",
+    metavar="FILE",
+    default=None,
+    help="Parse the given configuration file and its dependencies, write the result \
+    and the generated bwrap arguments to FILE as a sandbox bundle, then exit. \
+    Bundles can be run with '--bundle' without reading any configuration files."
+)
+argparser.add_argument(
+    "--bundle", "-b",
+    action="store_true",
+    default=False,
+    help="Treat 'filename' as the path of a sandbox bundle created with '--compile'."
+)
+argparser.add_argument(
+    "--check-all",
+    action="store_true",
+    default=False,
+    help="Parse and validate every config file in the '--search-in' directories (or in \
+    every search directory if none are given) instead of running one, then exit. \
+    Only configs affected by files changed since the last check are parsed again."
+)
+argparser.add_argument(
+    "--output-dir",
+    metavar="DIR",
+    default=None,
+    help="With '--check-all', write the flattened version of each valid config file to DIR."
+)
+argparser.add_argument(
+    "--report",
+    metavar="FILE",
+    default=None,
+    help="With '--check-all' or '--batch', write the results as JSON to FILE ('-' for stdout)."
+)
+argparser.add_argument(
+    "--jobs", "-j",
+    type=int,
+    default=None,
+    metavar="N",
+    help="With '--check-all', the number of processes to use. With '--batch', the number of \
+    sandboxes running at once. Defaults to the number of available CPUs."
+)
+argparser.add_argument(
+    "--batch",
+    metavar="MANIFEST",
+    default=None,
+    help="Run the launches listed in MANIFEST (a YAML file of configs, arguments and repeat \
+    counts) from this process, a limited number at a time, then print a summary of their exit \
+    codes and durations. Each config is only resolved once."
+)
+argparser.add_argument(
+    "--stagger",
+    type=float,
+    default=None,
+    metavar="SECONDS",
+    help="With '--batch', wait at least SECONDS between starting sandboxes."
+)
+argparser.add_argument(
+    "--daemon",
+    action="store_true",
+    default=False,
+    help="Start a daemon which keeps resolved configs in memory and launches sandboxes \
+    for run-sandbox-client, instead of running a config. Runs until it's terminated."
+)
+argparser.add_argument(
+    "--pool",
+    type=int,
+    default=None,
+    metavar="N",
+    help="Start a daemon (see '--daemon') which keeps N sandboxes of the config file set up \
+    and waiting, and runs commands from run-sandbox-client in them."
+)
+argparser.add_argument(
+    "--pool-max-age",
+    type=float,
+    default=None,
+    metavar="SECONDS",
+    help="With '--pool', replace sandboxes which have been waiting for longer than SECONDS."
+)
+argparser.add_argument(
+    "--pool-max-uses",
+    type=int,
+    default=1,
+    metavar="N",
+    help="With '--pool', the number of commands to run in each sandbox before replacing it. \
+    Defaults to 1, since later commands can see what earlier ones left in the sandbox."
+)
 argparser.add_argument(
     "--run",
     metavar="EXECUTABLE",
@@ -28,6 +120,118 @@ argparser.add_argument(
     help="A program to run instead of the one specified in the given config file. \
     Useful for running a shell in your program's environment."
 )
+argparser.add_argument(
+    "--no-cache",
+    action="store_true",
+    default=False,
+    help="Don't read or write the launch cache. The config file and its dependencies \
+    will be parsed again."
+)
+argparser.add_argument(
+    "--rebuild-cache",
+    action="store_true",
+    default=False,
+    help="Ignore any existing launch cache entry for the config file and replace it."
+)
+argparser.add_argument(
+    "--verbose", "-v",
+    action="store_true",
+    default=False,
+    help="Print information about the launch (e.g. whether the launch cache was used) to stderr."
+)
+argparser.add_argument(
+    "--exec", "-e",
+    action="store_true",
+    default=False,
+    help="Replace run-sandbox with bwrap instead of waiting for it to exit, if nothing \
+    needs to be cleaned up after the sandbox exits. Saves memory for long-running sandboxes."
+)
+argparser.add_argument(
+    "--args-fd",
+    action="store_true",
+    default=False,
+    help="Pass arguments to bwrap through a file descriptor instead of the command line. \
+    Useful for configs with thousands of permissions, which may not fit on a command line."
+)
+argparser.add_argument(
+    "--no-optimize-mounts",
+    action="store_true",
+    default=False,
+    help="Pass every mount generated from the config to bwrap, instead of removing \
+    mounts which don't change the sandbox (duplicates, and optional binds of missing paths)."
+)
+argparser.add_argument(
+    "--trace-timing",
+    action="store_true",
+    default=False,
+    help="Print how long each phase of the launch took to stderr, or write it to the file \
+    given by '--trace-timing-output' in the format given by '--trace-format'."
+)
+argparser.add_argument(
+    "--trace-timing-output",
+    default=None,
+    metavar="FILE",
+    help="With '--trace-timing', write the phases to FILE instead of stderr."
+)
+argparser.add_argument(
+    "--trace-format",
+    choices=["table", "jsonl", "chrome"],
+    default=None,
+    help="The format of '--trace-timing': a table, JSON lines, or the Chrome trace \
+    event format (which can be opened with chrome://tracing or Perfetto). Defaults to \
+    'table' on stderr and 'chrome' for files."
+)
+argparser.add_argument(
+    "--trace-access",
+    action="store_true",
+    default=False,
+    help="Record which paths the sandbox opens while it runs, and write the bound paths \
+    (filesystem permissions) it never used to stderr, or to the file given by \
+    '--trace-access-output', in the format given by '--trace-access-format'. Uses fanotify \
+    if run as root, otherwise samples /proc, which can miss short-lived files."
+)
+argparser.add_argument(
+    "--trace-access-output",
+    default=None,
+    metavar="FILE",
+    help="With '--trace-access', write the result to FILE instead of stderr."
+)
+argparser.add_argument(
+    "--trace-access-format",
+    choices=["report", "config"],
+    default="report",
+    help="The format of '--trace-access': a JSON report of the unused entries and the \
+    config files they come from, or the flattened config with them removed."
+)
+argparser.add_argument(
+    "--metrics-log",
+    default=None,
+    metavar="FILE",
+    help="Append what the sandbox consumed (CPU time, memory, page faults, context switches, \
+    block I/O, launch and run time) to FILE as a JSON line once it exits. Implies waiting \
+    for the sandbox, even with '--exec'."
+)
+argparser.add_argument(
+    "--metrics-textfile",
+    default=None,
+    metavar="FILE",
+    help="Add what the sandbox consumed to the totals for its config in FILE, in the \
+    format of the Prometheus node exporter's textfile collector (a .prom file). Implies \
+    waiting for the sandbox, even with '--exec'."
+)
+argparser.add_argument(
+    "--log-output",
+    default=None,
+    metavar="FILE",
+    help="Write the sandbox's stdout and stderr to FILE instead of the terminal, rotating \
+    it once it reaches 10 MiB (see the 'output' config category for more options)."
+)
+argparser.add_argument(
+    "--log-timestamps",
+    action="store_true",
+    default=False,
+    help="Start each line written to the sandbox's log files with the time it was written."
+)
 argparser.add_argument(
     "--search-in", "-s",
     action="append",
@@ -37,6 +241,7 @@ argparser.add_argument(
 )
 argparser.add_argument(
     "filename",
+    nargs="?",
     help="The name of the configuration file to run, without the file extension."
 )
 argparser.add_argument(
@@ -50,21 +255,211 @@ argparser.add_argument(
 script_path = os.path.abspath(os.path.dirname(__file__))
 args = argparser.parse_args()
 
+if args.trace_timing:
+    import atexit
+    trace_output = args.trace_timing_output or "-"
+    tracing.enable(trace_output, args.trace_format or ("table" if trace_output == "-" else "chrome"))
+    tracing.add_span("imports and argument parsing", tracing.import_time, time.perf_counter())
+    atexit.register(tracing.finish)
+
 search_paths = args.search_in + os.environ.get("SANDBOX_CONFIG_DIRS", "").split(":") + [os.path.join(script_path, "default_configs/")]
 # Remove empty strings and lists
 search_paths = [i for i in search_paths if i]
 
-config_loader = ConfigLoader(search_paths)
-config_loader.load(args.filename)
+if args.check_all:
+    from classes.config_checker import ConfigChecker
+    from yaml import safe_dump
+    import json
+
+    checker = ConfigChecker(ConfigIndex(search_paths), args.jobs, use_state=not args.no_cache)
+    results = checker.check(checker.find_configs(args.search_in), reuse=not args.rebuild_cache)
+    errors = [filename for filename, result in results.items() if result["error"] is not None]
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+        for filename, result in results.items():
+            if result["error"] is None:
+                with open(os.path.join(args.output_dir, filename), "w") as file:
+                    safe_dump(result["config"], file, sort_keys=False)
+
+    if args.report:
+        report = {
+            "checked": len(results),
+            "rechecked": len(checker.rechecked),
+            "errors": len(errors),
+            "configs": {
+                filename: {
+                    "path": result["path"],
+                    "valid": result["error"] is None,
+                    "error": result["error"],
+                    "warnings": result["warnings"],
+                    "files": [path for path,_ in result["files"].values()],
+                    "rechecked": filename in checker.rechecked,
+                } for filename, result in results.items()
+            },
+        }
+        if args.report == "-":
+            json.dump(report, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.report, "w") as file:
+                json.dump(report, file, indent=2)
+    else:
+        for filename in errors:
+            print(f"{results[filename]['path']}: {results[filename]['error']}", file=sys.stderr)
+
+    if args.verbose or not args.report:
+        print(f"Checked {len(results)} config files ({len(checker.rechecked)} parsed again), {len(errors)} invalid.", file=sys.stderr)
+    sys.exit(1 if errors else 0)
+
+metrics = None
+if args.metrics_log or args.metrics_textfile:
+    from classes.usage_metrics import UsageMetrics
+    metrics = UsageMetrics(args.metrics_log, args.metrics_textfile)
+
+if args.batch:
+    from classes.batch import BatchRunner, load_manifest
+    import json
+
+    entries, options = load_manifest(args.batch)
+    runner = BatchRunner(
+        search_paths,
+        entries,
+        jobs=args.jobs if args.jobs is not None else options.get("jobs"),
+        stagger=args.stagger if args.stagger is not None else options.get("stagger", 0.0),
+        metrics=metrics,
+        verbose=args.verbose,
+    )
+    try:
+        summary = runner.run()
+    except KeyboardInterrupt:
+        sys.exit(130)
+
+    if args.report == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.report:
+        with open(args.report, "w") as file:
+            json.dump(summary, file, indent=2)
+    if args.verbose or not args.report:
+        for name, config_summary in summary["configs"].items():
+            run_seconds = config_summary["run_seconds"]
+            durations = f", ran for {run_seconds['min']:.2f}-{run_seconds['max']:.2f} s (median {run_seconds['median']:.2f} s)" if run_seconds else ""
+            print(f"{name}: {config_summary['launches']} launches, {config_summary['failed']} failed{durations}.", file=sys.stderr)
+        print(f"Ran {summary['launches']} launches in {summary['wall_seconds']:.2f} s, {summary['failed']} failed.", file=sys.stderr)
+    sys.exit(1 if summary["failed"] else 0)
+
+if args.daemon or args.pool is not None:
+    from classes.daemon import SandboxDaemon
+    daemon = SandboxDaemon(search_paths, verbose=args.verbose, metrics=metrics)
+    if args.pool is not None:
+        if args.filename is None:
+            argparser.error("argument --pool: a config file is required")
+        if args.pool < 1 or args.pool_max_uses < 1:
+            argparser.error("argument --pool: the pool size and max uses should be at least 1")
+        daemon.add_pool(args.filename, args.pool, args.pool_max_age, args.pool_max_uses)
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
+
+if args.filename is None:
+    argparser.error("the following arguments are required: filename")
+
+compiled = None
+if args.bundle:
+    compiled = read_bundle(args.filename)
+else:
+    config_index = ConfigIndex(search_paths)
+    launch_cache = LaunchCache(config_index)
+
+    # Tracing reports which config files unused entries come from
+    if not args.no_cache and not args.rebuild_cache and not args.trace_access:
+        with tracing.span("launch cache lookup"):
+            compiled = launch_cache.lookup(args.filename)
+    if args.verbose and not args.no_cache:
+        print(f"Launch cache {'hit' if compiled else 'miss'} for '{args.filename}'.", file=sys.stderr)
+
+if compiled:
+    config = compiled.config
+else:
+    config_loader = ConfigLoader(search_paths, config_index)
+    with tracing.span("load config", config=args.filename):
+        config_loader.load(args.filename)
+    config = config_loader.config
 
 if args.flatten:
-    safe_dump(config_loader.config, sys.stdout, sort_keys=False)
+    from yaml import safe_dump
+    safe_dump(config, sys.stdout, sort_keys=False)
     sys.exit(0)
 
 sandbox = None
-sandbox = Sandbox(config_loader.config, extra_args=args.args)
+# Sandbox removes 'name' and 'run' from the config it is given, so give it a copy
+sandbox_config = dict(config)
+sandbox_args = compiled.args if compiled else None
+if args.log_output or args.log_timestamps:
+    output = dict(sandbox_config.get("output") or {})
+    if args.log_output:
+        output.update(stdout=args.log_output, stderr=args.log_output)
+    if args.log_timestamps:
+        output["timestamps"] = True
+    sandbox_config["output"] = output
+    # The cached args don't include the output options
+    sandbox_args = None
+with tracing.span("create sandbox"):
+    sandbox = Sandbox(sandbox_config, extra_args=args.args, args=sandbox_args)
+
+if not compiled:
+    with tracing.span("store launch cache entry"):
+        compiled = CompiledConfig(config, sandbox.compile_args())
+        if not args.no_cache:
+            launch_cache.store(args.filename, config_loader.loaded_files, compiled)
+
+if args.compile:
+    write_bundle(args.compile, compiled)
+    sys.exit(0)
 
 if args.run:
     sandbox.executable = args.run
+sandbox.use_exec = args.exec
+sandbox.verbose = args.verbose
+sandbox.optimize_mounts = not args.no_optimize_mounts
+sandbox.use_args_fd = args.args_fd
+sandbox.metrics = metrics
+
+if args.trace_access:
+    from classes.access_trace import AccessTracer, bind_entries
+    sandbox.access_tracer = AccessTracer([source for _, _, source, _ in bind_entries(config, sandbox.env)])
+
+process = sandbox.run()
+
+if args.trace_access:
+    from classes.access_trace import find_unused, unused_by_file, trim_config
+    from yaml import safe_dump
+    import json
+
+    tracer = sandbox.access_tracer
+    unused = find_unused(config, sandbox.env, tracer.paths)
+    if args.trace_access_format == "config":
+        output = safe_dump(trim_config(config, unused), sort_keys=False)
+    else:
+        report = {
+            "config": args.filename,
+            "method": tracer.method,
+            "overflowed": tracer.overflowed,
+            "exit_code": process.returncode,
+            "paths": sorted(tracer.paths),
+            "unused": unused,
+            "files": unused_by_file(unused, config_loader.loaded_files) if not args.bundle else {},
+        }
+        output = json.dumps(report, indent=2) + "\n"
 
-sandbox.run()
+    if args.trace_access_output:
+        with open(args.trace_access_output, "w") as file:
+            file.write(output)
+    else:
+        sys.stderr.write(output)
+    if args.verbose or args.trace_access_output:
+        total = len(bind_entries(config, sandbox.env))
+        print(f"Traced {len(tracer.paths)} paths with {tracer.method}, {sum(map(len, unused.values()))} of {total} bound paths weren't used.", file=sys.stderr)